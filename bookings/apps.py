@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BookingsConfig(AppConfig):
     name = 'bookings'
+
+    def ready(self):
+        # connect token cache invalidation signals
+        from bookings import authhelper  # noqa: F401
@@ -0,0 +1,146 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+
+from bookings import outlookservice
+from bookings.timing import timer
+
+_executor = None
+
+
+def get_executor():
+    '''
+    Shared worker threads the pooled HTTP client runs on, sized by GRAPH_ASYNC_MAX_CONCURRENCY
+    :return: ThreadPoolExecutor
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.GRAPH_ASYNC_MAX_CONCURRENCY)
+    return _executor
+
+
+def get_cached_events_between_dates(access_token, user_email, start_date, end_date):
+    '''
+    Read a whole date window through the calendar cache
+    :param access_token:
+    :param user_email:
+    :param start_date: iso format start date
+    :param end_date: iso format end date
+    :return: dictionary containing value key which maps to list of dicts for each event or error string
+    '''
+    try:
+        return {'value': list(outlookservice.iter_cached_events_between_dates(access_token, user_email,
+                                                                               start_date, end_date))}
+    except requests.HTTPError as error:
+        return "{0}: {1}".format(error.response.status_code, error.response.text)
+
+
+class AsyncGraphClient(object):
+    '''
+    asyncio client for outlook calendar operations, the same calls as outlookservice awaited concurrently
+    with at most max_concurrency Graph requests in flight
+    e.g. await client.gather_events_between_dates([(token, email, '2018-02-10', '2018-02-17'), ...])
+    '''
+
+    def __init__(self, max_concurrency=None):
+        '''
+        :param max_concurrency: requests in flight at once, defaults to GRAPH_ASYNC_MAX_CONCURRENCY
+        '''
+        self.max_concurrency = max_concurrency or settings.GRAPH_ASYNC_MAX_CONCURRENCY
+        self.semaphore = None
+
+    async def call(self, function, *args, **kwargs):
+        '''
+        Run a blocking outlookservice function on the executor once a concurrency slot is free
+        :param function: outlookservice function
+        :return: function's return value
+        '''
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(get_executor(), functools.partial(function, *args, **kwargs))
+
+    async def get_events_between_dates(self, access_token, user_email, start_date, end_date):
+        '''
+        :return: dictionary containing value key which maps to list of dicts for each event or error string
+        '''
+        return await self.call(get_cached_events_between_dates, access_token, user_email, start_date, end_date)
+
+    async def get_next_pages(self, access_token, user_email, next_link):
+        '''
+        :return: list of event dicts on the pages from next_link on or error string
+        '''
+        return await self.call(outlookservice.get_next_pages, access_token, user_email, next_link)
+
+    async def book_event(self, access_token, user_email, event, body_content):
+        '''
+        :return: dict with booking details including created event id or error string
+        '''
+        return await self.call(outlookservice.book_event, access_token, user_email, event, body_content)
+
+    async def update_booking(self, access_token, user_email, event, body_content):
+        '''
+        :return: dict response containing saved event data or error string
+        '''
+        return await self.call(outlookservice.update_booking, access_token, user_email, event, body_content)
+
+    async def cancel_booking(self, access_token, user_email, event_id):
+        '''
+        :return: True if event was successfully cancelled else False
+        '''
+        return await self.call(outlookservice.cancel_booking, access_token, user_email, event_id)
+
+    async def gather_events_between_dates(self, windows):
+        '''
+        Fetch several date windows, weeks or hosts' calendars, concurrently
+        :param windows: list of tuples (access_token, user_email, start_date, end_date)
+        :return: list of responses in the same order as windows
+        '''
+        return await asyncio.gather(*[self.get_events_between_dates(*window) for window in windows])
+
+    async def gather_next_pages(self, links):
+        '''
+        Follow several calendarView windows' further pages concurrently
+        :param links: list of tuples (access_token, user_email, next_link)
+        :return: list of responses in the same order as links
+        '''
+        return await asyncio.gather(*[self.get_next_pages(*link) for link in links])
+
+
+def run_sync(coroutine):
+    '''
+    Run a coroutine to completion on a new event loop so synchronous views can use the async client,
+    the wait counts as graph time of the request
+    :param coroutine: e.g. AsyncGraphClient().gather_events_between_dates(windows)
+    :return: coroutine result
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        with timer('graph'):
+            return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def get_events_for_windows(windows, max_concurrency=None):
+    '''
+    Synchronous adapter fetching several date windows concurrently
+    :param windows: list of tuples (access_token, user_email, start_date, end_date)
+    :param max_concurrency: requests in flight at once
+    :return: list of responses in the same order as windows
+    '''
+    return run_sync(AsyncGraphClient(max_concurrency).gather_events_between_dates(windows))
+
+
+def get_next_pages(links, max_concurrency=None):
+    '''
+    Synchronous adapter following several windows' further pages concurrently
+    :param links: list of tuples (access_token, user_email, next_link)
+    :param max_concurrency: requests in flight at once
+    :return: list of responses in the same order as links
+    '''
+    return run_sync(AsyncGraphClient(max_concurrency).gather_next_pages(links))
@@ -1,21 +1,30 @@
 
+import copy
 import datetime
+import threading
+import time
 
-import requests
+from allauth.socialaccount.models import SocialToken
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
+from bookings import httpclient
+from bookings.timing import timer
 from meeting_scheduler.secret_settings import CLIENT_SECRET
 
 URI_CALLBACK = '/accounts/microsoft/login/callback/'
 
 client_id = 'c82fc9db-5118-4581-91ed-b3c586820b72'
 
-#  OAuth authority URL enables OAurh2 credential flow
-authority = 'https://login.microsoftonline.com'
-authorize_url = '{0}{1}'.format(authority, '/common/oauth2/v2.0/authorize?{0}')
+#  OAuth authority URL (OUTLOOK_AUTHORITY) enables OAurh2 credential flow
+authorize_path = '/common/oauth2/v2.0/authorize?{0}'
 
 #  token  endpoint
-token_url = '{0}{1}'.format(authority, '/common/oauth2/v2.0/token')
+token_path = '/common/oauth2/v2.0/token'
 
 scopes = ['openid',
           'offline_access',
@@ -23,6 +32,17 @@ scopes = ['openid',
           'Mail.Read',
           'Calendars.Read']
 
+# access tokens cached in process by social account id
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
+def get_token_url():
+    '''
+    :return: token endpoint under OUTLOOK_AUTHORITY
+    '''
+    return '{0}{1}'.format(settings.OUTLOOK_AUTHORITY, token_path)
+
+
 def get_new_access_token_from_refresh_token(refresh_token, redirect_uri):
     '''
     Query graph endpoint to refresh token
@@ -39,7 +59,7 @@ def get_new_access_token_from_refresh_token(refresh_token, redirect_uri):
                  'client_secret': CLIENT_SECRET
                  }
 
-    r = requests.post(token_url, data=payload)
+    r = httpclient.request('POST', get_token_url(), data=payload)
 
     try:
         return r.json()
@@ -47,16 +67,127 @@ def get_new_access_token_from_refresh_token(refresh_token, redirect_uri):
         return 'Error obtaining token: {0} - {1}'.format(r.status_code, r.text)
 
 
+def get_background_redirect_uri():
+    '''
+    Callback url for token refreshes made outside of a request e.g. management commands
+    :return: absolute callback url built from OUTLOOK_SITE_URL
+    '''
+    return '{0}{1}'.format(settings.OUTLOOK_SITE_URL.rstrip('/'), URI_CALLBACK)
+
+
+def get_social_token(account):
+    '''
+    Get an account's token from the in process cache, read from the database on first use
+    a copy is returned so requests never share a token object
+    :param account: SocialAccount
+    :return: SocialToken
+    '''
+    with _token_cache_lock:
+        token_obj = _token_cache.get(account.pk)
+    if token_obj is None:
+        token_obj = account.socialtoken_set.get()
+        cache_social_token(token_obj)
+    return copy.copy(token_obj)
+
+
+def cache_social_token(token_obj):
+    '''
+    :param token_obj: SocialToken
+    :return: Void
+    '''
+    with _token_cache_lock:
+        _token_cache[token_obj.account_id] = copy.copy(token_obj)
+
+
+@receiver([post_save, post_delete], sender=SocialToken)
+def forget_social_token(sender, instance, **kwargs):
+    '''
+    Drop a cached token when it is saved or deleted elsewhere e.g. on login
+    '''
+    with _token_cache_lock:
+        _token_cache.pop(instance.account_id, None)
+
+
+def refresh_access_token(token_obj, redirect_uri):
+    '''
+    Refresh an account's access token, single flight across threads sharing the cache through a cache lock
+    and across processes e.g. web workers and management commands through a row lock on the token,
+    on databases without row locks (SQLite) only the cache lock applies
+    if another refresh is running for the account wait for it and use its token
+    :param token_obj: SocialToken, updated in place
+    :param redirect_uri: usually a callback url
+    :return: Void
+    '''
+    lock_key = 'outlook_token_refresh:{}'.format(token_obj.account_id)
+    timeout = settings.OUTLOOK_TOKEN_REFRESH_TIMEOUT
+    if not cache.add(lock_key, 1, timeout):
+        waited = 0
+        while cache.get(lock_key) and waited < timeout:
+            time.sleep(0.1)
+            waited += 0.1
+        token_obj.refresh_from_db()
+        cache_social_token(token_obj)
+        return
+    try:
+        with transaction.atomic():
+            # held until the new token is saved, a process refreshing the same token waits here then reuses it
+            locked = SocialToken.objects.select_for_update().get(pk=token_obj.pk)
+            if locked.expires_at <= timezone.now() + \
+                    datetime.timedelta(seconds=settings.OUTLOOK_TOKEN_REFRESH_MARGIN):
+                response = get_new_access_token_from_refresh_token(locked.token_secret, redirect_uri)
+                locked.token_secret = response['refresh_token']
+                locked.token = response['access_token']
+                locked.expires_at = timezone.now() + datetime.timedelta(hours=1)
+                locked.save()
+        # otherwise refreshed by another worker since it was read
+        token_obj.token, token_obj.token_secret, token_obj.expires_at = \
+            locked.token, locked.token_secret, locked.expires_at
+        cache_social_token(token_obj)
+    finally:
+        cache.delete(lock_key)
+
+
+def refresh_access_token_in_background(token_obj, redirect_uri):
+    '''
+    Refresh a token that is about to expire on a separate thread so the request is not held up
+    :param token_obj: SocialToken
+    :param redirect_uri: usually a callback url
+    :return: Thread or None if a refresh is already running for the account
+    '''
+    if cache.get('outlook_token_refresh:{}'.format(token_obj.account_id)):
+        return None
+
+    def refresh():
+        try:
+            refresh_access_token(copy.copy(token_obj), redirect_uri)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
+
+
+def refresh_expired_token(token_obj, redirect_uri):
+    '''
+    Obtain new access token through refresh token if the current one has expired,
+    tokens within OUTLOOK_TOKEN_REFRESH_MARGIN seconds of expiry are refreshed in the background
+    :param token_obj:
+    :param redirect_uri: usually a callback url
+    :return: Void
+    '''
+    now = timezone.now()
+    if token_obj.expires_at < now:
+        with timer('token'):
+            refresh_access_token(token_obj, redirect_uri)
+    elif token_obj.expires_at < now + datetime.timedelta(seconds=settings.OUTLOOK_TOKEN_REFRESH_MARGIN):
+        refresh_access_token_in_background(token_obj, redirect_uri)
+
+
 def set_new_token(request,token_obj):
     '''
     Obtain new access token through refresh token
     :param token_obj:
     :return: Void
     '''
-    if token_obj.expires_at < timezone.now():
-        refresh_token = token_obj.token_secret
-        response = get_new_access_token_from_refresh_token(refresh_token, request.build_absolute_uri(URI_CALLBACK))
-        token_obj.token_secret = response['refresh_token']
-        token_obj.token = response['access_token']
-        token_obj.expires_at = timezone.now() + datetime.timedelta(hours=1)
-        token_obj.save()
\ No newline at end of file
+    refresh_expired_token(token_obj, request.build_absolute_uri(URI_CALLBACK))
\ No newline at end of file
@@ -0,0 +1,414 @@
+import bisect
+import datetime
+import re
+
+import dateutil.parser
+
+MINUTES_PER_DAY = 24 * 60
+FULL_DAY_MASK = (1 << MINUTES_PER_DAY) - 1
+MICROSECONDS_PER_MINUTE = 60 * 1000 * 1000
+MICROSECONDS_PER_DAY = MINUTES_PER_DAY * MICROSECONDS_PER_MINUTE
+# event times are naive local times, counted from this wall clock epoch
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# Graph dateTime values e.g. 2018-02-12T09:00:00.0000000 (local time, zone given separately)
+graph_datetime_format = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?$')
+
+
+def minute_of_day(time):
+    '''
+    Minute offset of a time from midnight, rounded up when the time has seconds
+    so that a slot starting on the minute compares the same way as the time object
+    :param time: datetime.time object
+    :return: int e.g. datetime.time(9, 30) => 570
+    '''
+    minutes = time.hour * 60 + time.minute
+    return minutes + 1 if time.second or time.microsecond else minutes
+
+
+def time_from_minute(minute):
+    '''
+    :param minute: minute of day, values past 23:59 are capped
+    :return: datetime.time object e.g. 570 => datetime.time(9, 30)
+    '''
+    return datetime.time(*divmod(min(minute, MINUTES_PER_DAY - 1), 60))
+
+
+def to_microseconds(delta):
+    '''
+    :param delta: timedelta object
+    :return: int number of microseconds in delta
+    '''
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def to_epoch_microseconds(datetime_obj):
+    '''
+    :param datetime_obj: naive datetime object
+    :return: int microseconds since EPOCH
+    '''
+    return to_microseconds(datetime_obj - EPOCH)
+
+
+def parse_graph_datetime(value):
+    '''
+    Parse a Graph dateTime string, the fixed format Graph uses is read directly and anything else
+    is left to dateutil
+    :param value: e.g. '2018-02-12T09:00:00.0000000'
+    :return: datetime object
+    '''
+    match = graph_datetime_format.match(value)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        try:
+            return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                     int(fraction[:6].ljust(6, '0')) if fraction else 0)
+        except ValueError:  # out of range values e.g. hour 24 are for dateutil to judge
+            pass
+    return dateutil.parser.parse(value)
+
+
+class EventRecord(object):
+    '''
+    Compact outlook event, start and end held as microseconds since EPOCH so availability checks
+    compare integers, readable like the parsed event dicts e.g. event['start']
+    microseconds rather than minutes keep events such as 11:07:30 - 11:52 exact
+    '''
+    __slots__ = ('start_us', 'end_us', 'is_all_day')
+    fields = ('start', 'end', 'is_all_day')
+
+    def __init__(self, start_us, end_us, is_all_day=False):
+        '''
+        :param start_us: microseconds since EPOCH of the start
+        :param end_us: microseconds since EPOCH of the end
+        :param is_all_day: True if an all day event
+        '''
+        self.start_us = start_us
+        self.end_us = end_us
+        self.is_all_day = bool(is_all_day)
+
+    @classmethod
+    def from_datetimes(cls, start, end, is_all_day=False):
+        '''
+        :param start: naive datetime object
+        :param end: naive datetime object
+        :param is_all_day:
+        :return: EventRecord
+        '''
+        return cls(to_epoch_microseconds(start), to_epoch_microseconds(end), is_all_day)
+
+    @classmethod
+    def from_graph(cls, event):
+        '''
+        :param event: Graph event dict with start, end and isAllDay
+        :return: EventRecord
+        '''
+        return cls.from_datetimes(parse_graph_datetime(event['start']['dateTime']),
+                                  parse_graph_datetime(event['end']['dateTime']), event.get('isAllDay'))
+
+    @property
+    def start(self):
+        return EPOCH + datetime.timedelta(microseconds=self.start_us)
+
+    @property
+    def end(self):
+        return EPOCH + datetime.timedelta(microseconds=self.end_us)
+
+    @property
+    def start_date(self):
+        return datetime.date.fromordinal(EPOCH_ORDINAL + self.start_us // MICROSECONDS_PER_DAY)
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def keys(self):
+        return self.fields
+
+    def __eq__(self, other):
+        if isinstance(other, EventRecord):
+            return (self.start_us, self.end_us, self.is_all_day) == (other.start_us, other.end_us, other.is_all_day)
+        if isinstance(other, dict):
+            return dict(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.start_us, self.end_us, self.is_all_day))
+
+    def __repr__(self):
+        return 'EventRecord(start={}, end={}, is_all_day={})'.format(self.start, self.end, self.is_all_day)
+
+
+def as_event_record(event):
+    '''
+    :param event: EventRecord or parsed event dict {start, end, is_all_day}
+    :return: EventRecord
+    '''
+    if isinstance(event, EventRecord):
+        return event
+    return EventRecord.from_datetimes(event['start'], event['end'], event['is_all_day'])
+
+
+class AvailabilityBitmap(object):
+    '''
+    Blocked minutes for a run of consecutive days held in a single integer
+    bit n is minute n counted from midnight of the first day, a set bit means
+    a slot starting on that minute is unbookable
+    '''
+
+    def __init__(self, days):
+        '''
+        :param days: list of consecutive date objects
+        '''
+        self.days = days
+        self.origin = datetime.datetime.combine(days[0], datetime.time.min)
+        self.origin_us = to_epoch_microseconds(self.origin)
+        self.length = len(days) * MINUTES_PER_DAY
+        self.day_offsets = {day: index * MINUTES_PER_DAY for index, day in enumerate(days)}
+        self.blocked = 0
+
+    def block_range(self, start, end):
+        '''
+        Block every minute in [start, end), clipped to the bitmap
+        :param start: first minute blocked
+        :param end: minute after the last minute blocked
+        :return: Void
+        '''
+        start, end = max(start, 0), min(end, self.length)
+        if start < end:
+            self.blocked |= ((1 << (end - start)) - 1) << start
+
+    def block_minute(self, minute):
+        '''
+        :param minute: minute offset from the first day
+        :return: Void
+        '''
+        if 0 <= minute < self.length:
+            self.blocked |= 1 << minute
+
+    def block_day(self, day):
+        '''
+        Block the whole of a day if it is within the bitmap
+        :param day: date object
+        :return: Void
+        '''
+        offset = self.day_offsets.get(day)
+        if offset is not None:
+            self.block_range(offset, offset + MINUTES_PER_DAY)
+
+    def block_day_outside(self, offset, start, end):
+        '''
+        Block everything on a day apart from [start, end)
+        :param offset: minute offset of the day
+        :param start: minute of day availability starts
+        :param end: minute of day availability ends
+        :return: Void
+        '''
+        self.block_range(offset, offset + start)
+        self.block_range(offset + max(start, end), offset + MINUTES_PER_DAY)
+
+    def block_datetime_range(self, start, end, increment):
+        '''
+        Block slot starts clashing with an event, mirrors is_slot_within_outlook_event
+        a slot clashes if it starts within the event or its end (start + increment) falls within it
+        :param start: event start datetime
+        :param end: event end datetime
+        :param increment: availability increment in minutes
+        :return: Void
+        '''
+        self.block_event(to_epoch_microseconds(start), to_epoch_microseconds(end), increment)
+
+    def block_event(self, start_us, end_us, increment):
+        '''
+        Block slot starts clashing with an event given as microseconds since EPOCH
+        :param start_us: event start
+        :param end_us: event end
+        :param increment: availability increment in minutes
+        :return: Void
+        '''
+        start_us -= self.origin_us
+        end_us -= self.origin_us
+        increment_us = increment * MICROSECONDS_PER_MINUTE
+        # start <= slot < end
+        self.block_range(-(-start_us // MICROSECONDS_PER_MINUTE), -(-end_us // MICROSECONDS_PER_MINUTE))
+        # start < slot + increment <= end
+        self.block_range((start_us - increment_us) // MICROSECONDS_PER_MINUTE + 1,
+                         (end_us - increment_us) // MICROSECONDS_PER_MINUTE + 1)
+
+    def block_datetime(self, datetime_obj):
+        '''
+        Block a single slot start, only exact minutes can match a slot
+        :param datetime_obj: datetime object
+        :return: Void
+        '''
+        if datetime_obj.second or datetime_obj.microsecond:
+            return
+        self.block_minute(to_microseconds(datetime_obj - self.origin) // MICROSECONDS_PER_MINUTE)
+
+    def day_mask(self, day):
+        '''
+        :param day: date object within the bitmap
+        :return: int bitmap of blocked minutes for the day, bit 0 => midnight
+        '''
+        return (self.blocked >> self.day_offsets[day]) & FULL_DAY_MASK
+
+    def is_free(self, day, minute):
+        '''
+        :param day: date object within the bitmap
+        :param minute: minute of day
+        :return: True if a slot starting at minute is bookable else False
+        '''
+        return not (self.blocked >> (self.day_offsets[day] + minute)) & 1
+
+
+class EventIndex(object):
+    '''
+    Outlook events as EventRecords sorted by start for overlap queries by bisection,
+    built once per calendar fetch and shared by every availability check
+    '''
+
+    def __init__(self, events):
+        '''
+        :param events: iterable of EventRecords or parsed outlook events [{start, end, is_all_day}, ...]
+        '''
+        self.events = sorted((as_event_record(event) for event in events), key=lambda event: event.start_us)
+        self.starts = [event.start_us for event in self.events]
+        self.max_ends = []
+        self.all_day_dates = set()
+        self.events_by_day = {}
+        for event in self.events:
+            end = event.end_us
+            self.max_ends.append(max(self.max_ends[-1], end) if self.max_ends else end)
+            day = event.start_date
+            if event.is_all_day:
+                self.all_day_dates.add(day)
+            self.events_by_day.setdefault(day, []).append(event)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+    def events_on(self, day):
+        '''
+        :param day: date object
+        :return: list of EventRecords starting on day sorted by start
+        '''
+        return self.events_by_day.get(day, [])
+
+    def has_all_day_event(self, day):
+        '''
+        :param day: date object
+        :return: True if an all day event starts on day else False
+        '''
+        return day in self.all_day_dates
+
+    def contains(self, datetime_obj):
+        '''
+        :param datetime_obj: datetime object
+        :return: True if an event has start <= datetime_obj < end else False
+        '''
+        moment = to_epoch_microseconds(datetime_obj)
+        position = bisect.bisect_right(self.starts, moment)
+        return position > 0 and self.max_ends[position - 1] > moment
+
+    def ends_within(self, datetime_obj):
+        '''
+        :param datetime_obj: datetime object
+        :return: True if an event has start < datetime_obj <= end else False
+        '''
+        moment = to_epoch_microseconds(datetime_obj)
+        position = bisect.bisect_left(self.starts, moment)
+        return position > 0 and self.max_ends[position - 1] >= moment
+
+    def clashes_with_slot(self, datetime_obj, increment):
+        '''
+        Slot clashes if its day has an all day event, it starts within an event
+        or its end (start + increment) falls within an event
+        :param datetime_obj: slot start datetime
+        :param increment: availability increment in minutes
+        :return: True if slot is clashing with an event else False
+        '''
+        return self.has_all_day_event(datetime_obj.date()) or self.contains(datetime_obj) or \
+            self.ends_within(datetime_obj + datetime.timedelta(minutes=increment))
+
+
+def find_short_breaks(day_events, max_gap, max_total):
+    '''
+    Short breaks between a day's close set of events in one sweep, a break is the end of an event
+    followed by the next event within max_gap minutes
+    :param day_events: EventRecords starting on a single day
+    :param max_gap: longest gap in whole minutes counted as a short break e.g. 15
+    :param max_total: breaks are kept only if their gaps add up to at most this many minutes e.g. 20
+    :return: list of datetime objects of break slots, empty for days with fewer than 3 events
+    '''
+    if len(day_events) < 3:
+        return []
+    events = sorted(day_events, key=lambda event: event.start_us)
+    breaks = []
+    total = 0
+    previous = events[0]
+    for event in events[1:]:
+        gap = event.start_us - previous.end_us
+        # overlapping events give a negative gap and are never a break, partial minutes are dropped
+        minutes = gap // MICROSECONDS_PER_MINUTE if gap >= 0 else 0
+        if 0 < minutes <= max_gap:
+            breaks.append(previous.end)
+            total += minutes
+        previous = event
+    return breaks if total <= max_total else []
+
+
+def build_availability_bitmap(booking_availability, days, outlook_events, short_breaks=(), now=None):
+    '''
+    Build blocked minutes for days with range operations, applies the same
+    checks as BookingAvailability.slot_is_available
+    1)Short break slots
+    2)Past time on the current day
+    3)Mon-Sun booking availability
+    4)Lunch break
+    5)Outlook events
+    :param booking_availability: BookingAvailability instance
+    :param days: list of consecutive date objects
+    :param outlook_events: EventIndex or list of EventRecords or parsed outlook events [{start, end, is_all_day}, ...]
+    :param short_breaks: set of datetime objects of short break slots
+    :param now: current datetime, defaults to datetime.now()
+    :return: AvailabilityBitmap
+    '''
+    bitmap = AvailabilityBitmap(days)
+    week, lunch = booking_availability.get_weekly_template()
+    for day in days:
+        offset = bitmap.day_offsets[day]
+        day_range = week[day.weekday()]
+        if not day_range:
+            bitmap.block_day(day)
+            continue
+        bitmap.block_day_outside(offset, *day_range)
+        if lunch:
+            bitmap.block_range(offset + lunch[0], offset + lunch[1])
+
+    now = now or datetime.datetime.now()
+    if now.date() in bitmap.day_offsets:
+        elapsed = to_microseconds(now - datetime.datetime.combine(now.date(), datetime.time.min))
+        offset = bitmap.day_offsets[now.date()]
+        bitmap.block_range(offset, offset - (-elapsed // MICROSECONDS_PER_MINUTE))
+
+    for event in outlook_events or []:
+        event = as_event_record(event)
+        if event.is_all_day:
+            bitmap.block_day(event.start_date)
+        bitmap.block_event(event.start_us, event.end_us, booking_availability.availability_increment)
+
+    for slot in short_breaks:
+        bitmap.block_datetime(slot)
+    return bitmap
@@ -0,0 +1,214 @@
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+from django.test import RequestFactory
+
+from bookings.booking_grid import BookingGrid
+from bookings.models import BookingAvailability
+
+fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures', 'graph_calendarview_event.json')
+
+DEFAULT_EVENT_COUNTS = (0, 100, 1000, 10000)
+DEFAULT_INCREMENTS = tuple(increment for increment, label in BookingAvailability.AVAILABILITY_INCREMENTS)
+DEFAULT_WEEKS = (1, 2, 4, 8)
+
+
+def make_calendar(start_date, days, event_count, seed=0):
+    '''
+    Synthetic calendarView response built from the Graph event fixture, events fall in working hours
+    with about one in twenty all day
+    :param start_date: date object of the first day
+    :param days: number of days the events are spread over
+    :param event_count: number of events
+    :param seed: random seed so runs compare like with like
+    :return: dictionary decoded from JSON like a Graph response, value key maps to list of events
+    '''
+    with open(fixture_path) as fixture:
+        template = json.load(fixture)
+    generator = random.Random(seed)
+    events = []
+    for number in range(event_count):
+        event = copy.deepcopy(template)
+        day = start_date + datetime.timedelta(days=generator.randrange(days))
+        if generator.random() < 0.05:
+            start = datetime.datetime.combine(day, datetime.time.min)
+            end = start + datetime.timedelta(days=1)
+            event['isAllDay'] = True
+        else:
+            start = datetime.datetime.combine(day, datetime.time(7, 0)) + \
+                    datetime.timedelta(minutes=generator.randrange(0, 11 * 60, 5))
+            end = start + datetime.timedelta(minutes=generator.choice([15, 30, 45, 60, 90, 120]))
+        event['id'] = 'event-{}'.format(number)
+        event['start']['dateTime'] = start.strftime('%Y-%m-%dT%H:%M:%S.0000000')
+        event['end']['dateTime'] = end.strftime('%Y-%m-%dT%H:%M:%S.0000000')
+        events.append(event)
+    events.sort(key=lambda event: event['start']['dateTime'])
+    # round trip through JSON so every run decodes a response the way the Graph client does
+    return json.loads(json.dumps({'value': events}))
+
+
+def make_preferences(increment, **kwargs):
+    '''
+    Unsaved weekday 8:00-18:00 preferences with a lunch break
+    :param increment: availability increment in minutes
+    :param kwargs: further BookingAvailability fields e.g. account_social
+    :return: BookingAvailability
+    '''
+    booking_availability = BookingAvailability(lunch_from=datetime.time(12, 0), lunch_to=datetime.time(13, 0),
+                                               availability_increment=increment, booking_duration=increment * 4,
+                                               **kwargs)
+    for weekday in BookingAvailability.WEEKDAYS[:5]:
+        setattr(booking_availability, '{}_from'.format(weekday), datetime.time(8, 0))
+        setattr(booking_availability, '{}_to'.format(weekday), datetime.time(18, 0))
+    return booking_availability
+
+
+def make_booking_availability(increment, calendar):
+    '''
+    Preferences from make_preferences() whose calendar reads return calendar
+    :param increment: availability increment in minutes
+    :param calendar: calendarView response e.g. make_calendar()
+    :return: BookingAvailability
+    '''
+    booking_availability = make_preferences(increment)
+    booking_availability.get_outlook_events = lambda dates: calendar
+    booking_availability.get_pending_events = lambda dates: []
+    return booking_availability
+
+
+def get_percentile(samples, percentile):
+    '''
+    :param samples: sorted list of numbers
+    :param percentile: e.g. 95
+    :return: nearest rank percentile of samples
+    '''
+    return samples[max(int(round(percentile / 100.0 * len(samples))) - 1, 0)]
+
+
+def measure(function, repeat):
+    '''
+    Time function repeat times then run it once more under tracemalloc
+    :param function: callable without arguments
+    :param repeat: number of timed runs
+    :return: dict of latency percentiles in milliseconds, peak traced memory in KiB and blocks allocated
+    '''
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        function()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    allocated = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return {'p50': round(get_percentile(samples, 50), 3), 'p95': round(get_percentile(samples, 95), 3),
+            'p99': round(get_percentile(samples, 99), 3), 'mean': round(sum(samples) / len(samples), 3),
+            'peak_kib': round(peak / 1024.0, 1), 'allocated_blocks': allocated}
+
+
+def get_time_slot_data_case(booking_availability, start_date, weeks):
+    '''
+    Grid data for each week of the horizon from one parse of the calendar
+    '''
+    def run():
+        days = [start_date, start_date + datetime.timedelta(days=weeks * 7 + 1)]
+        event_index = booking_availability.get_event_index(days)
+        for week in range(weeks):
+            booking_availability.get_time_slot_data(start_date + datetime.timedelta(days=week * 7),
+                                                    event_index=event_index)
+    return run
+
+
+def get_duration_choices_case(booking_availability, start_date):
+    '''
+    Duration choices of the booking form for the first slot of the first weekday
+    '''
+    from bookings.forms import EventBookingForm  # forms and views import each other, views must load first
+    slot = datetime.datetime.combine(start_date + datetime.timedelta(days=(7 - start_date.weekday()) % 7),
+                                     datetime.time(8, 0))
+
+    def run():
+        EventBookingForm(date=slot, booking_availability=booking_availability)
+    return run
+
+
+def render_booking_grid_case(booking_availability, start_date, weeks):
+    '''
+    BookingGrid HTML for each week of the horizon, grid data computed beforehand
+    '''
+    request = RequestFactory().get('/bookings/')
+    days = [start_date, start_date + datetime.timedelta(days=weeks * 7 + 1)]
+    event_index = booking_availability.get_event_index(days)
+    week_starts = [start_date + datetime.timedelta(days=week * 7) for week in range(weeks)]
+    weeks_data = [(booking_availability.get_time_slot_data(week_start, event_index=event_index),
+                   BookingAvailability.get_next_7_days(week_start, format=True)) for week_start in week_starts]
+
+    def run():
+        for table_data, day_labels in weeks_data:
+            BookingGrid(table_data, days=day_labels, pk=1).as_html(request)
+    return run
+
+
+def run_benchmarks(event_counts=DEFAULT_EVENT_COUNTS, increments=DEFAULT_INCREMENTS, weeks_options=DEFAULT_WEEKS,
+                   repeat=5, start_date=None, progress=None):
+    '''
+    Time grid data, booking form durations and grid rendering over synthetic calendars
+    :param event_counts: calendar sizes, events are spread over the longest horizon
+    :param increments: availability increments in minutes
+    :param weeks_options: horizons in weeks
+    :param repeat: timed runs per case
+    :param start_date: first day, defaults to the next Monday so results do not depend on the time of day
+    :param progress: callable given each case name and its measurements as it finishes
+    :return: dict {'meta': {...}, 'results': {case name: measurements see measure()}}
+    '''
+    today = datetime.date.today()
+    start_date = start_date or today + datetime.timedelta(days=7 - today.weekday())
+    days = max(weeks_options) * 7
+    results = {}
+    for event_count in event_counts:
+        calendar = make_calendar(start_date, days, event_count)
+        for increment in increments:
+            booking_availability = make_booking_availability(increment, calendar)
+            cases = [('duration_choices', get_duration_choices_case(booking_availability, start_date))]
+            for weeks in weeks_options:
+                cases.append(('time_slot_data:{}w'.format(weeks),
+                              get_time_slot_data_case(booking_availability, start_date, weeks)))
+                cases.append(('grid_render:{}w'.format(weeks),
+                              render_booking_grid_case(booking_availability, start_date, weeks)))
+            for name, case in cases:
+                key = '{}:{}ev:{}min'.format(name, event_count, increment)
+                results[key] = measure(case, repeat)
+                if progress:
+                    progress(key, results[key])
+    return {'meta': {'python': platform.python_version(), 'repeat': repeat, 'start_date': start_date.isoformat(),
+                     'created': datetime.datetime.now().isoformat()},
+            'results': results}
+
+
+def compare_with_baseline(results, baseline, tolerance=0.2, metric='p50'):
+    '''
+    Cases whose metric got slower than the baseline by more than tolerance
+    :param results: run_benchmarks() output
+    :param baseline: earlier run_benchmarks() output
+    :param tolerance: allowed fractional slow down e.g. 0.2 => 20%
+    :param metric: measurement compared e.g. p50, p95
+    :return: list of tuples (case name, baseline value, current value) sorted by case name
+    '''
+    regressions = []
+    for key, measurements in sorted(results['results'].items()):
+        previous = baseline.get('results', {}).get(key)
+        if previous and measurements[metric] > previous[metric] * (1 + tolerance):
+            regressions.append((key, previous[metric], measurements[metric]))
+    return regressions
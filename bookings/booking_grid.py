@@ -1,5 +1,13 @@
+import hashlib
+
 import django_tables2 as tables
-from django_tables2 import A, columns
+from django.conf import settings
+from django.core.cache import cache
+from django_tables2 import A, RequestConfig, columns
+
+from bookings.graphmetrics import format_family
+from bookings.models import BookingAvailability
+from bookings.timing import timer
 
 class BookingGrid(tables.Table):
     '''
@@ -44,4 +52,83 @@ class BookingGrid(tables.Table):
         self.base_columns['current_day_plus_6'] = tables.LinkColumn(accessor=self.days[6], verbose_name=self.days[6],
                                                                     viewname=self.viewname,
                                                                     args=[A(self.days[6]), self.days[6], self.pk, self.event_pk])
-        self.columns = columns.BoundColumns(self, self.base_columns)
\ No newline at end of file
+        self.columns = columns.BoundColumns(self, self.base_columns)
+
+
+def record_grid_cache_lookup(hit):
+    '''
+    Count a booking grid cache hit or miss
+    :param hit: True if the grid was served from cache
+    :return: Void
+    '''
+    key = 'booking_grid_cache:hits' if hit else 'booking_grid_cache:misses'
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:  # evicted between add and incr
+            cache.set(key, 1, None)
+
+
+def get_grid_cache_stats():
+    '''
+    :return: dict of booking grid cache hit and miss counts e.g. {'hits': 10, 'misses': 2}
+    '''
+    return {'hits': cache.get('booking_grid_cache:hits', 0), 'misses': cache.get('booking_grid_cache:misses', 0)}
+
+
+def grid_cache_as_prometheus():
+    '''
+    Booking grid cache hit and miss counts, kept in the shared cache so they cover every process using it
+    :return: string in the Prometheus text exposition format
+    '''
+    stats = get_grid_cache_stats()
+    lines = format_family('booking_grid_cache_hits_total', 'counter', 'Booking grids served from the cache',
+                          [('', [], stats['hits'])])
+    lines += format_family('booking_grid_cache_misses_total', 'counter', 'Booking grids rendered and cached',
+                           [('', [], stats['misses'])])
+    return '\n'.join(lines) + '\n'
+
+
+def render_booking_grid(request, booking_availability, start_date, pk, event_pk=0, event_index=None):
+    '''
+    Render the booking grid HTML for the week from start_date
+    :param request: request the table is configured from e.g. ?sort=
+    :param booking_availability: BookingAvailability of the host
+    :param start_date: date object of the first day
+    :param pk: user pk/id
+    :param event_pk: event pk/id of a booking being rescheduled, 0 for new bookings
+    :param event_index: EventIndex covering the week, fetched if not given
+    :return: HTML string
+    '''
+    table_data = booking_availability.get_time_slot_data(start_date=start_date, event_index=event_index)
+    days = BookingAvailability.get_next_7_days(start_date, format=True)
+    if event_pk:
+        table = BookingGrid(table_data, days=days, pk=pk, viewname='bookings:update_meeting_slot', event_pk=event_pk)
+    else:
+        table = BookingGrid(table_data, days=days, pk=pk)
+    # using RequestConfig automatically pulls values from request.GET and updates the table accordingly
+    with timer('render'):
+        RequestConfig(request, paginate=False).configure(table)
+        return table.as_html(request)
+
+
+def get_booking_grid_html(request, booking_availability, start_date, pk, event_pk=0):
+    '''
+    Rendered booking grid through Django's cache for BOOKING_GRID_CACHE_TIMEOUT seconds, keyed by account,
+    week, preferences version and calendar version so saving preferences or booking, updating or
+    cancelling an event renders it again
+    :param request: request the table is configured from e.g. ?sort=
+    :param booking_availability: BookingAvailability of the host
+    :param start_date: date object of the first day
+    :param pk: user pk/id
+    :param event_pk: event pk/id of a booking being rescheduled, 0 for new bookings
+    :return: HTML string
+    '''
+    query = hashlib.md5(request.GET.urlencode().encode('utf-8')).hexdigest()
+    key = booking_availability.get_availability_cache_key('booking_grid', start_date, pk, event_pk, query)
+    html = cache.get(key)
+    record_grid_cache_lookup(html is not None)
+    if html is None:
+        html = render_booking_grid(request, booking_availability, start_date, pk, event_pk)
+        cache.set(key, html, settings.BOOKING_GRID_CACHE_TIMEOUT)
+    return html
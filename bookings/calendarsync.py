@@ -0,0 +1,71 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from bookings.availability import parse_graph_datetime
+from bookings.models import CalendarEventMirror, CalendarSyncState
+from bookings.outlookservice import get_calendar_view_delta
+
+
+def get_sync_window(window_days=None):
+    '''
+    Window of the calendar mirrored, midnight today for OUTLOOK_MIRROR_WINDOW_DAYS days
+    :param window_days: number of days to override setting
+    :return: tuple of aware datetime objects (start, end)
+    '''
+    start = timezone.make_aware(datetime.datetime.combine(timezone.localdate(), datetime.time.min))
+    return start, start + datetime.timedelta(days=window_days or settings.OUTLOOK_MIRROR_WINDOW_DAYS)
+
+
+def apply_calendar_changes(social_account, changes):
+    '''
+    Apply events from a calendarView delta response to the mirror
+    :param social_account:
+    :param changes: list of event dicts, removed events have an '@removed' key
+    :return: Void
+    '''
+    for change in changes:
+        if '@removed' in change:
+            CalendarEventMirror.objects.filter(social_account=social_account, outlook_id=change['id']).delete()
+            continue
+        CalendarEventMirror.objects.update_or_create(
+            social_account=social_account, outlook_id=change['id'],
+            defaults={'start_time': timezone.make_aware(parse_graph_datetime(change['start']['dateTime'])),
+                      'end_time': timezone.make_aware(parse_graph_datetime(change['end']['dateTime'])),
+                      'is_all_day': bool(change.get('isAllDay'))})
+
+
+def sync_calendar_mirror(social_account, access_token, window_days=None):
+    '''
+    Bring an account's calendar mirror up to date with Graph calendarView delta queries
+    the mirror is rebuilt for a new window each day, otherwise only changes since the last delta link are fetched
+    :param social_account:
+    :param access_token:
+    :param window_days: number of days to mirror, defaults to OUTLOOK_MIRROR_WINDOW_DAYS
+    :return: True if synced else False (delta link is reset so next sync starts again)
+    '''
+    user_email = social_account.user.email
+    # write version read before fetching so a write through the app during the sync leaves the mirror stale
+    state = CalendarSyncState.objects.get_or_create(social_account=social_account)[0]
+    start, end = get_sync_window(window_days)
+    full_sync = not state.delta_link or state.window_start != start or state.window_end != end
+    response = get_calendar_view_delta(access_token, user_email, start_date=start.isoformat(),
+                                       end_date=end.isoformat(), delta_link=None if full_sync else state.delta_link)
+    if not isinstance(response, tuple):
+        state.delta_link = ''
+        state.save(update_fields=['delta_link'])
+        return False
+    changes, delta_link = response
+    with transaction.atomic():
+        if full_sync:
+            CalendarEventMirror.objects.filter(social_account=social_account).delete()
+        apply_calendar_changes(social_account, changes)
+        state.delta_link = delta_link or ''
+        state.window_start, state.window_end = start, end
+        state.calendar_version = state.write_version
+        state.synced_at = timezone.now()
+        # write_version is left out so writes counted since it was read are kept
+        state.save(update_fields=['delta_link', 'window_start', 'window_end', 'calendar_version', 'synced_at'])
+    return True
@@ -0,0 +1,394 @@
+import collections
+import copy
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import pytz
+from requests.structures import CaseInsensitiveDict
+
+from bookings.availability import parse_graph_datetime
+
+# Graph dateTime format returned for event start and end
+graph_datetime_output = '%Y-%m-%dT%H:%M:%S.0000000'
+
+prefer_timezone = re.compile(r'outlook\.timezone="([^"]+)"')
+
+
+def to_utc(value, zone):
+    '''
+    :param value: Graph or ISO dateTime string, with or without an offset
+    :param zone: pytz timezone naive values are in
+    :return: aware datetime in UTC
+    '''
+    datetime_obj = parse_graph_datetime(value)
+    if datetime_obj.tzinfo is None:
+        datetime_obj = zone.localize(datetime_obj)
+    return datetime_obj.astimezone(pytz.utc)
+
+
+def parse_event_time(value, zone):
+    '''
+    :param value: Graph dateTimeTimeZone dict e.g. {'dateTime': '2018-02-12T09:00:00', 'timeZone': 'UTC'}
+    :param zone: pytz timezone used when the dict names none or one pytz does not know
+    :return: aware datetime in UTC
+    '''
+    try:
+        zone = pytz.timezone(value.get('timeZone') or zone.zone)
+    except pytz.UnknownTimeZoneError:
+        pass
+    return to_utc(value['dateTime'], zone)
+
+
+class FakeGraphStore(object):
+    '''
+    In memory calendars keyed by mailbox, times held in UTC and shown in the zone each request prefers
+    every change takes the next sequence number so calendar view deltas can be answered
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = collections.defaultdict(dict)
+        self.removed = collections.defaultdict(dict)
+        self.sequence = 0
+
+    def save_event(self, mailbox, event):
+        '''
+        :param mailbox: email address
+        :param event: stored event dict, start and end as aware UTC datetimes
+        :return: Void
+        '''
+        self.sequence += 1
+        event['_sequence'] = self.sequence
+        self.events[mailbox][event['id']] = event
+        self.removed[mailbox].pop(event['id'], None)
+
+    def create_event(self, mailbox, payload, zone=pytz.utc):
+        '''
+        :param mailbox: email address
+        :param payload: Graph event dict e.g. book_event() payload or a calendarView event
+        :param zone: pytz timezone of dateTimes without an offset
+        :return: stored event dict
+        '''
+        event = copy.deepcopy(payload)
+        event['id'] = event.get('id') or str(uuid.uuid4())
+        event['isAllDay'] = bool(event.get('isAllDay'))
+        for field in ('start', 'end'):
+            event[field] = parse_event_time(payload[field], zone)
+        with self.lock:
+            self.save_event(mailbox, event)
+        return event
+
+    def add_calendar(self, mailbox, calendar, zone=pytz.utc):
+        '''
+        Seed a mailbox e.g. with benchmarks.make_calendar()
+        :param mailbox: email address
+        :param calendar: calendarView response dict with a value list
+        :param zone: pytz timezone of dateTimes without an offset
+        :return: Void
+        '''
+        for event in calendar['value']:
+            self.create_event(mailbox, event, zone)
+
+    def update_event(self, mailbox, event_id, payload, zone=pytz.utc):
+        '''
+        :return: stored event dict or None if there is no such event
+        '''
+        with self.lock:
+            event = self.events[mailbox].get(event_id)
+            if event is None:
+                return None
+            event = copy.deepcopy(event)
+            for field, value in payload.items():
+                if field in ('start', 'end'):
+                    value = parse_event_time(value, zone)
+                event[field] = value
+            self.save_event(mailbox, event)
+        return event
+
+    def delete_event(self, mailbox, event_id):
+        '''
+        :return: True if the event existed else False
+        '''
+        with self.lock:
+            if self.events[mailbox].pop(event_id, None) is None:
+                return False
+            self.sequence += 1
+            self.removed[mailbox][event_id] = self.sequence
+        return True
+
+    def get_events(self, mailbox, start=None, end=None):
+        '''
+        :param mailbox: email address
+        :param start: aware datetime, events ending after it are included
+        :param end: aware datetime, events starting before it are included
+        :return: list of stored event dicts sorted by start
+        '''
+        with self.lock:
+            events = list(self.events[mailbox].values())
+        if start is not None:
+            events = [event for event in events if event['end'] > start and event['start'] < end]
+        return sorted(events, key=lambda event: (event['start'], event['id']))
+
+    def get_changes(self, mailbox, start, end, since):
+        '''
+        :param since: sequence number of the previous delta link, 0 for a new sync
+        :return: tuple (events changed in the window, ids removed, current sequence number)
+        '''
+        with self.lock:
+            sequence = self.sequence
+            removed = [event_id for event_id, removed_at in self.removed[mailbox].items() if removed_at > since]
+        events = [event for event in self.get_events(mailbox, start, end) if event['_sequence'] > since]
+        return events, removed if since else [], sequence
+
+
+def render_event(event, zone, select=None):
+    '''
+    :param event: stored event dict
+    :param zone: pytz timezone start and end are shown in
+    :param select: list of fields to return besides id, None for all
+    :return: Graph event dict
+    '''
+    rendered = {'id': event['id']}
+    for field, value in event.items():
+        if field.startswith('_') or (select is not None and field not in select):
+            continue
+        if field in ('start', 'end'):
+            value = {'dateTime': value.astimezone(zone).strftime(graph_datetime_output), 'timeZone': zone.zone}
+        rendered[field] = value
+    return rendered
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the Graph and token endpoints the app uses from the server's store
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def do_PATCH(self):
+        self.respond()
+
+    def do_DELETE(self):
+        self.respond()
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        status, headers, content = self.server.dispatch(self.command, url.path, dict(parse_qsl(url.query)),
+                                                        CaseInsensitiveDict(self.headers.items()), body,
+                                                        'http://{}'.format(self.headers['Host']))
+        data = json.dumps(content).encode('utf-8') if content is not None else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if content is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeGraphServer(ThreadingMixIn, HTTPServer):
+    '''
+    Local stand in for Microsoft Graph, the OAuth token endpoint and reCAPTCHA verification so the full stack
+    runs offline
+    e.g.
+    server = FakeGraphServer(('localhost', 8001), latency=0.05, throttle_rate=0.01)
+    server.start()
+    settings GRAPH_BASE_URL = server.graph_base_url, OUTLOOK_AUTHORITY = server.base_url and
+    GOOGLE_RECAPTCHA_VERIFY_URL = server.recaptcha_verify_url
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, store=None, latency=0, error_rate=0, throttle_rate=0, retry_after=1, seed=None,
+                 verbose=False):
+        '''
+        :param address: tuple (host, port), port 0 picks a free port
+        :param store: FakeGraphStore, a new empty one by default
+        :param latency: seconds added to every response
+        :param error_rate: fraction of Graph requests answered 503
+        :param throttle_rate: fraction of Graph requests answered 429 with a Retry-After header
+        :param retry_after: seconds sent in Retry-After
+        :param seed: random seed for the injected failures
+        :param verbose: log each request to stderr
+        '''
+        HTTPServer.__init__(self, address, FakeGraphHandler)
+        self.store = store or FakeGraphStore()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.verbose = verbose
+        self.request_counts = collections.Counter()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    @property
+    def graph_base_url(self):
+        return '{}/v1.0'.format(self.base_url)
+
+    @property
+    def recaptcha_verify_url(self):
+        return '{}/recaptcha/api/siteverify'.format(self.base_url)
+
+    def start(self):
+        '''
+        Serve on a daemon thread
+        :return: self
+        '''
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def get_fault(self):
+        '''
+        :return: tuple (status, headers, body) of an injected failure or None
+        '''
+        with self.random_lock:
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return 429, {'Retry-After': str(self.retry_after)}, \
+                {'error': {'code': 'TooManyRequests', 'message': 'Please retry after {} seconds.'.format(
+                    self.retry_after)}}
+        if roll < self.throttle_rate + self.error_rate:
+            return 503, {}, {'error': {'code': 'ServiceNotAvailable', 'message': 'Injected failure.'}}
+        return None
+
+    def dispatch(self, method, path, query, headers, body, base_url):
+        '''
+        :param method: HTTP method e.g GET,POST
+        :param path: url path e.g. /v1.0/me/events
+        :param query: dict of query parameters
+        :param headers: CaseInsensitiveDict of request headers
+        :param body: request body bytes
+        :param base_url: scheme and host next links are built on
+        :return: tuple (status, response headers dict, JSON body or None)
+        '''
+        if path.endswith('/oauth2/v2.0/token') and method == 'POST':
+            self.request_counts['POST token'] += 1
+            return 200, {}, {'token_type': 'Bearer', 'expires_in': 3600, 'scope': 'Calendars.ReadWrite',
+                             'access_token': 'fake-access-{}'.format(uuid.uuid4().hex),
+                             'refresh_token': 'fake-refresh-{}'.format(uuid.uuid4().hex)}
+        if path == '/recaptcha/api/siteverify' and method == 'POST':
+            self.request_counts['POST siteverify'] += 1
+            return 200, {}, {'success': True, 'hostname': 'localhost'}
+        if not path.startswith('/v1.0/'):
+            return 404, {}, {'error': {'code': 'NotFound', 'message': path}}
+        path = path[len('/v1.0'):]
+        route = re.sub(r'^/me/events/[^/]+$', '/me/events/{id}', path)
+        self.request_counts['{} {}'.format(method, route)] += 1
+        if not (headers.get('Authorization') or '').startswith('Bearer '):
+            return 401, {}, {'error': {'code': 'InvalidAuthenticationToken', 'message': 'Access token is empty.'}}
+        fault = self.get_fault()
+        if fault:
+            return fault
+        mailbox = headers.get('X-AnchorMailbox') or 'me'
+        zone_match = prefer_timezone.search(headers.get('Prefer') or '')
+        zone = pytz.timezone(zone_match.group(1)) if zone_match else pytz.utc
+        try:
+            payload = json.loads(body.decode('utf-8')) if body else None
+        except ValueError:
+            return 400, {}, {'error': {'code': 'BadRequest', 'message': 'Unable to read JSON request payload.'}}
+        select = query['$select'].split(',') if '$select' in query else None
+
+        if route == '/$batch' and method == 'POST':
+            return 200, {}, {'responses': self.run_batch(payload.get('requests', []), headers, base_url)}
+        if route == '/me/events' and method == 'GET':
+            events = self.store.get_events(mailbox)[:int(query.get('$top', 10))]
+            return 200, {}, {'value': [render_event(event, zone, select) for event in events]}
+        if route == '/me/events' and method == 'POST':
+            return 201, {}, render_event(self.store.create_event(mailbox, payload, zone), zone)
+        if route == '/me/events/{id}':
+            event_id = path.rsplit('/', 1)[1]
+            if method == 'PATCH':
+                event = self.store.update_event(mailbox, event_id, payload, zone)
+                if event:
+                    return 200, {}, render_event(event, zone)
+            elif method == 'DELETE' and self.store.delete_event(mailbox, event_id):
+                return 204, {}, None
+            return 404, {}, {'error': {'code': 'ErrorItemNotFound', 'message': 'The specified object was not found.'}}
+        if route == '/me/calendarview' and method == 'GET':
+            return self.get_calendar_view(mailbox, zone, query, select, base_url)
+        if route == '/me/calendarview/delta' and method == 'GET':
+            return self.get_calendar_view_delta(mailbox, zone, query, base_url)
+        return 404, {}, {'error': {'code': 'NotFound', 'message': '{} {}'.format(method, path)}}
+
+    def get_calendar_view(self, mailbox, zone, query, select, base_url):
+        if 'startdatetime' not in query or 'enddatetime' not in query:
+            return 400, {}, {'error': {'code': 'ErrorInvalidParameter',
+                                       'message': 'This request requires a time window specified by the query '
+                                                  'string parameters StartDateTime and EndDateTime.'}}
+        events = self.store.get_events(mailbox, to_utc(query['startdatetime'], zone),
+                                       to_utc(query['enddatetime'], zone))
+        top, skip = int(query.get('$top', 10)), int(query.get('$skip', 0))
+        page = {'value': [render_event(event, zone, select) for event in events[skip:skip + top]]}
+        if skip + top < len(events):
+            page['@odata.nextLink'] = '{}/v1.0/me/calendarview?{}'.format(
+                base_url, urlencode(dict(query, **{'$skip': skip + top})))
+        return 200, {}, page
+
+    def get_calendar_view_delta(self, mailbox, zone, query, base_url):
+        if 'startdatetime' not in query or 'enddatetime' not in query:
+            return 400, {}, {'error': {'code': 'ErrorInvalidParameter', 'message': 'Missing time window.'}}
+        events, removed, sequence = self.store.get_changes(mailbox, to_utc(query['startdatetime'], zone),
+                                                           to_utc(query['enddatetime'], zone),
+                                                           int(query.get('$deltatoken', 0)))
+        value = [render_event(event, zone) for event in events]
+        value.extend({'id': event_id, '@removed': {'reason': 'deleted'}} for event_id in removed)
+        delta_query = {'startdatetime': query['startdatetime'], 'enddatetime': query['enddatetime'],
+                       '$deltatoken': sequence}
+        return 200, {}, {'value': value,
+                         '@odata.deltaLink': '{}/v1.0/me/calendarview/delta?{}'.format(base_url,
+                                                                                      urlencode(delta_query))}
+
+    def run_batch(self, batch_requests, headers, base_url):
+        '''
+        Answer each request of a JSON batch in order, requests whose dependency failed get 424
+        :return: list of response dicts
+        '''
+        responses = []
+        succeeded = set()
+        for request in batch_requests:
+            if any(request_id not in succeeded for request_id in request.get('dependsOn', [])):
+                responses.append({'id': request['id'], 'status': 424, 'headers': {},
+                                  'body': {'error': {'code': 'FailedDependency', 'message': 'Dependency failed.'}}})
+                continue
+            url = urlsplit(request['url'])
+            request_headers = CaseInsensitiveDict(headers)
+            request_headers.update(request.get('headers', {}))
+            body = json.dumps(request['body']).encode('utf-8') if 'body' in request else b''
+            status, response_headers, content = self.dispatch(
+                request['method'], '/v1.0{}'.format(url.path), dict(parse_qsl(url.query)),
+                request_headers, body, base_url)
+            if 200 <= status < 300:
+                succeeded.add(request['id'])
+            responses.append({'id': request['id'], 'status': status, 'headers': response_headers, 'body': content})
+        return responses
@@ -1,4 +1,3 @@
-import datetime
 from django import forms
 from bookings import views
 from bookings.models import BookingAvailability, Event
@@ -81,6 +80,7 @@ class EventBookingForm(forms.ModelForm):
         self.existing_event = kwargs.pop('event', None)
         self.booking_date = kwargs.pop('date')
         self.booking_availability = kwargs.pop('booking_availability')
+        self.event_index = kwargs.pop('event_index', None)
         super(EventBookingForm, self).__init__(*args, **kwargs)
         choices = self.get_duration_choices()
         self.fields['duration'] = forms.TypedChoiceField(choices=choices)
@@ -90,46 +90,31 @@ class EventBookingForm(forms.ModelForm):
     def get_duration_choices(self):
         '''
         Get choices for duration according to availability on Booking widget
+        only the booking day's outlook events are fetched unless an EventIndex was passed to the form
         :return: list of duration choices
         '''
         default_choices = self.booking_availability.get_range_of_durations()
-        time_slots = self.booking_availability.get_time_slot_data(start_date=self.booking_date.date(), format=False)
-        free_slots = [slot.get(self.booking_date.date()) for slot in time_slots if self.booking_date.date() in slot]
+        if self.event_index is None:
+            self.event_index = self.booking_availability.get_day_event_index(self.booking_date.date())
         event_start = self.existing_event.start_time.astimezone().replace(tzinfo=None) if self.existing_event else None
         event_end = self.existing_event.end_time.astimezone().replace(tzinfo=None) if self.existing_event else None
-        choices = self.get_choices_within_event_range(default_choices, free_slots, event_start, event_end)
+        choices = self.get_choices_within_event_range(default_choices, event_start, event_end)
         return choices
 
-    def get_choices_within_event_range(self, default_choices, free_slots, event_start=None, event_end=None):
+    def get_choices_within_event_range(self, default_choices, event_start=None, event_end=None):
         '''
-        Get duration choices according to booking widget and whether event is being updated
+        Get duration choices that fit the longest free run from the booking date,
+        an event being updated does not clash with its own current time
         :param default_choices: list of durations e.g availability incr of 15 = [15,30,45,60]
-        :param free_slots: list of datetime objects that are available for booking
         :param event_start: existing event start datetime
         :param event_end: existing event end datetime
-        :return: List of choices that have been tuplified
+        :return: List of choices that have been tuplified, empty if the slot has been booked recently
         e.g. if 15,30 only possible return is [(15,15),(30,30)]/
         format necessary for choice field
         '''
-        possible_choices = []
-        event_not_clashed = True
-        override_existing_event = False
-        for choice in default_choices:
-            if event_start and not override_existing_event and event_start.date() == self.booking_date.date():
-                if event_start <= self.booking_date + datetime.timedelta(minutes=choice) <= event_end:
-                    possible_choices.append(choice)
-                    continue
-                elif self.booking_date + datetime.timedelta(minutes=choice) > event_end and possible_choices:
-                    override_existing_event = True
-            if (self.booking_date + datetime.timedelta(minutes=choice)).time() in free_slots and \
-                    event_not_clashed: #or not override_existing_event if event_start else True:
-                possible_choices.append(choice)
-            elif event_not_clashed and not override_existing_event:
-                possible_choices.append(choice)
-                event_not_clashed = False
-            else:
-                break
-        return self.tuplify_choices(possible_choices)
+        moved_event = (event_start, event_end) if event_start else None
+        longest_run = self.booking_availability.get_longest_free_run(self.booking_date, self.event_index, moved_event)
+        return self.tuplify_choices([choice for choice in default_choices if choice <= longest_run])
 
     def tuplify_choices(self, durations):
         '''
@@ -0,0 +1,129 @@
+import bisect
+import collections
+import re
+import threading
+from urllib.parse import urlsplit
+
+# upper bounds in seconds of the Graph latency histogram buckets, +Inf is implied
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# path segments that identify a single item, collapsed so each endpoint is one label value
+item_path = re.compile(r'/(events|messages|users|calendars)/[^/]+')
+
+
+def get_endpoint_label(url):
+    '''
+    :param url: Graph url, absolute or relative to the API version, with or without a query string
+    :return: endpoint label e.g. https://graph.microsoft.com/v1.0/me/events/AAMk=?$top=1 => /me/events/{id}
+    '''
+    path = urlsplit(url).path
+    if path.startswith('/v1.0/') or path.startswith('/beta/'):
+        path = path[path.index('/', 1):]
+    return item_path.sub(lambda match: '/{}/{{id}}'.format(match.group(1)), path) or '/'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_family(name, kind, description, samples):
+    '''
+    :param name: metric name e.g. graph_responses_total
+    :param kind: counter, gauge or histogram
+    :param description: HELP text
+    :param samples: list of tuples (name suffix, list of (label, value) pairs, value)
+    :return: list of lines of the metric family in the Prometheus text exposition format
+    '''
+    lines = ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, kind)]
+    for suffix, labels, value in samples:
+        label_text = ','.join('{}="{}"'.format(label, escape_label(label_value)) for label, label_value in labels)
+        lines.append('{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if label_text else '', value))
+    return lines
+
+
+class GraphMetrics(object):
+    '''
+    Counters and latency histograms of this process's Graph calls, rendered in the Prometheus text format
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget everything recorded
+        :return: Void
+        '''
+        with self.lock:
+            # endpoint => [count per bucket..., count over the last bucket]
+            self.latency_counts = collections.defaultdict(lambda: [0] * (len(latency_buckets) + 1))
+            self.latency_sums = collections.Counter()
+            self.responses = collections.Counter()
+            self.retries = collections.Counter()
+            self.bytes_received = collections.Counter()
+            self.mailbox_calls = collections.Counter()
+            self.throttle_seconds = collections.Counter()
+
+    def observe(self, method, endpoint, status, seconds, received=0, retries=0, mailbox=None, retry_after=None):
+        '''
+        Record one Graph call
+        :param method: HTTP method e.g GET,POST
+        :param endpoint: label from get_endpoint_label()
+        :param status: response status code, or 'error' if no response came back
+        :param seconds: time the call took, retries included
+        :param received: response body size in bytes
+        :param retries: times the transport retried the call
+        :param mailbox: X-AnchorMailbox the call was made for
+        :param retry_after: seconds Graph asked us to wait when throttling
+        :return: Void
+        '''
+        with self.lock:
+            self.latency_counts[endpoint][bisect.bisect_left(latency_buckets, seconds)] += 1
+            self.latency_sums[endpoint] += seconds
+            self.responses[(endpoint, method, str(status))] += 1
+            self.retries[endpoint] += retries
+            self.bytes_received[endpoint] += received
+            if mailbox:
+                self.mailbox_calls[mailbox] += 1
+            if retry_after:
+                self.throttle_seconds[endpoint] += retry_after
+
+    def as_prometheus(self):
+        '''
+        :return: string in the Prometheus text exposition format
+        '''
+        lines = []
+
+        def add_family(name, kind, description, samples):
+            lines.extend(format_family(name, kind, description, samples))
+
+        with self.lock:
+            histogram = []
+            for endpoint, counts in sorted(self.latency_counts.items()):
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in latency_buckets] + ['+Inf'], counts):
+                    cumulative += count
+                    histogram.append(('_bucket', [('endpoint', endpoint), ('le', bound)], cumulative))
+                histogram.append(('_sum', [('endpoint', endpoint)], round(self.latency_sums[endpoint], 6)))
+                histogram.append(('_count', [('endpoint', endpoint)], cumulative))
+            add_family('graph_request_duration_seconds', 'histogram', 'Graph call latency by endpoint', histogram)
+            add_family('graph_responses_total', 'counter', 'Graph responses by endpoint, method and status code',
+                       [('', [('endpoint', endpoint), ('method', method), ('status', status)], count)
+                        for (endpoint, method, status), count in sorted(self.responses.items())])
+            add_family('graph_retries_total', 'counter', 'Graph calls retried by the transport',
+                       [('', [('endpoint', endpoint)], count) for endpoint, count in sorted(self.retries.items())])
+            add_family('graph_response_bytes_total', 'counter', 'Graph response bytes received',
+                       [('', [('endpoint', endpoint)], count)
+                        for endpoint, count in sorted(self.bytes_received.items())])
+            add_family('graph_mailbox_requests_total', 'counter',
+                       'Graph calls per mailbox, Outlook throttling limits are per mailbox',
+                       [('', [('mailbox', mailbox)], count) for mailbox, count in sorted(self.mailbox_calls.items())])
+            add_family('graph_throttle_retry_after_seconds_total', 'counter', 'Retry-After seconds asked for in 429s',
+                       [('', [('endpoint', endpoint)], count)
+                        for endpoint, count in sorted(self.throttle_seconds.items())])
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of this process, each worker process keeps and serves its own
+graph_metrics = GraphMetrics()
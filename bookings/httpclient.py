@@ -0,0 +1,78 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class CappedRetry(Retry):
+    '''
+    Retry that waits at most HTTP_RETRY_AFTER_MAX seconds however long a Retry-After header asks,
+    so a throttled call does not hold a page up for minutes
+    '''
+
+    def parse_retry_after(self, retry_after):
+        return min(Retry.parse_retry_after(self, retry_after), settings.HTTP_RETRY_AFTER_MAX)
+
+
+def create_session():
+    '''
+    Build a requests session with pooled keep-alive connections sized by HTTP_POOL_CONNECTIONS
+    (hosts kept) and HTTP_POOL_MAXSIZE (connections per host), cookies are never stored as the
+    session is shared between users and threads
+    when HTTP_MAX_RETRIES is set, failed connections and idempotent requests answered 429, 503 or 504 are
+    retried up to that many times, waiting as long as Retry-After asks up to HTTP_RETRY_AFTER_MAX seconds
+    :return: requests.Session
+    '''
+    session = requests.Session()
+    retry = CappedRetry(total=settings.HTTP_MAX_RETRIES, read=0, status_forcelist=(429, 503, 504),
+                        backoff_factor=settings.HTTP_RETRY_BACKOFF, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS, pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session():
+    '''
+    Shared session used for all outbound HTTP calls, created on first use
+    :return: requests.Session
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def close_session():
+    '''
+    Close pooled connections, the next request opens a new session
+    :return: Void
+    '''
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def request(method, url, **kwargs):
+    '''
+    Make HTTP request through the pooled session with (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT) timeouts
+    unless a timeout is given
+    :param method: HTTP method e.g GET,POST
+    :param url:
+    :param kwargs: keyword arguments for requests e.g. headers, data, params
+    :return: requests.Response
+    '''
+    kwargs.setdefault('timeout', (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
@@ -0,0 +1,191 @@
+import datetime
+import json
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from bookings.authhelper import get_background_redirect_uri, get_social_token, refresh_expired_token
+from bookings.models import Event, OutlookWriteJob
+from bookings.outbox import get_retry_delay, queue_mail
+from bookings.outlookservice import book_event, cancel_booking, invalidate_calendar_cache, update_booking
+
+
+def queue_outlook_write(action, event, body_content='', mail=None, previous=None):
+    '''
+    Queue an Outlook write for an event already saved locally as pending or cancelled
+    :param action: OutlookWriteJob.BOOK, UPDATE or CANCEL
+    :param event: Event
+    :param body_content: HTML content of the outlook event
+    :param mail: queue_mail keyword arguments, queued once the write succeeds
+    :param previous: get_event_times() of an UPDATE's event before it was moved, restored if the write fails
+    :return: OutlookWriteJob
+    '''
+    job = OutlookWriteJob.objects.create(social_account=event.social_account, event=event, action=action,
+                                         payload=json.dumps({'body_content': body_content, 'mail': mail,
+                                                             'previous': previous}))
+    # pending events change availability before the outlook calendar does
+    invalidate_calendar_cache(event.social_account.user.email)
+    return job
+
+
+def get_event_times(event):
+    '''
+    :param event: Event
+    :return: dict of the event's start_time, end_time, duration and date_time that can be stored as JSON
+    '''
+    return {'start_time': event.start_time.isoformat(), 'end_time': event.end_time.isoformat(),
+            'duration': event.duration, 'date_time': event.date_time}
+
+
+def get_event_dict(event):
+    '''
+    :param event: Event
+    :return: dict of the fields outlookservice writes to outlook
+    '''
+    return {'start_time': event.start_time, 'end_time': event.end_time, 'first_name': event.first_name,
+            'email': event.email, 'subject': event.subject, 'outlook_id': event.outlook_id}
+
+
+def run_job(job, access_token):
+    '''
+    Perform a job's Outlook write and apply the result to its event
+    :param job: OutlookWriteJob
+    :param access_token:
+    :return: None on success else error string
+    '''
+    event = job.event
+    if event is None:
+        return None if job.action == OutlookWriteJob.CANCEL else 'Event no longer exists'
+    user_email = job.social_account.user.email
+    body_content = job.get_payload().get('body_content')
+    if job.action == OutlookWriteJob.BOOK:
+        response = book_event(access_token, user_email, get_event_dict(event), body_content)
+    elif job.action == OutlookWriteJob.UPDATE:
+        if not event.outlook_id:
+            return 'Event has no outlook id'
+        response = update_booking(access_token, user_email, get_event_dict(event), body_content)
+    else:
+        # a booking that never reached outlook has nothing to cancel
+        if event.outlook_id and not cancel_booking(access_token, user_email, event.outlook_id):
+            return 'Cancel failed for {}'.format(event.outlook_id)
+        event.delete()
+        job.event = None
+        return None
+    if not isinstance(response, dict):
+        return response
+    event.outlook_id = response.get('id')
+    event.status, event.confirmed_at = Event.CONFIRMED, timezone.now()
+    event.save(update_fields=['outlook_id', 'status', 'confirmed_at'])
+    # the event no longer counts as pending, calendars cached or mirrored without it must be fetched again
+    invalidate_calendar_cache(user_email)
+    return None
+
+
+def get_access_token(social_account, tokens):
+    '''
+    :param social_account:
+    :param tokens: dict of social account id => access token, tokens fetched during this run
+    :return: access token string refreshed if expired
+    '''
+    if social_account.pk not in tokens:
+        token_obj = get_social_token(social_account)
+        refresh_expired_token(token_obj, get_background_redirect_uri())
+        tokens[social_account.pk] = token_obj.token
+    return tokens[social_account.pk]
+
+
+def claim_job(job):
+    '''
+    Mark a job as running so overlapping run_outlook_jobs runs skip it, the claim lapses after
+    OUTLOOK_JOB_CLAIM_TIMEOUT seconds so a job left running by a run that died is run again
+    :param job: OutlookWriteJob as read, pending or running with a lapsed claim
+    :return: True if claimed else False if another run claimed or finished it since it was read
+    '''
+    claimed_until = timezone.now() + datetime.timedelta(seconds=settings.OUTLOOK_JOB_CLAIM_TIMEOUT)
+    claimed = OutlookWriteJob.objects.filter(pk=job.pk, status=job.status, next_attempt_at=job.next_attempt_at) \
+        .update(status=OutlookWriteJob.RUNNING, next_attempt_at=claimed_until)
+    if claimed:
+        job.status, job.next_attempt_at = OutlookWriteJob.RUNNING, claimed_until
+    return bool(claimed)
+
+
+def run_outlook_jobs(batch_size=None):
+    '''
+    Run due Outlook write jobs in the order they were queued, failures are retried with backoff
+    until OUTLOOK_JOB_MAX_ATTEMPTS then the event is marked failed
+    each job is claimed before it runs so overlapping runs never write it to Outlook twice
+    :param batch_size: most jobs run, defaults to OUTLOOK_JOB_BATCH_SIZE
+    :return: tuple (number done, number failed)
+    '''
+    jobs = OutlookWriteJob.objects.filter(status__in=[OutlookWriteJob.PENDING, OutlookWriteJob.RUNNING],
+                                          next_attempt_at__lte=timezone.now()) \
+        .select_related('event', 'social_account__user').order_by('pk')[:batch_size or settings.OUTLOOK_JOB_BATCH_SIZE]
+    done = failed = 0
+    tokens = {}
+    for job in jobs:
+        if job.has_earlier_pending_job() or not claim_job(job):
+            continue
+        try:
+            error = run_job(job, get_access_token(job.social_account, tokens))
+        except Exception as exception:
+            error = repr(exception)
+        if error:
+            record_failure(job, error)
+            failed += 1
+            continue
+        job.status, job.finished_at = OutlookWriteJob.DONE, timezone.now()
+        job.save(update_fields=['status', 'finished_at'])
+        mail = job.get_payload().get('mail')
+        if mail:
+            queue_mail(**mail)
+        done += 1
+    return done, failed
+
+
+def record_failure(job, error):
+    '''
+    Schedule the next attempt of a job or mark it and its event failed once out of attempts
+    :param job: OutlookWriteJob
+    :param error: error string
+    :return: Void
+    '''
+    job.attempts += 1
+    job.last_error = error
+    if job.attempts >= settings.OUTLOOK_JOB_MAX_ATTEMPTS:
+        job.status, job.finished_at = OutlookWriteJob.FAILED, timezone.now()
+        if job.event is not None:
+            fail_event(job)
+    else:
+        job.status = OutlookWriteJob.PENDING
+        job.next_attempt_at = timezone.now() + get_retry_delay(job.attempts, settings.OUTLOOK_JOB_RETRY_DELAY)
+    job.save(update_fields=['attempts', 'last_error', 'status', 'finished_at', 'next_attempt_at'])
+
+
+def fail_event(job):
+    '''
+    Apply a job's final failure to its event, a failed update puts the event back at the times Outlook
+    still has, anything else marks it failed, the host and booker are emailed when a booking or update fails
+    :param job: OutlookWriteJob out of attempts
+    :return: Void
+    '''
+    event = job.event
+    previous = job.get_payload().get('previous')
+    if job.action == OutlookWriteJob.UPDATE and previous:
+        event.start_time = parse_datetime(previous['start_time'])
+        event.end_time = parse_datetime(previous['end_time'])
+        event.duration, event.date_time = previous['duration'], previous['date_time']
+        event.status = Event.CONFIRMED if event.outlook_id else Event.FAILED
+        event.save(update_fields=['start_time', 'end_time', 'duration', 'date_time', 'status'])
+    else:
+        event.status = Event.FAILED
+        event.save(update_fields=['status'])
+    # the slot the pending event held is free again
+    invalidate_calendar_cache(job.social_account.user.email)
+    if job.action in (OutlookWriteJob.BOOK, OutlookWriteJob.UPDATE):
+        update = job.action == OutlookWriteJob.UPDATE
+        msg_html = render_to_string('bookings/email_booking_failed.html', {'event': event, 'update': update})
+        queue_mail(subject='{}: {}'.format('Reschedule Failed' if update else 'Booking Failed', event.subject),
+                   message='', from_email='imeetingbooker@gmail.com',
+                   recipient_list=[job.social_account.user.email, event.email], html_message=msg_html)
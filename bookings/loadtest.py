@@ -0,0 +1,274 @@
+import contextlib
+import datetime
+import itertools
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from socketserver import ThreadingMixIn
+
+import requests
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.servers.basehttp import WSGIServer
+from django.core.urlresolvers import reverse
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test.testcases import QuietWSGIRequestHandler
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from bookings.benchmarks import get_percentile, make_calendar, make_preferences
+from bookings.fakegraph import FakeGraphServer
+
+DEFAULT_MIX = 'grid=40,week=25,durations=20,book=15'
+
+csrf_input = re.compile(r'name=["\']csrfmiddlewaretoken["\'] value=["\']([^"\']+)["\']')
+duration_option = re.compile(r'<select name="duration"[^>]*>\s*<option value="(\d+)"')
+
+
+def parse_mix(value):
+    '''
+    :param value: comma separated operation=weight pairs e.g. 'grid=40,week=25,durations=20,book=15'
+    :return: list of tuples (operation, weight), raises ValueError for unknown operations or bad weights
+    '''
+    mix = []
+    for part in value.split(','):
+        operation, _, weight = part.partition('=')
+        if operation.strip() not in operations:
+            raise ValueError('Unknown operation {}, choose from {}'.format(operation, ', '.join(sorted(operations))))
+        mix.append((operation.strip(), float(weight)))
+    if not any(weight > 0 for operation, weight in mix):
+        raise ValueError('At least one operation needs a positive weight')
+    return mix
+
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class LoadTarget(object):
+    '''
+    Site under load and the booking page being exercised e.g. LoadTarget('http://localhost:8000', 'alice', 1, 15)
+    '''
+
+    def __init__(self, base_url, name, pk, increment, weeks=4):
+        '''
+        :param base_url: scheme and host e.g. http://localhost:8000
+        :param name: username in the booking urls
+        :param pk: user pk of the booking page
+        :param increment: availability increment in minutes, sent with duration AJAX calls
+        :param weeks: weeks ahead navigated to and booked in
+        '''
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.pk = pk
+        self.increment = increment
+        self.weeks = weeks
+
+    def url(self, viewname, **kwargs):
+        return '{}{}'.format(self.base_url, reverse(viewname, kwargs=kwargs))
+
+
+def view_grid(session, target, generator):
+    return [('grid', session.get(target.url('bookings:display_available_time_slots', name=target.name,
+                                            pk=target.pk)))]
+
+
+def navigate_week(session, target, generator):
+    # the grid's next button shows the week after the date in the url
+    date = datetime.date.today() + datetime.timedelta(days=7 * generator.randrange(max(target.weeks - 1, 1)))
+    return [('week', session.get(target.url('bookings:display_available_time_slots', name=target.name, pk=target.pk,
+                                            date=date.strftime('%x'), action='next', event_pk=0)))]
+
+
+def load_durations(session, target, generator):
+    return [('durations', session.get(target.url('bookings:ajax_load_booking_durations'),
+                                      params={'availability_increment': target.increment}))]
+
+
+def book_slot(session, target, generator):
+    '''
+    Open the booking form of a free slot then post it, the slot may have been taken since by another worker
+    '''
+    start = datetime.date.today() + datetime.timedelta(days=7 * generator.randrange(target.weeks))
+    week = session.get(target.url('bookings:available_time_slots_json', pk=target.pk),
+                       params={'start': start.isoformat()})
+    timings = [('availability', week)]
+    slots = [(day['label'], minute) for day in week.json().get('days', []) for minute in day['free']] \
+        if week.status_code == 200 else []
+    if not slots:
+        return timings
+    label, minute = generator.choice(slots)
+    url = target.url('bookings:book_meeting_slot', slot='{:02d}:{:02d}'.format(*divmod(minute, 60)), date=label,
+                     pk=target.pk, event_pk=0)
+    form = session.get(url)
+    timings.append(('booking_form', form))
+    match = csrf_input.search(form.text)
+    if form.status_code != 200 or not match:
+        return timings
+    number = generator.randrange(10 ** 6)
+    duration = duration_option.search(form.text)
+    timings.append(('book', session.post(url, headers={'Referer': url},
+                                         data={'csrfmiddlewaretoken': match.group(1), 'g-recaptcha-response': 'load',
+                                               'first_name': 'Load', 'last_name': str(number),
+                                               'email': 'load{}@kcl.ac.uk'.format(number),
+                                               'subject': 'Load test',
+                                               'duration': duration.group(1) if duration else target.increment,
+                                               'date_time': label}, allow_redirects=False)))
+    return timings
+
+
+operations = {'grid': view_grid, 'week': navigate_week, 'durations': load_durations, 'book': book_slot}
+
+
+def run_load(targets, mix, concurrency=4, total=100, duration=None, seed=0, timeout=30):
+    '''
+    Drive a weighted mix of operations against targets from concurrent workers, targets are used round robin
+    each worker keeps its own session so CSRF cookies carry from booking form to post
+    :param targets: list of LoadTarget
+    :param mix: list of tuples (operation, weight) see parse_mix()
+    :param concurrency: number of worker threads
+    :param total: operations to run, ignored if duration is given
+    :param duration: seconds to keep running
+    :param seed: random seed for the operation sequence
+    :param timeout: seconds each request may take
+    :return: tuple (dict of endpoint => list of (latency in seconds, status code or None if the request raised),
+                    elapsed seconds)
+    '''
+    names, weights = zip(*mix)
+    samples = {}
+    lock = threading.Lock()
+    counter = itertools.count()
+    target_cycle = itertools.cycle(targets)
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+
+    def work(worker):
+        generator = random.Random('{}:{}'.format(seed, worker))
+        session = requests.Session()
+        original_request = session.request
+
+        def timed_request(*args, **kwargs):
+            kwargs.setdefault('timeout', timeout)
+            request_started = time.perf_counter()
+            response = original_request(*args, **kwargs)
+            response.latency = time.perf_counter() - request_started
+            return response
+        session.request = timed_request
+        while True:
+            number = next(counter)
+            if (deadline and time.perf_counter() > deadline) or (not deadline and number >= total):
+                break
+            with lock:
+                target = next(target_cycle)
+            operation = generator.choices(names, weights)[0]
+            operation_started = time.perf_counter()
+            try:
+                results = [(endpoint, response.latency, response.status_code)
+                           for endpoint, response in operations[operation](session, target, generator)]
+            except (requests.RequestException, ValueError):
+                results = [(operation, time.perf_counter() - operation_started, None)]
+            with lock:
+                for endpoint, latency, status in results:
+                    samples.setdefault(endpoint, []).append((latency, status))
+        session.close()
+
+    workers = [threading.Thread(target=work, args=(worker,)) for worker in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return samples, time.perf_counter() - started
+
+
+def summarise(samples, elapsed):
+    '''
+    :param samples: run_load() samples
+    :param elapsed: run_load() elapsed seconds
+    :return: dict of endpoint => {'requests', 'errors', 'throughput' per second, 'p50', 'p95', 'p99' in ms,
+             'statuses': {status: count}} with an 'all' entry over every endpoint
+    '''
+    summary = {}
+    everything = [sample for endpoint_samples in samples.values() for sample in endpoint_samples]
+    for endpoint, endpoint_samples in itertools.chain(sorted(samples.items()), [('all', everything)]):
+        if not endpoint_samples:
+            continue
+        latencies = sorted(latency * 1000 for latency, status in endpoint_samples)
+        statuses = {}
+        for latency, status in endpoint_samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[endpoint] = {'requests': len(endpoint_samples),
+                             'errors': sum(1 for latency, status in endpoint_samples
+                                           if status is None or status >= 500),
+                             'throughput': round(len(endpoint_samples) / elapsed, 2) if elapsed else 0,
+                             'p50': round(get_percentile(latencies, 50), 3),
+                             'p95': round(get_percentile(latencies, 95), 3),
+                             'p99': round(get_percentile(latencies, 99), 3),
+                             'statuses': statuses}
+    return summary
+
+
+def seed_booking_page(username, events, increment, weeks, graph_store, seed=0):
+    '''
+    Create a user with a Microsoft account, a long lived token, weekday availability and a synthetic calendar
+    :param username: user name, the mailbox is <username>@example.com
+    :param events: events spread over the weeks in the fake Graph calendar
+    :param increment: availability increment in minutes
+    :param weeks: weeks the events are spread over
+    :param graph_store: FakeGraphStore the calendar is added to
+    :param seed: random seed of the calendar
+    :return: User
+    '''
+    user = User.objects.create_user(username, '{}@example.com'.format(username), 'load-test-password')
+    app = SocialApp.objects.create(provider='microsoft', name='Load test', client_id='load', secret='load')
+    app.sites.add(Site.objects.get_current())
+    account = SocialAccount.objects.create(user=user, provider='microsoft', uid=username)
+    SocialToken.objects.create(app=app, account=account, token='load-access', token_secret='load-refresh',
+                               expires_at=timezone.now() + datetime.timedelta(days=1))
+    make_preferences(increment, account_social=account).save()
+    graph_store.add_calendar(user.email, make_calendar(datetime.date.today(), weeks * 7, events, seed))
+    return user
+
+
+@contextlib.contextmanager
+def offline_site(events=200, increment=15, weeks=4, graph_latency=0, error_rate=0, throttle_rate=0, seed=0):
+    '''
+    Serve the site in process against a throwaway database and a fake Graph server, nothing leaves the machine
+    e.g.
+    with offline_site(events=500) as target:
+        samples, elapsed = run_load([target], parse_mix(DEFAULT_MIX))
+    :param events: synthetic events in the booking page's calendar
+    :param increment: availability increment in minutes
+    :param weeks: weeks the events are spread over and the load navigates
+    :param graph_latency: seconds the fake Graph adds to every response
+    :param error_rate: fraction of Graph requests answered 503
+    :param throttle_rate: fraction of Graph requests answered 429
+    :param seed: random seed of the calendar and injected failures
+    :return: LoadTarget of the seeded booking page
+    '''
+    handle, database_name = tempfile.mkstemp(prefix='loadtest', suffix='.sqlite3')
+    os.close(handle)
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = database_name
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    graph = FakeGraphServer(('localhost', 0), latency=graph_latency, error_rate=error_rate,
+                            throttle_rate=throttle_rate, seed=seed).start()
+    site = ThreadedWSGIServer(('localhost', 0), QuietWSGIRequestHandler)
+    graph_settings = override_settings(GRAPH_BASE_URL=graph.graph_base_url, OUTLOOK_AUTHORITY=graph.base_url,
+                                       GOOGLE_RECAPTCHA_VERIFY_URL=graph.recaptcha_verify_url,
+                                       EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    graph_settings.enable()
+    try:
+        user = seed_booking_page('loadtest', events, increment, weeks, graph.store, seed)
+        site.set_app(get_wsgi_application())
+        threading.Thread(target=site.serve_forever, daemon=True).start()
+        yield LoadTarget('http://{}:{}'.format(*site.server_address[:2]), user.username, user.pk, increment, weeks)
+    finally:
+        site.shutdown()
+        site.server_close()
+        graph.stop()
+        graph_settings.disable()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookings.benchmarks import DEFAULT_EVENT_COUNTS, DEFAULT_INCREMENTS, DEFAULT_WEEKS, compare_with_baseline, \
+    run_benchmarks
+
+
+class Command(BaseCommand):
+    '''
+    Benchmark availability over synthetic calendars
+    e.g. python manage.py benchmark_availability --events 0 1000 --weeks 1 4 --output baseline.json
+         python manage.py benchmark_availability --compare baseline.json
+    '''
+    help = 'Time grid data, booking form durations and grid rendering, write or compare a JSON baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, nargs='+', default=list(DEFAULT_EVENT_COUNTS),
+                            help='Calendar sizes')
+        parser.add_argument('--increments', type=int, nargs='+', default=list(DEFAULT_INCREMENTS),
+                            help='Availability increments in minutes')
+        parser.add_argument('--weeks', type=int, nargs='+', default=list(DEFAULT_WEEKS), help='Horizons in weeks')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+        parser.add_argument('--compare', help='Baseline JSON file to compare results against')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed fractional p50 slow down against the baseline')
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(options['events'], options['increments'], options['weeks'], options['repeat'],
+                                 progress=self.report_case)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+            self.stdout.write('Wrote {} cases to {}'.format(len(results['results']), options['output']))
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            regressions = compare_with_baseline(results, baseline, options['tolerance'])
+            for key, previous, current in regressions:
+                self.stderr.write('{}: p50 {:.3f}ms -> {:.3f}ms'.format(key, previous, current))
+            if regressions:
+                raise CommandError('{} cases slower than baseline'.format(len(regressions)))
+            self.stdout.write('No regressions against {}'.format(options['compare']))
+
+    def report_case(self, key, measurements):
+        '''
+        :param key: case name
+        :param measurements: dict see bookings.benchmarks.measure
+        :return: Void
+        '''
+        self.stdout.write('{}: p50 {p50:.3f}ms p95 {p95:.3f}ms p99 {p99:.3f}ms peak {peak_kib}KiB '
+                          '{allocated_blocks} blocks'.format(key, **measurements))
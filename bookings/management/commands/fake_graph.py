@@ -0,0 +1,50 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from bookings.benchmarks import make_calendar
+from bookings.fakegraph import FakeGraphServer
+
+
+class Command(BaseCommand):
+    '''
+    Serve a local stand in for Microsoft Graph and the OAuth token endpoint, point GRAPH_BASE_URL
+    and OUTLOOK_AUTHORITY at it to run the site offline
+    e.g. python manage.py fake_graph --port 8001 --events 200 --latency 80 --throttle-rate 0.02
+    '''
+    help = 'Run a fake Graph server with in memory calendars and injected latency, errors and throttling'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--mailbox', nargs='+', help='Mailboxes to seed, defaults to every user with an email')
+        parser.add_argument('--events', type=int, default=0, help='Synthetic events seeded per mailbox')
+        parser.add_argument('--days', type=int, default=28, help='Days from today the seeded events are spread over')
+        parser.add_argument('--latency', type=int, default=0, help='Milliseconds added to every response')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of Graph requests answered 503')
+        parser.add_argument('--throttle-rate', type=float, default=0, help='Fraction of Graph requests answered 429')
+        parser.add_argument('--retry-after', type=int, default=1, help='Seconds sent with 429 responses')
+        parser.add_argument('--seed', type=int, help='Random seed for seeded events and injected failures')
+        parser.add_argument('--verbose', action='store_true', help='Log every request')
+
+    def handle(self, *args, **options):
+        server = FakeGraphServer((options['host'], options['port']), latency=options['latency'] / 1000.0,
+                                 error_rate=options['error_rate'], throttle_rate=options['throttle_rate'],
+                                 retry_after=options['retry_after'], seed=options['seed'],
+                                 verbose=options['verbose'])
+        if options['events']:
+            mailboxes = options['mailbox'] or User.objects.exclude(email='').values_list('email', flat=True)
+            for mailbox in mailboxes:
+                server.store.add_calendar(mailbox, make_calendar(datetime.date.today(), options['days'],
+                                                                 options['events'], options['seed'] or 0))
+                self.stdout.write('Seeded {} events for {}'.format(options['events'], mailbox))
+        self.stdout.write("Serving on {0}\nGRAPH_BASE_URL = '{1}'\nOUTLOOK_AUTHORITY = '{0}'\n"
+                          "GOOGLE_RECAPTCHA_VERIFY_URL = '{2}'".format(server.base_url, server.graph_base_url,
+                                                                       server.recaptcha_verify_url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
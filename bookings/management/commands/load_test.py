@@ -0,0 +1,63 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookings.loadtest import DEFAULT_MIX, LoadTarget, offline_site, parse_mix, run_load, summarise
+
+
+class Command(BaseCommand):
+    '''
+    Generate booking traffic and report throughput and latency percentiles per endpoint
+    e.g. python manage.py load_test --offline --events 500 --concurrency 8 --requests 400
+         python manage.py load_test --host http://app1:8000 http://app2:8000 --name alice --pk 3 --duration 60
+    '''
+    help = 'Drive a mix of booking grid views, week navigation, duration AJAX calls and booking posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', nargs='+', help='Base urls of running sites, used round robin')
+        parser.add_argument('--name', help='Username of the booking page on the hosts')
+        parser.add_argument('--pk', type=int, help='User pk of the booking page on the hosts')
+        parser.add_argument('--increment', type=int, default=15, help='Availability increment in minutes')
+        parser.add_argument('--weeks', type=int, default=4, help='Weeks ahead navigated to and booked in')
+        parser.add_argument('--offline', action='store_true',
+                            help='Serve the site in process against a throwaway database and a fake Graph')
+        parser.add_argument('--events', type=int, default=200, help='Calendar size when offline')
+        parser.add_argument('--graph-latency', type=int, default=0, help='Fake Graph milliseconds per response')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of fake Graph requests answered 503')
+        parser.add_argument('--throttle-rate', type=float, default=0,
+                            help='Fraction of fake Graph requests answered 429')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help='Operation weights e.g. {}'.format(DEFAULT_MIX))
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent workers')
+        parser.add_argument('--requests', type=int, default=100, help='Operations to run')
+        parser.add_argument('--duration', type=float, help='Seconds to run for instead of a number of operations')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the summary as JSON to this file')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as error:
+            raise CommandError(error)
+        load = {'concurrency': options['concurrency'], 'total': options['requests'],
+                'duration': options['duration'], 'seed': options['seed']}
+        if options['offline']:
+            with offline_site(options['events'], options['increment'], options['weeks'],
+                              options['graph_latency'] / 1000.0, options['error_rate'], options['throttle_rate'],
+                              options['seed']) as target:
+                self.stdout.write('Serving offline on {}'.format(target.base_url))
+                samples, elapsed = run_load([target], mix, **load)
+        elif options['host'] and options['name'] and options['pk']:
+            targets = [LoadTarget(host, options['name'], options['pk'], options['increment'], options['weeks'])
+                       for host in options['host']]
+            samples, elapsed = run_load(targets, mix, **load)
+        else:
+            raise CommandError('Give --offline or --host with --name and --pk')
+        summary = summarise(samples, elapsed)
+        self.stdout.write('{:<14}{:>9}{:>8}{:>10}{:>11}{:>11}{:>11}'.format('endpoint', 'requests', 'errors',
+                                                                          'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for endpoint, row in sorted(summary.items(), key=lambda item: item[0] == 'all'):
+            self.stdout.write('{:<14}{requests:>9}{errors:>8}{throughput:>10.2f}{p50:>11.1f}{p95:>11.1f}'
+                              '{p99:>11.1f}'.format(endpoint, **row))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'elapsed': round(elapsed, 3), 'endpoints': summary}, output, indent=2, sort_keys=True)
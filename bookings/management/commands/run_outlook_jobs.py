@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bookings.jobs import run_outlook_jobs
+
+
+class Command(BaseCommand):
+    '''
+    Perform Outlook event writes queued while OUTLOOK_ASYNC_WRITES is on
+    e.g. python manage.py run_outlook_jobs --loop --interval 2
+    '''
+    help = 'Run queued Outlook booking, reschedule and cancel writes, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Most jobs run per pass')
+        parser.add_argument('--loop', action='store_true', help='Keep running jobs until interrupted')
+        parser.add_argument('--interval', type=int, default=2, help='Seconds to wait when no job ran')
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = run_outlook_jobs(options['batch_size'])
+            if done or failed:
+                self.stdout.write('Done {}, failed {}'.format(done, failed))
+            if not options['loop']:
+                break
+            if not done:
+                time.sleep(options['interval'])
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bookings.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    '''
+    Deliver queued emails
+    e.g. python manage.py send_outbox --loop --interval 5
+    '''
+    help = 'Send queued booking emails over a single SMTP connection, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Most emails sent per connection')
+        parser.add_argument('--loop', action='store_true', help='Keep draining the outbox until interrupted')
+        parser.add_argument('--interval', type=int, default=5, help='Seconds to wait when the outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = drain_outbox(options['batch_size'])
+            if sent or failed:
+                self.stdout.write('Sent {}, failed {}'.format(sent, failed))
+            if not options['loop']:
+                break
+            if not sent:
+                time.sleep(options['interval'])
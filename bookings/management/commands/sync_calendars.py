@@ -0,0 +1,53 @@
+import time
+
+from allauth.socialaccount.models import SocialAccount
+from django.core.management.base import BaseCommand
+
+from bookings.authhelper import get_background_redirect_uri, get_social_token, refresh_expired_token
+from bookings.calendarsync import sync_calendar_mirror
+
+
+class Command(BaseCommand):
+    '''
+    Keep local calendar mirrors current with Graph calendarView delta queries
+    e.g. python manage.py sync_calendars --loop --interval 60
+    '''
+    help = 'Sync Outlook calendars of accounts with booking preferences into the local event mirror'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, action='append', dest='accounts',
+                            help='Social account id to sync, may be repeated (default all with preferences)')
+        parser.add_argument('--window-days', type=int, help='Days ahead to mirror')
+        parser.add_argument('--loop', action='store_true', help='Keep syncing until interrupted')
+        parser.add_argument('--interval', type=int, default=60, help='Seconds between syncs with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            self.sync_accounts(options['accounts'], options['window_days'])
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def sync_accounts(self, account_ids, window_days):
+        '''
+        Sync mirror of each account, errors are reported and do not stop other accounts syncing
+        :param account_ids: list of social account ids or None for all accounts with booking preferences
+        :param window_days: days ahead to mirror
+        :return: Void
+        '''
+        accounts = SocialAccount.objects.filter(provider='microsoft', availability_prefs__isnull=False) \
+            .select_related('user')
+        if account_ids:
+            accounts = accounts.filter(pk__in=account_ids)
+        for account in accounts:
+            try:
+                token_obj = get_social_token(account)
+                refresh_expired_token(token_obj, get_background_redirect_uri())
+                synced = sync_calendar_mirror(account, token_obj.token, window_days)
+            except Exception as error:
+                self.stderr.write('Account {}: sync failed {!r}'.format(account.pk, error))
+                continue
+            if synced:
+                self.stdout.write('Account {}: synced'.format(account.pk))
+            else:
+                self.stderr.write('Account {}: delta sync rejected, will resync'.format(account.pk))
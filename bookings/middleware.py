@@ -0,0 +1,139 @@
+import cProfile
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.core.urlresolvers import Resolver404, resolve
+
+from bookings.profiling import is_profile_requested, save_profile, take_profile_slot
+from bookings.timing import start_request_timings, stop_request_timings
+
+slow_request_logger = logging.getLogger('bookings.slow_requests')
+
+
+class QueryTimingCursorWrapper(CursorWrapper):
+    '''
+    Cursor adding the time and number of its queries to a request's totals, unlike the debug cursor
+    the SQL is not kept
+    '''
+
+    def __init__(self, cursor, db, totals):
+        '''
+        :param cursor: cursor returned by the connection's own cursor factory
+        :param db: database connection
+        :param totals: list [seconds, queries] shared by the request's cursors
+        '''
+        super(QueryTimingCursorWrapper, self).__init__(cursor, db)
+        self.totals = totals
+
+    def timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.totals[0] += time.perf_counter() - started
+            self.totals[1] += 1
+
+    def execute(self, sql, params=None):
+        return self.timed(super(QueryTimingCursorWrapper, self).execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(super(QueryTimingCursorWrapper, self).executemany, sql, param_list)
+
+
+def time_queries(connection, totals):
+    '''
+    Wrap the cursors a connection hands out, debug or not, in QueryTimingCursorWrapper
+    :param connection: database connection of this thread
+    :param totals: list [seconds, queries] the cursors add to
+    :return: Void, undo with untime_queries
+    '''
+    for factory in ('make_cursor', 'make_debug_cursor'):
+        def make_timed_cursor(cursor, make_cursor=getattr(connection, factory)):
+            return QueryTimingCursorWrapper(make_cursor(cursor), connection, totals)
+        setattr(connection, factory, make_timed_cursor)
+
+
+def untime_queries(connection):
+    '''
+    :param connection: database connection passed to time_queries
+    :return: Void
+    '''
+    del connection.make_cursor
+    del connection.make_debug_cursor
+
+
+class ServerTimingMiddleware(object):
+    '''
+    Break each request down into db, graph, token, slots and render phases, sent as a Server-Timing header
+    to staff users or to everyone when SERVER_TIMING_HEADER is on, requests slower than SLOW_REQUEST_THRESHOLD
+    milliseconds are logged as JSON to the bookings.slow_requests logger
+    db time is counted by wrapping each connection's cursors so it also counts towards any phase the queries ran in,
+    the queries' SQL is not stored unless DEBUG logs it anyway
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = start_request_timings()
+        totals = [0.0, 0]
+        timed_connections = list(connections.all())
+        for connection in timed_connections:
+            time_queries(connection, totals)
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_request_timings()
+            for connection in timed_connections:
+                untime_queries(connection)
+            if totals[1]:
+                timings.add('db', *totals)
+        total = timings.get_total()
+        # the breakdown shows token refreshes and Graph and query counts, not for anonymous bookers by default
+        user = getattr(request, 'user', None)
+        if settings.SERVER_TIMING_HEADER or (user and user.is_active and user.is_staff):
+            response['Server-Timing'] = timings.as_header(total)
+        if total * 1000 >= settings.SLOW_REQUEST_THRESHOLD:
+            slow_request_logger.warning(json.dumps({'method': request.method, 'path': request.get_full_path(),
+                                                    'status': response.status_code,
+                                                    'total_ms': round(total * 1000, 3),
+                                                    'phases': timings.as_dict()}))
+        return response
+
+
+class ProfilerMiddleware(object):
+    '''
+    Profile a bookings request with cProfile when a staff user adds ?profile=1 or an X-Profile-Request: 1 header,
+    at most PROFILE_RATE_LIMIT a minute, the X-Profile response header names the stored profile
+    must come after AuthenticationMiddleware
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_profile_requested(request):
+            return self.get_response(request)
+        try:
+            if resolve(request.path_info).namespace != 'bookings':
+                return self.get_response(request)
+        except Resolver404:
+            return self.get_response(request)
+        if not take_profile_slot():
+            response = self.get_response(request)
+            response['X-Profile'] = 'rate limited'
+            return response
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        name = save_profile(profiler, request, response, time.perf_counter() - started)
+        response['X-Profile'] = name or 'too large'
+        return response
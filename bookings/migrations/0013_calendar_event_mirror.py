@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2026-10-18 03:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialaccount', '0003_extra_data_default_dict'),
+        ('bookings', '0012_auto_20180413_2008'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarEventMirror',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('outlook_id', models.CharField(max_length=1000)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('is_all_day', models.BooleanField(default=False)),
+                ('social_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mirrored_events', to='socialaccount.SocialAccount')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CalendarSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta_link', models.TextField(blank=True)),
+                ('window_start', models.DateTimeField(blank=True, null=True)),
+                ('window_end', models.DateTimeField(blank=True, null=True)),
+                ('calendar_version', models.IntegerField(default=0)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('social_account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='calendar_sync_state', to='socialaccount.SocialAccount')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='calendareventmirror',
+            unique_together=set([('social_account', 'outlook_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='calendareventmirror',
+            index_together=set([('social_account', 'start_time', 'end_time')]),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2026-10-18 03:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialaccount', '0003_extra_data_default_dict'),
+        ('bookings', '0014_outbox_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutlookWriteJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('book', 'Book'), ('update', 'Update'), ('cancel', 'Cancel')], max_length=10)),
+                ('payload', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='status',
+            field=models.CharField(choices=[('confirmed', 'Confirmed'), ('pending', 'Pending'), ('cancelled', 'Cancelled'), ('failed', 'Failed')], default='confirmed', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='outlookwritejob',
+            name='event',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='outlook_jobs', to='bookings.Event'),
+        ),
+        migrations.AddField(
+            model_name='outlookwritejob',
+            name='social_account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outlook_jobs', to='socialaccount.SocialAccount'),
+        ),
+        migrations.AlterIndexTogether(
+            name='outlookwritejob',
+            index_together=set([('status', 'next_attempt_at')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2026-10-18 04:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0015_outlook_write_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendarsyncstate',
+            name='write_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,12 +1,22 @@
 import datetime
+import json
 
-import dateutil.parser
 from allauth.socialaccount.models import SocialAccount
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
 from django.db import models
+from django.db.models import F, Q
+from django.dispatch import receiver
+from django.utils import timezone
 
-from bookings.outlookservice import get_events_between_dates
+from bookings.authhelper import get_social_token
+from bookings.availability import MINUTES_PER_DAY, EventIndex, EventRecord, build_availability_bitmap, \
+    find_short_breaks, minute_of_day, time_from_minute
+from bookings.outlookservice import calendar_changed, get_cached_events_for_windows, get_calendar_cache_version, \
+    iter_cached_events_between_dates
+from bookings.timing import timed
 
 
 class BookingAvailability(models.Model):
@@ -20,6 +30,7 @@ class BookingAvailability(models.Model):
         (45, 45),
         (60, 60),
     )
+    WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
     account_social = models.OneToOneField(SocialAccount, related_name='availability_prefs', blank=True, null=True)
     monday_from = models.TimeField(blank=True, null=True)
     monday_to = models.TimeField(blank=True, null=True)
@@ -45,15 +56,52 @@ class BookingAvailability(models.Model):
         choices=(),
     )
 
+    def save(self, *args, **kwargs):
+        '''
+        Discard compiled weekly template so it is rebuilt from saved fields
+        and bump the preferences version so cached availability is recomputed
+        '''
+        self._weekly_template = None
+        super(BookingAvailability, self).save(*args, **kwargs)
+        key = 'availability_prefs_version:{}'.format(self.pk)
+        try:
+            cache.incr(key)
+        except ValueError:  # version expired or evicted
+            cache.set(key, self.get_prefs_version() + 1, None)
 
-    def get_time_slot_data(self, start_date=None, format=True):
+    def get_prefs_version(self):
         '''
+        Version number of these preferences, bumped on every save()
+        :return: int version
+        '''
+        key = 'availability_prefs_version:{}'.format(self.pk)
+        cache.add(key, 1, None)
+        return cache.get(key, 1)
+
+    def get_weekly_template(self):
+        '''
+        Compile Mon-Sun and lunch time fields into minute of day ranges, cached on the instance until save()
+        :return: tuple(tuple of 7 (start, end) minute ranges indexed by weekday() or None if unavailable,
+        (start, end) lunch range or None) e.g. (((480, 960), ..., None, None), (720, 780))
+        '''
+        template = getattr(self, '_weekly_template', None)
+        if template is None:
+            compile_range = lambda start, end: (minute_of_day(start), minute_of_day(end)) if start and end else None
+            week = tuple(compile_range(getattr(self, day + '_from'), getattr(self, day + '_to'))
+                         for day in self.WEEKDAYS)
+            template = self._weekly_template = (week, compile_range(self.lunch_from, self.lunch_to))
+        return template
+
+    @timed('slots')
+    def get_time_slot_data(self, start_date=None, format=True, event_index=None):
+        '''
+        :param event_index: EventIndex of outlook events for the days, fetched if not given
         :return: list of dicts from current date e.g. TUE 13/02/18 => 7 days
         '''
         days = self.get_next_7_days(start_date)
         min_time, max_time = self.get_time_ranges()
         times = self.get_times_by_increment(min_time, max_time)
-        date_time_data_dict = self.get_day_time_availability_dict(days, times, format)
+        date_time_data_dict = self.get_day_time_availability_dict(days, times, format, event_index)
         return date_time_data_dict
 
     @staticmethod
@@ -73,17 +121,10 @@ class BookingAvailability(models.Model):
         Get minimum from time and maximum to time
         :return: tuple(min time, max time)
         '''
-        filter_none = lambda lst: [elem for elem in lst if elem is not None]
-        default_start, default_end = [datetime.time(23, 59)], [datetime.time(0, 0)]
-        start_times = [self.monday_from, self.tuesday_from,
-                       self.wednesday_from, self.thursday_from,
-                       self.friday_from, self.saturday_from,
-                       self.sunday_from]
-        end_times = [self.monday_to, self.tuesday_to,
-                     self.wednesday_to, self.thursday_to,
-                     self.friday_to, self.saturday_to,
-                     self.sunday_to]
-        return min(filter_none(start_times) or default_start), max(filter_none(end_times) or default_end)
+        week = [day_range for day_range in self.get_weekly_template()[0] if day_range]
+        if not week:
+            return datetime.time(23, 59), datetime.time(0, 0)
+        return time_from_minute(min(start for start, end in week)), time_from_minute(max(end for start, end in week))
 
     def get_times_by_increment(self, min_time, max_time):
         '''
@@ -93,67 +134,162 @@ class BookingAvailability(models.Model):
         e.g. 20 min increment 9:00AM start 5:00PM end
         returns [9:00,9:20,9:40,10:00,10:20 ... 16:40, 17:00] as datetime objects
         '''
-        min_datetime = datetime.datetime.combine(datetime.date.min, min_time)
-        max_datetime = datetime.datetime.combine(datetime.date.min, max_time)
-        times = []
-        while min_datetime <= max_datetime:
-            times.append(min_datetime)
-            min_datetime += datetime.timedelta(minutes=self.availability_increment)
-        return times
+        midnight = datetime.datetime.combine(datetime.date.min, datetime.time.min)
+        return [midnight + datetime.timedelta(minutes=minute)
+                for minute in range(minute_of_day(min_time), minute_of_day(max_time) + 1, self.availability_increment)]
 
-    def get_day_time_availability_dict(self, days, times, format=True):
+    def get_day_time_availability_dict(self, days, times, format=True, event_index=None):
         '''
         Get day time dictionary according to availability of time slots
         :param days: list of date objects for range of dates
         :param times: list of datetime objects for range of times
         :param format: format date objects as Fri 16/02/18 and time objects as 08:00
+        :param event_index: EventIndex of outlook events for the days, fetched if not given
         :return:  list of dicts of day and time [{'Fri 16/02/18': 08:00, 'Thu 16/02/18': 08:00, },{}...]
         '''
         data = []
-        outlook_events = self.parse_outlook_events_into_dict(self.get_outlook_events(days))
-        short_breaks = self.get_breaks_between_close_sets_of_events(days, outlook_events)
+        bitmap = self.get_availability_bitmap(days, event_index)
+        day_masks = [(day.strftime('%a %d/%m/%y') if format else day, bitmap.day_mask(day)) for day in days]
         for time in times:
             dic = {}
-            for day in days:
-                if self.slot_is_available(time.time(), day, outlook_events, short_breaks):
-                    dic[day.strftime('%a %d/%m/%y') if format else day] = time.time().strftime('%H:%M') if format else \
-                        time.time()
+            minute = minute_of_day(time.time())
+            value = time.time().strftime('%H:%M') if format else time.time()
+            for key, mask in day_masks:
+                if not (mask >> minute) & 1:
+                    dic[key] = value
             data.append(dic)
         return data
 
-    def get_breaks_between_close_sets_of_events(self, days, events):
+    def get_availability_bitmap(self, days, event_index=None):
         '''
-        e.g. 9:30 – 10 10 – 10:15 10:30 – 10:45 (15) seq = 3   3+ 15 minutes or or less
-        Find cumulative difference between meetings if greater than 15 and 3 or more meetings
-        don't worry otherwise
-        :return: list of datetime object slots that are possible for breaktimes
+        :param days: list of date objects for range of dates
+        :param event_index: EventIndex of outlook events for the days, fetched if not given
+        :return: AvailabilityBitmap of unbookable slot starts for the days
         '''
-        break_slots = []
-        day_events_dict = self.get_day_events_dict(events)
-        for day in days:
-            if day_events_dict.get(day):
-                day_events = day_events_dict.get(day)
-                if len(events) < 3:  # if less than 3 events skip day
-                    continue
-                cumulative_difference = 0
-                possible_times = []
-                i = 0
-                for event in day_events:
-                    if i == 0:
-                        previous_event_end_time = event['end']
-                        i+=1
-                        continue
-                    difference = event['start'] - previous_event_end_time
-                    diff_in_minutes = int(difference.seconds / 60)
-                    if 0< diff_in_minutes <= 15:
-                        possible_times.append(previous_event_end_time)#, 'end': previous_event_end_time})
-                        cumulative_difference += diff_in_minutes
-                    previous_event_end_time = event['end']
-                if cumulative_difference > 20:
-                    continue
-                break_slots.append( possible_times )
-        return [inner for outer in break_slots for inner in outer]
+        if event_index is None:
+            event_index = self.get_event_index(days)
+        short_breaks = self.get_breaks_between_close_sets_of_events(days, event_index)
+        return build_availability_bitmap(self, days, event_index, short_breaks)
+
+    @timed('slots')
+    def get_week_availability(self, start_date, event_index=None):
+        '''
+        Compact week of availability for the booking grid JSON API
+        :param start_date: date object of the first day
+        :param event_index: EventIndex of outlook events for the days, fetched if not given
+        :return: dict of grid metadata and free slot start minutes per day e.g.
+        {'start': '2018-02-12', 'increment': 20, 'times': [480, 500, ...],
+         'days': [{'date': '2018-02-12', 'label': 'Mon 12/02/18', 'free': [480, 540, ...]}, ...]}
+        '''
+        days = self.get_next_7_days(start_date)
+        bitmap = self.get_availability_bitmap(days, event_index)
+        min_time, max_time = self.get_time_ranges()
+        minutes = list(range(minute_of_day(min_time), minute_of_day(max_time) + 1, self.availability_increment))
+        week = []
+        # the 8th day only bounds the event window, the grid shows 7 columns
+        for day in days[:7]:
+            mask = bitmap.day_mask(day)
+            week.append({'date': day.isoformat(), 'label': day.strftime('%a %d/%m/%y'),
+                         'free': [minute for minute in minutes if not (mask >> minute) & 1]})
+        return {'start': start_date.isoformat(), 'increment': self.availability_increment,
+                'duration': self.booking_duration, 'times': minutes, 'days': week}
+
+    def get_day_event_index(self, day):
+        '''
+        Fetch outlook events overlapping a single day into an EventIndex
+        :param day: date object
+        :return: EventIndex
+        '''
+        return self.get_event_index([day, day + datetime.timedelta(days=1)])
+
+    @timed('slots')
+    def get_free_slots_on_day(self, day, event_index=None):
+        '''
+        Bookable grid times of a single day, only that day's events are fetched
+        :param day: date object
+        :param event_index: EventIndex of outlook events for the day, fetched if not given
+        :return: list of datetime.time objects e.g. [datetime.time(9, 0), datetime.time(9, 20), ...]
+        '''
+        if event_index is None:
+            event_index = self.get_day_event_index(day)
+        mask = self.get_availability_bitmap([day], event_index).day_mask(day)
+        min_time, max_time = self.get_time_ranges()
+        return [time_from_minute(minute) for minute in
+                range(minute_of_day(min_time), minute_of_day(max_time) + 1, self.availability_increment)
+                if not (mask >> minute) & 1]
+
+    def get_longest_free_run(self, start, event_index=None, moved_event=None):
+        '''
+        Longest meeting that can start at start without a clash, in whole increments up to booking_duration
+        i.e. every slot from start up to the meeting's last increment is free
+        :param start: datetime object of the first slot
+        :param event_index: EventIndex of outlook events for the day, fetched if not given
+        :param moved_event: (start, end) naive datetimes of an event being rescheduled, events within it
+        are left out so the meeting can overlap its own current time
+        :return: int minutes e.g. 40, 0 if start itself is unbookable
+        '''
+        day = start.date()
+        if event_index is None:
+            event_index = self.get_day_event_index(day)
+        if moved_event:
+            event_index = EventIndex([event for event in event_index
+                                      if not moved_event[0] <= event.start <= event.end <= moved_event[1]])
+        mask = self.get_availability_bitmap([day], event_index).day_mask(day)
+        minute = minute_of_day(start.time())
+        run = 0
+        while run + self.availability_increment <= self.booking_duration and minute + run < MINUTES_PER_DAY \
+                and not (mask >> (minute + run)) & 1:
+            run += self.availability_increment
+        return run
+
+    def get_availability_cache_key(self, prefix, start_date, *parts):
+        '''
+        Cache key for computed availability of the week from start_date, changes with the preferences version,
+        the calendar version and, for the current week, every minute as past slots close
+        :param prefix: key prefix
+        :param start_date: date object of the first day
+        :param parts: further key components
+        :return: string key
+        '''
+        key_parts = [prefix, self.pk, self.get_prefs_version(),
+                     get_calendar_cache_version(self.account_social.user.email), start_date.isoformat()]
+        now = datetime.datetime.now()
+        if start_date <= now.date() < start_date + datetime.timedelta(days=8):
+            key_parts.append(now.strftime('%Y%m%d%H%M'))
+        return ':'.join(str(part) for part in key_parts + list(parts))
 
+    def get_cached_week_availability(self, start_date):
+        '''
+        get_week_availability through Django's cache for AVAILABILITY_CACHE_TIMEOUT seconds
+        :param start_date: date object of the first day
+        :return: dict see get_week_availability
+        '''
+        key = self.get_availability_cache_key('availability_week', start_date)
+        week = cache.get(key)
+        if week is None:
+            week = self.get_week_availability(start_date)
+            cache.set(key, week, settings.AVAILABILITY_CACHE_TIMEOUT)
+        return week
+
+    def get_breaks_between_close_sets_of_events(self, days, events, max_gap=None, max_total=None):
+        '''
+        e.g. 9:30 – 10 10 – 10:15 10:30 – 10:45 (15) seq = 3   3+ 15 minutes or or less
+        Find cumulative difference between meetings if greater than 15 and 3 or more meetings on the day
+        don't worry otherwise
+        :param days: list of date objects
+        :param events: EventIndex or list of parsed outlook events
+        :param max_gap: longest gap counted as a break, defaults to SHORT_BREAK_MAX_GAP
+        :param max_total: most minutes of breaks kept on a day, defaults to SHORT_BREAK_MAX_TOTAL
+        :return: set of datetime object slots that are possible for breaktimes
+        '''
+        max_gap = settings.SHORT_BREAK_MAX_GAP if max_gap is None else max_gap
+        max_total = settings.SHORT_BREAK_MAX_TOTAL if max_total is None else max_total
+        if not isinstance(events, EventIndex):
+            events = EventIndex(events)
+        break_slots = set()
+        for day in days:
+            break_slots.update(find_short_breaks(events.events_on(day), max_gap, max_total))
+        return break_slots
 
     def get_day_events_dict(self, events):
         '''
@@ -185,7 +321,7 @@ class BookingAvailability(models.Model):
             'Lunch': {'start': self.lunch_from, 'end': self.lunch_to},
         }
 
-    def slot_is_available(self, time, day, outlook_events, short_break_slots=[]):
+    def slot_is_available(self, time, day, outlook_events, short_break_slots=()):
         '''
         Checks whether time slot for day is available
         5 main checks
@@ -196,6 +332,7 @@ class BookingAvailability(models.Model):
         4)Interfaces with outlook calendar json response to check availability with reference to existing booked events
         :param time: datetime.time object e.g. datetime.time(8,0) 8:00AM
         :param day: datetime.date object datetime.date(2018,2,10)
+        :param outlook_events: EventIndex of parsed outlook events, built once by the caller for every slot checked
         :return: True/False (True => Slot is available for booking) otherwise False
         '''
         combined_date_time = datetime.datetime.combine(day, time)
@@ -211,30 +348,16 @@ class BookingAvailability(models.Model):
             return False
         return True
 
-    def get_combined_start_end_and_current_datetime(self, start, end, current):
-        '''
-        Return combined date and time object
-        :param start: start time
-        :param end: end time
-        :param current: current time
-        :return: tuple of datetime objects tuple => (start,end,current)
-        '''
-        combine = lambda time: datetime.datetime.combine(datetime.date.min, time)
-        return combine(start), combine(end), combine(current)
-
     def is_slot_within_lunch_break(self, datetime_obj):
         '''
         Check whether slot is in a lunch break
         :param datetime_obj: datetime object
         :return:True if slot is in lunch break (Unbookable) otherwise False
         '''
-        lunch_prefs = self.get_day_availability_dict().get('Lunch')
-        if not lunch_prefs.get('start') or not lunch_prefs.get('end'):
+        lunch = self.get_weekly_template()[1]
+        if not lunch:
             return False
-        start_time, end_time, current_time = self.get_combined_start_end_and_current_datetime(
-            start=lunch_prefs['start'], end=lunch_prefs['end'], current=datetime_obj.time()
-        )
-        return True if start_time <= current_time < end_time else False
+        return lunch[0] <= minute_of_day(datetime_obj.time()) < lunch[1]
 
     def is_slot_within_booking_availability(self, datetime_obj):
         '''
@@ -242,47 +365,91 @@ class BookingAvailability(models.Model):
         :param datetime_obj:
         :return: True if slot is within booking availability (Bookable) otherwise False
         '''
-        day = datetime_obj.strftime('%A')
-        availability_dict = self.get_day_availability_dict()
-        day_preferences = availability_dict.get(day)
-        if not day_preferences.get('start') or not day_preferences.get('end'):
+        day_range = self.get_weekly_template()[0][datetime_obj.weekday()]
+        if not day_range:
             return False
-        start_time, end_time, current_time = self.get_combined_start_end_and_current_datetime(
-            start=day_preferences['start'], end=day_preferences['end'], current=datetime_obj.time()
-        )
-        return True if start_time <= current_time < end_time else False
+        return day_range[0] <= minute_of_day(datetime_obj.time()) < day_range[1]
 
     def get_outlook_events(self, dates):
         '''
-        Retrieve outlook events between a range of dates
+        Retrieve outlook events between a range of dates, read from the local calendar mirror
+        unless it is stale, otherwise served from the calendar cache or streamed live page by page
         :param dates: list of datetimeobjects [start date,end date]
         :param as_timezone:
-        :return:
+        :return: dictionary containing value key which maps to an iterable of dicts for each event
         '''
-        token = self.account_social.socialtoken_set.get()
+        mirrored_events = CalendarEventMirror.get_events_between_dates(self.account_social, dates[0], dates[-1])
+        if mirrored_events is not None:
+            return mirrored_events
+        token = get_social_token(self.account_social)
         email = self.account_social.user.email
-        outlook_events = get_events_between_dates(
+        outlook_events = iter_cached_events_between_dates(
             access_token=token,
             user_email=email,
             start_date=dates[0].isoformat(),
             end_date=dates[-1].isoformat())
-        return outlook_events
+        return {'value': outlook_events}
+
+    def get_event_index(self, dates):
+        '''
+        Fetch and parse outlook events between a range of dates into an EventIndex
+        :param dates: list of datetimeobjects [start date,end date]
+        :return: EventIndex
+        '''
+        return EventIndex(self.parse_outlook_events_into_dict(self.get_outlook_events(dates)) +
+                          self.get_pending_events(dates))
+
+    def get_horizon_event_index(self, start_date, weeks):
+        '''
+        Fetch outlook events for several weeks at once into a single EventIndex, read from the local
+        calendar mirror unless it is stale, otherwise every week is fetched in one batched Graph call
+        :param start_date: date object of the first day
+        :param weeks: number of weeks
+        :return: EventIndex covering weeks * 7 days plus the following day
+        '''
+        dates = [start_date, start_date + datetime.timedelta(days=weeks * 7 + 1)]
+        outlook_events = CalendarEventMirror.get_events_between_dates(self.account_social, dates[0], dates[-1])
+        if outlook_events is None:
+            bounds = [start_date + datetime.timedelta(days=week * 7) for week in range(weeks)] + [dates[-1]]
+            windows = [(bounds[week].isoformat(), bounds[week + 1].isoformat()) for week in range(weeks)]
+            outlook_events = get_cached_events_for_windows(access_token=get_social_token(self.account_social),
+                                                           user_email=self.account_social.user.email, windows=windows)
+        return EventIndex(self.parse_outlook_events_into_dict(outlook_events) + self.get_pending_events(dates))
+
+    def get_pending_events(self, dates):
+        '''
+        Bookings saved locally whose Outlook write has not run yet, or was confirmed within
+        OUTLOOK_CALENDAR_CACHE_TIMEOUT seconds while a calendar cached before it may still lack the event,
+        so their slots stay unbookable
+        :param dates: list of datetimeobjects [start date,end date]
+        :return: list of EventRecords in local time
+        '''
+        start = timezone.make_aware(datetime.datetime.combine(dates[0], datetime.time.min))
+        end = timezone.make_aware(datetime.datetime.combine(dates[-1], datetime.time.max))
+        recently = timezone.now() - datetime.timedelta(seconds=settings.OUTLOOK_CALENDAR_CACHE_TIMEOUT)
+        events = Event.objects.filter(Q(status=Event.PENDING) | Q(status=Event.CONFIRMED, confirmed_at__gte=recently),
+                                      social_account=self.account_social, start_time__lt=end, end_time__gt=start)
+        return [EventRecord.from_datetimes(timezone.localtime(event.start_time).replace(tzinfo=None),
+                                           timezone.localtime(event.end_time).replace(tzinfo=None))
+                for event in events]
 
     def parse_outlook_events_into_dict(self, outlook_output):
         '''
-        Parse JSON outlook service response event info into a usable data structure
-        :param outlook_output: output JSON from service
-        :return: list of dictionaries for each event [{start:'',end:'',is_all_day:True},{},{},...]
+        Parse JSON outlook service response event info into a usable data structure, a streamed value
+        is parsed as it arrives so only the EventRecords are held
+        :param outlook_output: output JSON from service, value may be a generator e.g. from get_outlook_events
+        :return: list of EventRecords for each event, readable as [{start:'',end:'',is_all_day:True},{},{},...]
+        '''
+        return list(self.iter_parsed_outlook_events(outlook_output.get('value') or []))
+
+    def iter_parsed_outlook_events(self, events):
+        '''
+        Parse outlook events one at a time so a stream of events is never held as JSON
+        :param events: iterable of event dicts e.g. outlookservice.iter_cached_events_between_dates
+        :return: generator of EventRecords for each event, readable as {start:'',end:'',is_all_day:True}
         '''
-        events = outlook_output.get('value')
-        event_lst = []
-        if events:
-            for event in events:
-                event_lst.append({
-                    'start': dateutil.parser.parse(event.get('start').get('dateTime')),
-                    'end': dateutil.parser.parse(event.get('end').get('dateTime')),
-                    'is_all_day': event.get('isAllDay')})
-        return event_lst
+        for event in events:
+            yield EventRecord.from_graph(event)
 
     def is_slot_within_outlook_event(self, datetime_obj, events):
         '''
@@ -291,19 +458,12 @@ class BookingAvailability(models.Model):
         2)if slot is within event duration
         3)if at least one meeting slot is possible remain available
         :param datetime_obj:
-        :param events:
+        :param events: EventIndex of parsed outlook events, built once by the caller for every slot checked
         :return: True if slot is clashing with outlook event (Unbookable) else False
         '''
-        if events:
-            for event in events:
-                if event['is_all_day'] and event['start'].date() == datetime_obj.date():
-                    return True
-                if event['start'] <= datetime_obj < event['end']:
-                    return True
-                if event['start'] < datetime_obj + datetime.timedelta(minutes=self.availability_increment) \
-                        <= event['end']:
-                    return True
-        return False
+        if not events:
+            return False
+        return events.clashes_with_slot(datetime_obj, self.availability_increment)
 
     def get_range_of_durations(self):
         '''
@@ -330,6 +490,17 @@ def custom_validate_kcl_email(email):
 
 
 class Event(models.Model):
+    # pending and cancelled events are waiting for their Outlook write to run (OUTLOOK_ASYNC_WRITES)
+    CONFIRMED = 'confirmed'
+    PENDING = 'pending'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+    STATUSES = (
+        (CONFIRMED, 'Confirmed'),
+        (PENDING, 'Pending'),
+        (CANCELLED, 'Cancelled'),
+        (FAILED, 'Failed'),
+    )
     social_account = models.ForeignKey(SocialAccount, related_name='events')
     date_time = models.CharField(max_length=200)
     start_time = models.DateTimeField(blank=True)
@@ -340,3 +511,171 @@ class Event(models.Model):
     duration = models.IntegerField(choices=())
     subject = models.CharField(max_length=500, blank=True)
     outlook_id = models.CharField(max_length=1000, blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=CONFIRMED)
+    # when a queued Outlook write confirmed the event
+    confirmed_at = models.DateTimeField(blank=True, null=True)
+
+
+class CalendarSyncState(models.Model):
+    '''
+    Graph calendarView delta sync progress for an account's calendar mirror, write_version counts the app's
+    writes to the calendar and calendar_version is the write_version the mirror was last synced at
+    both are kept in the database so every web worker and command process agrees on them
+    '''
+    social_account = models.OneToOneField(SocialAccount, related_name='calendar_sync_state')
+    delta_link = models.TextField(blank=True)
+    window_start = models.DateTimeField(blank=True, null=True)
+    window_end = models.DateTimeField(blank=True, null=True)
+    calendar_version = models.IntegerField(default=0)
+    write_version = models.IntegerField(default=0)
+    synced_at = models.DateTimeField(blank=True, null=True)
+
+    def is_fresh(self, start, end):
+        '''
+        Mirror can answer for a window if it covers it, was synced within OUTLOOK_MIRROR_MAX_AGE seconds
+        and no event has been written through the app since (write version unchanged)
+        :param start: aware datetime window start
+        :param end: aware datetime window end
+        :return: True if mirror can be used else False
+        '''
+        if not self.synced_at or not self.window_start or not self.window_end:
+            return False
+        if self.synced_at < timezone.now() - datetime.timedelta(seconds=settings.OUTLOOK_MIRROR_MAX_AGE):
+            return False
+        if not self.window_start <= start or not end <= self.window_end:
+            return False
+        return self.calendar_version == self.write_version
+
+
+@receiver(calendar_changed)
+def mark_calendar_mirror_stale(sender, user_email, **kwargs):
+    '''
+    Count a write to a mailbox's calendar so its mirror is stale until the next sync
+    '''
+    CalendarSyncState.objects.filter(social_account__user__email=user_email) \
+        .update(write_version=F('write_version') + 1)
+
+
+class CalendarEventMirror(models.Model):
+    '''
+    Local copy of an outlook calendar event kept current by the sync_calendars command
+    '''
+    social_account = models.ForeignKey(SocialAccount, related_name='mirrored_events')
+    outlook_id = models.CharField(max_length=1000)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    is_all_day = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('social_account', 'outlook_id')
+        index_together = [('social_account', 'start_time', 'end_time')]
+
+    @classmethod
+    def get_events_between_dates(cls, social_account, start_date, end_date):
+        '''
+        Get mirrored events overlapping a range of dates in the same format as a calendarView response
+        :param social_account:
+        :param start_date: date object
+        :param end_date: date object
+        :return: dictionary containing value key which maps to list of dicts for each event,
+        None if the mirror is missing or stale
+        '''
+        start = timezone.make_aware(datetime.datetime.combine(start_date, datetime.time.min))
+        end = timezone.make_aware(datetime.datetime.combine(end_date, datetime.time.min))
+        state = CalendarSyncState.objects.filter(social_account=social_account).first()
+        if not state or not state.is_fresh(start, end):
+            return None
+        local_iso = lambda datetime_obj: timezone.localtime(datetime_obj).replace(tzinfo=None).isoformat()
+        events = cls.objects.filter(social_account=social_account, start_time__lt=end, end_time__gt=start) \
+            .order_by('start_time').values_list('start_time', 'end_time', 'is_all_day')
+        return {'value': [{'start': {'dateTime': local_iso(event_start)}, 'end': {'dateTime': local_iso(event_end)},
+                           'isAllDay': is_all_day} for event_start, event_end, is_all_day in events]}
+
+
+class OutboxEmail(models.Model):
+    '''
+    Email queued by views and delivered by the send_outbox command, a sending email is claimed by a
+    send_outbox run until its next_attempt_at, after which another run may pick it up again
+    '''
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+    subject = models.CharField(max_length=1000)
+    message = models.TextField(blank=True)
+    html_message = models.TextField(blank=True)
+    from_email = models.CharField(max_length=200)
+    recipients = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt_at')]
+
+    def get_recipient_list(self):
+        '''
+        :return: list of recipient email addresses
+        '''
+        return [recipient for recipient in self.recipients.split(',') if recipient]
+
+
+class OutlookWriteJob(models.Model):
+    '''
+    Outlook event write queued by the booking views when OUTLOOK_ASYNC_WRITES is on
+    and performed by the run_outlook_jobs command
+    '''
+    BOOK = 'book'
+    UPDATE = 'update'
+    CANCEL = 'cancel'
+    ACTIONS = (
+        (BOOK, 'Book'),
+        (UPDATE, 'Update'),
+        (CANCEL, 'Cancel'),
+    )
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    social_account = models.ForeignKey(SocialAccount, related_name='outlook_jobs')
+    event = models.ForeignKey(Event, related_name='outlook_jobs', blank=True, null=True, on_delete=models.SET_NULL)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    payload = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt_at')]
+
+    def get_payload(self):
+        '''
+        :return: dict stored with the job
+        '''
+        return json.loads(self.payload) if self.payload else {}
+
+    def has_earlier_pending_job(self):
+        '''
+        Writes to the same event run in the order they were queued
+        :return: True if an earlier job for this job's event has not finished else False
+        '''
+        return self.event_id is not None and OutlookWriteJob.objects.filter(
+            event_id=self.event_id, status__in=[self.PENDING, self.RUNNING], pk__lt=self.pk).exists()
@@ -0,0 +1,114 @@
+import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.utils import timezone
+
+from bookings.models import OutboxEmail
+
+
+def queue_mail(subject, message, from_email, recipient_list, html_message=None):
+    '''
+    Queue an email for the send_outbox worker, same arguments as django.core.mail.send_mail
+    :param subject:
+    :param message: plain text body
+    :param from_email:
+    :param recipient_list: list of email addresses
+    :param html_message: HTML alternative body
+    :return: OutboxEmail
+    '''
+    return OutboxEmail.objects.create(subject=subject, message=message, from_email=from_email,
+                                      recipients=','.join(recipient_list), html_message=html_message or '')
+
+
+def get_retry_delay(attempts, delay=None):
+    '''
+    Exponential backoff between attempts, delay doubled for every failed attempt
+    :param attempts: number of failed attempts
+    :param delay: seconds before the first retry, defaults to EMAIL_OUTBOX_RETRY_DELAY
+    :return: timedelta
+    '''
+    return datetime.timedelta(seconds=(delay or settings.EMAIL_OUTBOX_RETRY_DELAY) * 2 ** (attempts - 1))
+
+
+def build_message(email, connection):
+    '''
+    :param email: OutboxEmail
+    :param connection: email backend connection
+    :return: EmailMultiAlternatives
+    '''
+    message = EmailMultiAlternatives(subject=email.subject, body=email.message, from_email=email.from_email,
+                                     to=email.get_recipient_list(), connection=connection)
+    if email.html_message:
+        message.attach_alternative(email.html_message, 'text/html')
+    return message
+
+
+def claim_email(email):
+    '''
+    Mark an email as sending so overlapping send_outbox runs skip it, the claim lapses after
+    EMAIL_OUTBOX_CLAIM_TIMEOUT seconds so an email left sending by a run that died is sent again
+    :param email: OutboxEmail as read, pending or sending with a lapsed claim
+    :return: True if claimed else False if another run claimed or sent it since it was read
+    '''
+    claimed_until = timezone.now() + datetime.timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+    claimed = OutboxEmail.objects.filter(pk=email.pk, status=email.status, next_attempt_at=email.next_attempt_at) \
+        .update(status=OutboxEmail.SENDING, next_attempt_at=claimed_until)
+    if claimed:
+        email.status, email.next_attempt_at = OutboxEmail.SENDING, claimed_until
+    return bool(claimed)
+
+
+def drain_outbox(batch_size=None, connection=None):
+    '''
+    Send due outbox emails over a single reused connection, failures are retried with backoff
+    until EMAIL_OUTBOX_MAX_ATTEMPTS
+    each email is claimed before it is sent so overlapping runs never send it twice
+    :param batch_size: most emails sent, defaults to EMAIL_OUTBOX_BATCH_SIZE
+    :param connection: email backend connection, defaults to get_connection()
+    :return: tuple (number sent, number failed)
+    '''
+    due = OutboxEmail.objects.filter(status__in=[OutboxEmail.PENDING, OutboxEmail.SENDING],
+                                     next_attempt_at__lte=timezone.now()) \
+        .order_by('next_attempt_at')[:batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE]
+    emails = [email for email in due if claim_email(email)]
+    if not emails:
+        return 0, 0
+    connection = connection or get_connection()
+    sent = failed = 0
+    try:
+        connection.open()
+        for email in emails:
+            try:
+                connection.send_messages([build_message(email, connection)])
+            except Exception as error:
+                record_failure(email, error)
+                failed += 1
+            else:
+                email.status, email.sent_at = OutboxEmail.SENT, timezone.now()
+                email.save(update_fields=['status', 'sent_at'])
+                sent += 1
+    except Exception as error:  # connection could not be opened, retry everything not yet sent
+        for email in emails[sent + failed:]:
+            record_failure(email, error)
+            failed += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def record_failure(email, error):
+    '''
+    Schedule the next attempt of an email or mark it failed once out of attempts
+    :param email: OutboxEmail
+    :param error: exception raised sending it
+    :return: Void
+    '''
+    email.attempts += 1
+    email.last_error = repr(error)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmail.FAILED
+    else:
+        email.status = OutboxEmail.PENDING
+        email.next_attempt_at = timezone.now() + get_retry_delay(email.attempts)
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
@@ -1,9 +1,34 @@
+import hashlib
 import json
+import logging
+import time
 import uuid
+from urllib.parse import urlencode
 
 import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal
 
-graph_endpoint = 'https://graph.microsoft.com/v1.0{0}'
+from bookings import httpclient
+from bookings.graphmetrics import get_endpoint_label, graph_metrics
+from bookings.timing import timer
+
+logger = logging.getLogger('bookings.graph')
+
+# maximum number of requests Graph accepts in one JSON batch
+batch_limit = 20
+
+# sent with user_email whenever the app writes to a mailbox's calendar
+calendar_changed = Signal(providing_args=['user_email'])
+
+
+def graph_endpoint(path):
+    '''
+    :param path: endpoint relative to the API version e.g. /me/events
+    :return: absolute url under GRAPH_BASE_URL e.g. https://graph.microsoft.com/v1.0/me/events
+    '''
+    return '{0}{1}'.format(settings.GRAPH_BASE_URL, path)
 
 
 def make_api_call(method, url, token, user_email, payload=None, parameters=None):
@@ -17,7 +42,8 @@ def make_api_call(method, url, token, user_email, payload=None, parameters=None)
     through a dictionary that is parsed to JSON
     :param parameters: query parameters for retrieving
     specfic data
-    :return:
+    :return: requests.Response, latency, status, size and retries are recorded in graph_metrics
+    and failures logged with the client-request-id sent
     '''
     request_id = str(uuid.uuid4())
     headers = {'User-Agent': 'meeting_scheduler/1.0',
@@ -30,18 +56,30 @@ def make_api_call(method, url, token, user_email, payload=None, parameters=None)
                'return-client-request-id': 'true'
                }
 
-    response = None
-    if method.upper() == 'GET':
-        response = requests.get(url, headers=headers, params=parameters)
-    elif method.upper() == 'DELETE':
-        response = requests.delete(url, headers=headers, params=parameters)
-    elif method.upper() == 'PATCH':
-        headers.update({'Content-Type': 'application/json'})
-        response = requests.patch(url, headers=headers, data=json.dumps(payload), params=parameters)
-    elif method.upper() == 'POST':
+    method = method.upper()
+    data = None
+    if method in ('PATCH', 'POST'):
         headers.update({'Content-Type': 'application/json'})
-        response = requests.post(url, headers=headers, data=json.dumps(payload), params=parameters)
-    return response
+        data = json.dumps(payload)
+    elif method not in ('GET', 'DELETE'):
+        return None
+    endpoint = get_endpoint_label(url)
+    started = time.perf_counter()
+    try:
+        with timer('graph'):
+            r = httpclient.request(method, url, headers=headers, data=data, params=parameters)
+    except requests.RequestException as error:
+        graph_metrics.observe(method, endpoint, 'error', time.perf_counter() - started, mailbox=user_email)
+        logger.warning('Graph %s %s failed, client-request-id %s: %s', method, endpoint, request_id, error)
+        raise
+    retries = r.raw.retries.history if getattr(r.raw, 'retries', None) else ()
+    retry_after = r.headers.get('Retry-After') if r.status_code == requests.codes.too_many_requests else None
+    graph_metrics.observe(method, endpoint, r.status_code, time.perf_counter() - started, len(r.content),
+                          len(retries), user_email, int(retry_after) if retry_after and retry_after.isdigit() else None)
+    if r.status_code >= 400:
+        logger.warning('Graph %s %s returned %s, client-request-id %s, request-id %s', method, endpoint,
+                       r.status_code, request_id, r.headers.get('request-id'))
+    return r
 
 
 def get_outlook_events(access_token, user_email):
@@ -56,7 +94,7 @@ def get_outlook_events(access_token, user_email):
     :param user_email:
     :return: dict containing events
     '''
-    events_endpoint = graph_endpoint.format('/me/events')
+    events_endpoint = graph_endpoint('/me/events')
     query_params = {'$top': '10',
                     '$select': 'subject,start,end',
                     '$orderby': 'start/dateTime ASC'}
@@ -68,23 +106,150 @@ def get_outlook_events(access_token, user_email):
         return "{0}: {1}".format(r.status_code, r.text)
 
 
+def iter_calendar_view_pages(access_token, user_email, start_date, end_date):
+    '''
+    Get pages of outlook events between a start and end date, following @odata.nextLink
+    pages hold up to OUTLOOK_CALENDAR_PAGE_SIZE events with only the fields availability needs
+    :param access_token:
+    :param user_email:
+    :param start_date: iso format start date
+    :param end_date: iso format end date
+    :return: generator of page dicts, raises requests.HTTPError if a page request fails
+    '''
+    url = graph_endpoint('/me/calendarview')
+    query_params = {'startdatetime': start_date,
+                    'enddatetime': end_date,
+                    '$top': str(settings.OUTLOOK_CALENDAR_PAGE_SIZE),
+                    '$select': 'start,end,isAllDay'}
+    while url:
+        r = make_api_call('GET', url, access_token, user_email, parameters=query_params)
+        r.raise_for_status()
+        page = r.json()
+        yield page
+        url, query_params = page.get('@odata.nextLink'), None
+
+
+def iter_events_between_dates(access_token, user_email, start_date, end_date):
+    '''
+    Stream outlook events between a start and end date page by page
+    :param access_token:
+    :param user_email:
+    :param start_date: iso format start date
+    :param end_date: iso format end date
+    :return: generator of event dicts, raises requests.HTTPError if a page request fails
+    '''
+    for page in iter_calendar_view_pages(access_token, user_email, start_date, end_date):
+        for event in page.get('value', []):
+            yield event
+
+
 def get_events_between_dates(access_token, user_email, start_date, end_date):
     '''
-    Get outlook events between a start and end date
+    Get outlook events between a start and end date, all pages are combined into the first
     :param access_token:
     :param user_email:
     :param start_date: iso format start date
     :param end_date: iso format end date
     :return: dictionary containing value key which maps to list of dicts for each event
     '''
-    events_endpoint = graph_endpoint.format('/me/calendarview')
-    query_params = {'startdatetime': start_date,
-                    'enddatetime': end_date}
-    r = make_api_call('GET', events_endpoint, access_token, user_email, parameters=query_params)
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    else:
-        return "{0}: {1}".format(r.status_code, r.text)
+    pages = iter_calendar_view_pages(access_token, user_email, start_date, end_date)
+    try:
+        events = next(pages)
+        for page in pages:
+            events['value'].extend(page.get('value', []))
+    except requests.HTTPError as error:
+        return "{0}: {1}".format(error.response.status_code, error.response.text)
+    events.pop('@odata.nextLink', None)
+    return events
+
+
+def get_calendar_view_delta(access_token, user_email, start_date=None, end_date=None, delta_link=None):
+    '''
+    Get changes to the calendar view since the last sync, following pages until Graph returns a delta link
+    starts a new sync for the date window if no delta link is given
+    :param access_token:
+    :param user_email:
+    :param start_date: iso format start date
+    :param end_date: iso format end date
+    :param delta_link: @odata.deltaLink from the previous sync
+    :return: tuple (list of changed event dicts, new delta link) or string if errored
+    removed events are included with an '@removed' key
+    '''
+    url = delta_link or graph_endpoint('/me/calendarview/delta')
+    query_params = None if delta_link else {'startdatetime': start_date, 'enddatetime': end_date}
+    changes = []
+    while True:
+        r = make_api_call('GET', url, access_token, user_email, parameters=query_params)
+        if r.status_code != requests.codes.ok:
+            return "{0}: {1}".format(r.status_code, r.text)
+        page = r.json()
+        changes.extend(page.get('value', []))
+        if '@odata.nextLink' not in page:
+            return changes, page.get('@odata.deltaLink')
+        url, query_params = page['@odata.nextLink'], None
+
+
+def get_calendar_cache_key(prefix, user_email, *parts):
+    '''
+    Cache key for a mailbox, email is hashed to keep keys short and memcached safe
+    :param prefix: key prefix
+    :param user_email:
+    :param parts: further key components
+    :return: string key e.g. outlook_calendar_version:<md5 of email>
+    '''
+    return ':'.join([prefix, hashlib.md5(user_email.encode('utf-8')).hexdigest()] + [str(part) for part in parts])
+
+
+def get_calendar_cache_version(user_email):
+    '''
+    Version number of a mailbox's cached calendar windows, bumping it invalidates every window
+    :param user_email:
+    :return: int version
+    '''
+    key = get_calendar_cache_key('outlook_calendar_version', user_email)
+    cache.add(key, 1, None)
+    return cache.get(key, 1)
+
+
+def invalidate_calendar_cache(user_email):
+    '''
+    Invalidate all cached calendar windows for a mailbox e.g. after an event is booked through the app
+    and send calendar_changed so the mailbox's calendar mirror is marked stale
+    :param user_email:
+    :return: Void
+    '''
+    key = get_calendar_cache_key('outlook_calendar_version', user_email)
+    try:
+        cache.incr(key)
+    except ValueError:  # version expired or evicted
+        cache.set(key, get_calendar_cache_version(user_email) + 1, None)
+    calendar_changed.send(sender=None, user_email=user_email)
+
+
+def iter_cached_events_between_dates(access_token, user_email, start_date, end_date):
+    '''
+    Stream outlook events between a start and end date through Django's cache, keyed by mailbox and
+    date window for OUTLOOK_CALENDAR_CACHE_TIMEOUT seconds, a window that is not cached is streamed
+    from Graph page by page and cached once its last page is read, only the start, end and isAllDay
+    of each event are kept so the raw JSON of a single page is held at a time
+    :param access_token:
+    :param user_email:
+    :param start_date: iso format start date
+    :param end_date: iso format end date
+    :return: generator of event dicts, raises requests.HTTPError if a page request fails, errors are not cached
+    '''
+    key = get_calendar_cache_key('outlook_calendar_view', user_email, get_calendar_cache_version(user_email),
+                                 start_date, end_date)
+    events = cache.get(key)
+    if events is not None:
+        yield from events['value']
+        return
+    kept = []
+    for event in iter_events_between_dates(access_token, user_email, start_date, end_date):
+        event = {'start': event['start'], 'end': event['end'], 'isAllDay': event.get('isAllDay')}
+        kept.append(event)
+        yield event
+    cache.set(key, {'value': kept}, settings.OUTLOOK_CALENDAR_CACHE_TIMEOUT)
 
 
 def update_booking(access_token, user_email, event, body_content):
@@ -96,7 +261,7 @@ def update_booking(access_token, user_email, event, body_content):
     :param body_content: HTML content for update email auto sent by user
     :return: dict response containing saved event data or string if errored
     '''
-    events_endpoint = graph_endpoint.format('/me/events/{}'.format(event['outlook_id']))
+    events_endpoint = graph_endpoint('/me/events/{}'.format(event['outlook_id']))
     payload = {
         "subject": event['subject'],
         "body": {
@@ -114,6 +279,7 @@ def update_booking(access_token, user_email, event, body_content):
     }
     r = make_api_call('PATCH', events_endpoint, access_token, user_email, payload=payload)
     if r.status_code == requests.codes.ok:
+        invalidate_calendar_cache(user_email)
         return r.json()
     else:
         return "{}: {} Request: {}".format(r.status_code, r.text, payload)
@@ -127,10 +293,13 @@ def cancel_booking(access_token, user_email, event_id):
     :param event_id: outlook id of users event
     :return: True if event was successfully cancelled (204) else False
     '''
-    events_endpoint = graph_endpoint.format('/me/events/{}'.format(event_id))
+    events_endpoint = graph_endpoint('/me/events/{}'.format(event_id))
     r = make_api_call('DELETE', events_endpoint, access_token, user_email)
     # check that the request has been processed but no content has been responded (204)
-    return True if r.status_code == requests.codes.no_content else False
+    if r.status_code == requests.codes.no_content:
+        invalidate_calendar_cache(user_email)
+        return True
+    return False
 
 
 def book_event(access_token, user_email, event, body_content):
@@ -143,7 +312,7 @@ def book_event(access_token, user_email, event, body_content):
     :param body_content: HTML content to be sent in email auto sent to booker by user
     :return: dict with booking details including created event id
     '''
-    events_endpoint = graph_endpoint.format('/me/events')
+    events_endpoint = graph_endpoint('/me/events')
 
     payload = {
         "subject": event['subject'],
@@ -173,6 +342,170 @@ def book_event(access_token, user_email, event, body_content):
     r = make_api_call('POST', events_endpoint, access_token, user_email, payload=payload)
     # check if resource has been created (201)
     if r.status_code == requests.codes.created:
+        invalidate_calendar_cache(user_email)
         return r.json()
     else:
         return "{}: {} Request: {}".format(r.status_code, r.text, payload)
+
+
+class GraphBatch(object):
+    '''
+    Collect up to 20 Graph requests and send them in one round trip through the JSON $batch endpoint
+    e.g.
+    batch = GraphBatch(access_token, user_email)
+    read_id = batch.add('GET', '/me/calendarview', parameters={'startdatetime': start, 'enddatetime': end})
+    batch.send()
+    batch.responses[read_id] => {'status': 200, 'headers': {...}, 'body': {...}}
+    '''
+
+    def __init__(self, access_token, user_email):
+        self.access_token = access_token
+        self.user_email = user_email
+        self.requests = []
+        self.responses = {}
+
+    def add(self, method, url, payload=None, parameters=None, depends_on=None):
+        '''
+        Add a request to the batch
+        :param method: HTTP method e.g GET,POST
+        :param url: endpoint relative to the API version e.g. /me/events
+        :param payload: dictionary sent as the JSON body
+        :param parameters: query parameters
+        :param depends_on: list of ids of earlier requests that must succeed before this one runs
+        :return: id of the request, used to look up its response
+        '''
+        if len(self.requests) >= batch_limit:
+            raise ValueError('Graph batches are limited to {} requests'.format(batch_limit))
+        known_ids = [request['id'] for request in self.requests]
+        if any(request_id not in known_ids for request_id in depends_on or []):
+            raise ValueError('Requests can only depend on requests added earlier in the batch')
+        request = {'id': str(len(self.requests) + 1),
+                   'method': method.upper(),
+                   'url': '{}?{}'.format(url, urlencode(parameters)) if parameters else url,
+                   'headers': {'Prefer': 'outlook.timezone="Europe/London"'}}
+        if payload is not None:
+            request['body'] = payload
+            request['headers']['Content-Type'] = 'application/json'
+        if depends_on:
+            request['dependsOn'] = list(depends_on)
+        self.requests.append(request)
+        return request['id']
+
+    def send(self):
+        '''
+        Send the batch and map each response back to its request id, requests whose dependency
+        failed come back with status 424
+        :return: dict of request id => {'status': int, 'headers': dict, 'body': dict or None} or string if errored
+        '''
+        if not self.requests:
+            return self.responses
+        r = make_api_call('POST', graph_endpoint('/$batch'), self.access_token, self.user_email,
+                          payload={'requests': self.requests})
+        if r.status_code != requests.codes.ok:
+            return "{0}: {1}".format(r.status_code, r.text)
+        for response in r.json().get('responses', []):
+            self.responses[response['id']] = {'status': response.get('status'),
+                                              'headers': response.get('headers', {}),
+                                              'body': response.get('body')}
+        methods = {request['id']: request['method'] for request in self.requests}
+        if any(methods[request_id] != 'GET' and 200 <= (response['status'] or 0) < 300
+               for request_id, response in self.responses.items()):
+            invalidate_calendar_cache(self.user_email)
+        return self.responses
+
+    def is_success(self, request_id):
+        '''
+        :param request_id: id returned by add
+        :return: True if the request has a 2xx response else False
+        '''
+        status = self.responses.get(request_id, {}).get('status')
+        return status is not None and 200 <= status < 300
+
+
+def get_next_pages(access_token, user_email, next_link):
+    '''
+    Follow a calendarView window's @odata.nextLink to its last page
+    :param access_token:
+    :param user_email:
+    :param next_link: @odata.nextLink of the window's first page
+    :return: list of event dicts on the following pages or error string
+    '''
+    events = []
+    while next_link:
+        r = make_api_call('GET', next_link, access_token, user_email)
+        if r.status_code != requests.codes.ok:
+            return "{0}: {1}".format(r.status_code, r.text)
+        page = r.json()
+        events.extend(page.get('value', []))
+        next_link = page.get('@odata.nextLink')
+    return events
+
+
+def get_events_for_windows(access_token, user_email, windows):
+    '''
+    Get outlook events for several date windows e.g. weeks in one batched round trip,
+    further pages of the windows are followed concurrently through the async client
+    :param access_token:
+    :param user_email:
+    :param windows: list of tuples (iso start date, iso end date), at most 20
+    :return: list of dictionaries containing value key in the same order as windows, error string for a failed window
+    '''
+    from bookings import asyncoutlookservice  # the async client wraps this module's functions
+    batch = GraphBatch(access_token, user_email)
+    request_ids = [batch.add('GET', '/me/calendarview', parameters={'startdatetime': start_date,
+                                                                     'enddatetime': end_date,
+                                                                     '$top': str(settings.OUTLOOK_CALENDAR_PAGE_SIZE),
+                                                                     '$select': 'start,end,isAllDay'})
+                   for start_date, end_date in windows]
+    responses = batch.send()
+    if not isinstance(responses, dict):
+        return [responses] * len(windows)
+    results = []
+    next_links = []
+    for request_id in request_ids:
+        response = responses.get(request_id, {})
+        if not batch.is_success(request_id):
+            results.append("{0}: {1}".format(response.get('status'), json.dumps(response.get('body'))))
+            continue
+        events = response['body']
+        next_link = events.pop('@odata.nextLink', None)
+        if next_link:
+            next_links.append((len(results), next_link))
+        results.append(events)
+    if next_links:
+        pages = asyncoutlookservice.get_next_pages([(access_token, user_email, link) for _, link in next_links])
+        for (position, _), events in zip(next_links, pages):
+            if isinstance(events, list):
+                results[position]['value'].extend(events)
+            else:
+                results[position] = events
+    return results
+
+
+def get_cached_events_for_windows(access_token, user_email, windows):
+    '''
+    Get outlook events for consecutive date windows e.g. the weeks of a booking horizon in one batched
+    round trip through Django's cache, events overlapping two windows are returned once
+    :param access_token:
+    :param user_email:
+    :param windows: list of tuples (iso start date, iso end date), at most 20
+    :return: dictionary containing value key which maps to list of dicts for each event or error string
+    '''
+    key = get_calendar_cache_key('outlook_calendar_windows', user_email, get_calendar_cache_version(user_email),
+                                 *[date for window in windows for date in window])
+    events = cache.get(key)
+    if events is None:
+        responses = get_events_for_windows(access_token, user_email, windows)
+        errors = [response for response in responses if not isinstance(response, dict)]
+        if errors:
+            return errors[0]
+        seen = set()
+        events = {'value': []}
+        for response in responses:
+            for event in response.get('value', []):
+                event_key = (event['start']['dateTime'], event['end']['dateTime'], event.get('isAllDay'))
+                if event_key not in seen:
+                    seen.add(event_key)
+                    events['value'].append(event)
+        cache.set(key, events, settings.OUTLOOK_CALENDAR_CACHE_TIMEOUT)
+    return events
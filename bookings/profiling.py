@@ -0,0 +1,127 @@
+import datetime
+import json
+import os
+import pstats
+import re
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+# names of stored profiles, also what the profile pages accept so paths never leave PROFILE_DIR
+profile_name = re.compile(r'^[\w-]+$')
+
+
+def is_profile_requested(request):
+    '''
+    :param request: request with ?profile=1 or an X-Profile-Request: 1 header asks to be profiled
+    :return: True if profiling is on and a staff user asked for it else False
+    '''
+    if not settings.PROFILE_REQUESTS_ENABLED:
+        return False
+    if request.GET.get('profile') != '1' and request.META.get('HTTP_X_PROFILE_REQUEST') != '1':
+        return False
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_active and user.is_staff)
+
+
+def take_profile_slot():
+    '''
+    Count a profile against PROFILE_RATE_LIMIT profiles a minute, the count is kept in the default cache
+    so it is shared by the processes sharing CACHES, every process on the host with the file cache
+    :return: True if the request may be profiled else False
+    '''
+    key = 'request_profiles:{}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M'))
+    if cache.add(key, 1, 60):
+        return True
+    try:
+        return cache.incr(key) <= settings.PROFILE_RATE_LIMIT
+    except ValueError:  # expired between add and incr
+        return cache.add(key, 1, 60)
+
+
+def get_profile_path(name, extension='prof'):
+    '''
+    :param name: profile name
+    :param extension: prof for the pstats dump, json for its request details
+    :return: path under PROFILE_DIR, raises ValueError for names that are not profile names
+    '''
+    if not profile_name.match(name):
+        raise ValueError('Invalid profile name {}'.format(name))
+    return os.path.join(settings.PROFILE_DIR, '{}.{}'.format(name, extension))
+
+
+def save_profile(profiler, request, response, seconds):
+    '''
+    Store a request's profile and its details, profiles over PROFILE_MAX_BYTES are discarded
+    and the oldest are removed beyond PROFILE_MAX_FILES
+    :param profiler: cProfile.Profile that ran the request
+    :param request:
+    :param response:
+    :param seconds: time the request took
+    :return: profile name or None if it was too large to keep
+    '''
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    match = getattr(request, 'resolver_match', None)
+    name = '{}-{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+                             match.url_name if match and match.url_name else 'request', uuid.uuid4().hex[:8])
+    path = get_profile_path(name)
+    profiler.dump_stats(path)
+    if os.path.getsize(path) > settings.PROFILE_MAX_BYTES:
+        os.remove(path)
+        return None
+    with open(get_profile_path(name, 'json'), 'w') as details:
+        json.dump({'name': name, 'method': request.method, 'path': request.get_full_path(),
+                   'status': response.status_code, 'user': request.user.get_username(),
+                   'ms': round(seconds * 1000, 3), 'created': datetime.datetime.now().isoformat()}, details)
+    prune_profiles()
+    return name
+
+
+def prune_profiles():
+    '''
+    Remove the oldest profiles beyond PROFILE_MAX_FILES
+    :return: Void
+    '''
+    for details in list_profiles()[settings.PROFILE_MAX_FILES:]:
+        for extension in ('prof', 'json'):
+            try:
+                os.remove(get_profile_path(details['name'], extension))
+            except OSError:
+                pass
+
+
+def list_profiles():
+    '''
+    :return: list of stored profile details newest first e.g.
+    [{'name': ..., 'method': 'GET', 'path': '/bookings/...', 'status': 200, 'user': ..., 'ms': 812.5, 'created': ...}]
+    '''
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in os.listdir(settings.PROFILE_DIR):
+        name, extension = os.path.splitext(filename)
+        if extension != '.json' or not profile_name.match(name):
+            continue
+        try:
+            with open(os.path.join(settings.PROFILE_DIR, filename)) as details:
+                profiles.append(json.load(details))
+        except (OSError, ValueError):
+            continue
+    return sorted(profiles, key=lambda details: details['name'], reverse=True)
+
+
+def get_top_functions(name, limit=30, sort='cumulative'):
+    '''
+    :param name: profile name
+    :param limit: number of functions
+    :param sort: cumulative or tottime
+    :return: list of dicts {'function', 'calls', 'tottime', 'cumtime'} with times in ms, slowest first
+    raises ValueError or OSError if there is no such profile
+    '''
+    stats = pstats.Stats(get_profile_path(name)).stats
+    rows = [{'function': '{}:{}({})'.format(filename, line, function), 'calls': calls,
+             'tottime': round(tottime * 1000, 3), 'cumtime': round(cumtime * 1000, 3)}
+            for (filename, line, function), (primitive, calls, tottime, cumtime, callers) in stats.items()]
+    rows.sort(key=lambda row: row['cumtime' if sort == 'cumulative' else 'tottime'], reverse=True)
+    return rows[:limit]
@@ -1,17 +1,51 @@
+import collections
+import contextlib
 import datetime
-from unittest.mock import patch
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import Mock, patch
 
+import pytz
+import requests
 import responses
 from allauth.socialaccount.models import SocialAccount, SocialToken
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
 from django.test import RequestFactory
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from freezegun import freeze_time
 
+from bookings import asyncoutlookservice
+from bookings import authhelper
+from bookings import benchmarks
+from bookings import booking_grid
+from bookings import calendarsync
+from bookings import fakegraph
+from bookings import graphmetrics
+from bookings import httpclient
+from bookings import jobs
+from bookings import loadtest
+from bookings import outbox
 from bookings import outlookservice
+from bookings import profiling
+from bookings import timing
+from bookings.availability import FULL_DAY_MASK, EventIndex, EventRecord, build_availability_bitmap, \
+    parse_graph_datetime
 from bookings import views
-from .models import BookingAvailability, Event
+from .models import BookingAvailability, CalendarEventMirror, CalendarSyncState, Event, OutboxEmail, \
+    OutlookWriteJob
 
 
 class BookingDurationChoiceTests(TestCase):
@@ -168,8 +202,8 @@ class BookingBookMeetingSlotTests(TestCase):
     @patch('bookings.views.validate_recaptcha')
     @patch('bookings.views.render_to_string')
     @patch('bookings.views.book_event')
-    @patch('bookings.views.send_mail')
-    def test_book_meeting_slot_invalid_form(self, send_mail, book_event, render_string, captcha, booking_form,
+    @patch('bookings.views.queue_mail')
+    def test_book_meeting_slot_invalid_form(self, queue_mail, book_event, render_string, captcha, booking_form,
                                             token_patch):
         captcha.return_value = True
         booking_form().is_valid.return_value = True
@@ -181,12 +215,38 @@ class BookingBookMeetingSlotTests(TestCase):
         response = self.client.post(
             reverse('bookings:book_meeting_slot', args=[self.time, self.date_formatted, '1', '2']),
             data={}, follow=True)
-        send_mail.assert_called_with(subject='New Booking: sub', message='', from_email='imeetingbooker@gmail.com',
+        queue_mail.assert_called_with(subject='New Booking: sub', message='', from_email='imeetingbooker@gmail.com',
                           recipient_list=['test_email'], html_message='htmlMessage')
         self.assertRedirects(response,reverse('bookings:booking_confirmed', args=[1]))
         self.assertEqual(response.status_code, 200)
     # first_name =last_name = email =duration =subject =
 
+    @override_settings(OUTLOOK_ASYNC_WRITES=True)
+    @patch('bookings.views.set_new_token')
+    @patch('bookings.views.EventBookingForm')
+    @patch('bookings.views.validate_recaptcha')
+    @patch('bookings.views.render_to_string')
+    @patch('bookings.views.book_event')
+    @patch('bookings.views.queue_mail')
+    def test_book_meeting_slot_async_write(self, queue_mail, book_event, render_string, captcha, booking_form,
+                                           token_patch):
+        captcha.return_value = True
+        booking_form().is_valid.return_value = True
+        booking_form().save.return_value = Event(
+            first_name='fn',last_name='ln',email='em',duration=10,subject='sub'
+        )
+        render_string.return_value = 'htmlMessage'
+        response = self.client.post(
+            reverse('bookings:book_meeting_slot', args=[self.time, self.date_formatted, '1', '2']),
+            data={}, follow=True)
+        self.assertRedirects(response,reverse('bookings:booking_confirmed', args=[1]))
+        book_event.assert_not_called()
+        queue_mail.assert_not_called()
+        self.assertEqual(Event.objects.get().status, Event.PENDING)
+        job = OutlookWriteJob.objects.get()
+        self.assertEqual(job.action, OutlookWriteJob.BOOK)
+        self.assertEqual(job.get_payload()['mail']['subject'], 'New Booking: sub')
+
 
 class BookingAvailabilityModelTests(TestCase):
 
@@ -229,7 +289,7 @@ class BookingAvailabilityModelTests(TestCase):
                           datetime.date(2018, 2, 13), datetime.date(2018, 2, 14), datetime.date(2018, 2, 15),
                           datetime.date(2018, 2, 16)])
 
-    @patch('bookings.models.get_events_between_dates')
+    @patch('bookings.models.iter_cached_events_between_dates')
     @patch('bookings.models.set_new_token')
     @freeze_time("2018-02-10 10:21:34")
     def test_get_outlook_events(self, set_new_token_mock, get_events_call_mock):
@@ -276,6 +336,21 @@ class BookingAvailabilityModelTests(TestCase):
             self.assertNotIn('Fri 16/02/18', data_for_10AM_booking)
             self.assertIn('Fri 16/02/18', data_for_1030AM_booking)
 
+    def test_get_weekly_template(self):
+        self.booking_obj.lunch_from, self.booking_obj.lunch_to = datetime.time(12, 0), datetime.time(12, 30)
+        self.booking_obj.save()
+        week, lunch = self.booking_obj.get_weekly_template()
+        self.assertEqual(week, ((480, 960),) * 5 + (None, None))
+        self.assertEqual(lunch, (720, 750))
+
+    def test_get_weekly_template_invalidated_on_save(self):
+        self.booking_obj.get_weekly_template()
+        self.booking_obj.monday_to = datetime.time(18, 0)
+        self.assertEqual(self.booking_obj.get_weekly_template()[0][0], (480, 960))
+        self.booking_obj.save()
+        self.assertEqual(self.booking_obj.get_weekly_template()[0][0], (480, 1080))
+        self.assertEqual(self.booking_obj.get_time_ranges(), (datetime.time(8, 0), datetime.time(18, 0)))
+
     def test_get_day_availability_dict(self):
         dic = self.booking_obj.get_day_availability_dict()
         days = ['Monday{}', 'Tuesday{}', 'Wednesday{}', 'Thursday{}', 'Friday{}', 'Saturday{}', 'Sunday{}']
@@ -289,25 +364,25 @@ class BookingAvailabilityModelTests(TestCase):
     def test_slot_is_available_slot_in_past(self):
         past_time = datetime.time(10, 0)
         past_date = datetime.date(2018, 2, 8)
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=[]), False)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex([])), False)
 
     @freeze_time("2018-02-8 10:21:34")
     def test_slot_is_available_outside_booking_availabilty(self):
         past_time = datetime.time(10, 0)
         past_date = datetime.date(2018, 2, 10)
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=[]), False)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex([])), False)
 
     @freeze_time("2018-02-6 10:21:34")
     def test_slot_is_available_not_in_booking_availabilty(self):
         past_time = datetime.time(7, 0)
         past_date = datetime.date(2018, 2, 8)
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=[]), False)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex([])), False)
 
     @freeze_time("2018-02-6 10:21:34")
     def test_slot_is_available_slot_in_booking_availabilty(self):
         past_time = datetime.time(10, 0)
         past_date = datetime.date(2018, 2, 8)
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=[]), True)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex([])), True)
 
     @freeze_time("2018-02-4 10:21:34")
     def test_slot_is_available_slot_within_outlook_event(self):
@@ -315,7 +390,7 @@ class BookingAvailabilityModelTests(TestCase):
         past_date = datetime.date(2018, 2, 6)
         outlook_event = [{'start': datetime.datetime(2018, 2, 6, 10, 0), 'end': datetime.datetime(2018, 2, 6, 10, 30),
                           'is_all_day': False}]
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=outlook_event), False)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex(outlook_event)), False)
 
     @freeze_time("2018-02-4 10:21:34")
     def test_slot_is_available_slot_within_outlook_event_is_all_day(self):
@@ -323,7 +398,7 @@ class BookingAvailabilityModelTests(TestCase):
         past_date = datetime.date(2018, 2, 6)
         outlook_event = [{'start': datetime.datetime(2018, 2, 6, 10, 0), 'end': datetime.datetime(2018, 2, 6, 10, 30),
                           'is_all_day': True}]
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=outlook_event), False)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex(outlook_event)), False)
 
     @freeze_time("2018-02-4 10:21:34")
     def test_slot_is_available_slot_outside_outlook_event(self):
@@ -331,14 +406,14 @@ class BookingAvailabilityModelTests(TestCase):
         past_date = datetime.date(2018, 2, 6)
         outlook_event = [{'start': datetime.datetime(2018, 2, 6, 10, 0), 'end': datetime.datetime(2018, 2, 6, 10, 30),
                           'is_all_day': False}]
-        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=outlook_event), True)
+        self.assertEqual(self.booking_obj.slot_is_available(past_time, past_date, outlook_events=EventIndex(outlook_event)), True)
 
     @freeze_time("2018-02-4 10:21:34")
     def test_slot_is_available_in_short_break_slot(self):
         past_time = datetime.time(10, 15)
         past_date = datetime.date(2018, 2, 6)
         short_break_slots = [datetime.datetime(2018, 2, 6, 10, 15)]
-        outlook_event = []
+        outlook_event = EventIndex([])
         self.assertEqual(
             self.booking_obj.slot_is_available(past_time, past_date, outlook_event, short_break_slots), False
         )
@@ -354,7 +429,7 @@ class BookingAvailabilityModelTests(TestCase):
                           'is_all_day': False}
                          ]
         '''cluster each day into dict of lists for each list of lists we find breaks'''
-        output = [datetime.datetime(2018, 2, 6, 10, 15)]
+        output = {datetime.datetime(2018, 2, 6, 10, 15)}
         self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.booking_obj.get_next_7_days(datetime.date.today()),outlook_events), output)
 
     def test_get_day_events_dict(self):
@@ -371,6 +446,1351 @@ class BookingAvailabilityModelTests(TestCase):
         self.assertEqual(len(output[datetime.date(2018, 2, 7)]), 1)
 
 
+class AvailabilityBitmapTests(TestCase):
+
+    def setUp(self):
+        self.booking_obj = BookingAvailability(
+            monday_from=datetime.time(8, 0),
+            monday_to=datetime.time(16, 0),
+            tuesday_from=datetime.time(9, 15),
+            tuesday_to=datetime.time(17, 45),
+            wednesday_from=datetime.time(8, 0),
+            wednesday_to=datetime.time(12, 0),
+            friday_from=datetime.time(7, 0),
+            friday_to=datetime.time(19, 0),
+            saturday_from=datetime.time(10, 0),
+            saturday_to=datetime.time(14, 0),
+            lunch_from=datetime.time(12, 0),
+            lunch_to=datetime.time(13, 0),
+            availability_increment=15,
+            booking_duration=60,
+        )
+        self.days = self.booking_obj.get_next_7_days(datetime.date(2018, 2, 10))
+        self.events = [
+            {'start': datetime.datetime(2018, 2, 12, 9, 30), 'end': datetime.datetime(2018, 2, 12, 10, 0),
+             'is_all_day': False},
+            {'start': datetime.datetime(2018, 2, 12, 10, 10), 'end': datetime.datetime(2018, 2, 12, 10, 20),
+             'is_all_day': False},
+            {'start': datetime.datetime(2018, 2, 12, 10, 30), 'end': datetime.datetime(2018, 2, 12, 11, 0),
+             'is_all_day': False},
+            {'start': datetime.datetime(2018, 2, 13, 16, 0), 'end': datetime.datetime(2018, 2, 14, 9, 0),
+             'is_all_day': False},
+            {'start': datetime.datetime(2018, 2, 15, 0, 0), 'end': datetime.datetime(2018, 2, 16, 0, 0),
+             'is_all_day': True},
+            {'start': datetime.datetime(2018, 2, 16, 11, 7, 30), 'end': datetime.datetime(2018, 2, 16, 11, 52),
+             'is_all_day': False},
+        ]
+
+    def get_slot_by_slot_data(self, days, times, events):
+        event_index = EventIndex(events)
+        short_breaks = self.booking_obj.get_breaks_between_close_sets_of_events(days, event_index)
+        data = []
+        for time in times:
+            dic = {}
+            for day in days:
+                if self.booking_obj.slot_is_available(time.time(), day, event_index, short_breaks):
+                    dic[day.strftime('%a %d/%m/%y')] = time.time().strftime('%H:%M')
+            data.append(dic)
+        return data
+
+    @freeze_time("2018-02-10 11:21:34")
+    def test_get_day_time_availability_dict_matches_slot_checks(self):
+        for increment in [5, 10, 15, 20, 30, 40, 45, 60]:
+            self.booking_obj.availability_increment = increment
+            times = self.booking_obj.get_times_by_increment(*self.booking_obj.get_time_ranges())
+            with patch.object(self.booking_obj, 'get_outlook_events'), \
+                    patch.object(self.booking_obj, 'parse_outlook_events_into_dict', return_value=self.events):
+                data = self.booking_obj.get_day_time_availability_dict(self.days, times)
+            self.assertEqual(data, self.get_slot_by_slot_data(self.days, times, self.events))
+
+    @freeze_time("2018-02-12 10:21:34")
+    def test_build_availability_bitmap_blocks(self):
+        bitmap = build_availability_bitmap(self.booking_obj, self.days, self.events)
+        monday = datetime.date(2018, 2, 12)
+        self.assertFalse(bitmap.is_free(monday, 10 * 60 + 15))  # past
+        self.assertTrue(bitmap.is_free(monday, 11 * 60))
+        self.assertFalse(bitmap.is_free(monday, 12 * 60 + 30))  # lunch
+        self.assertFalse(bitmap.is_free(monday, 16 * 60))  # outside availability
+        self.assertEqual(bitmap.day_mask(datetime.date(2018, 2, 15)), FULL_DAY_MASK)  # all day event
+        self.assertEqual(bitmap.day_mask(datetime.date(2018, 2, 11)), FULL_DAY_MASK)  # no sunday availability
+
+    @freeze_time("2018-02-10 11:21:34")
+    def test_get_free_slots_on_day_matches_week_grid(self):
+        event_index = EventIndex(self.events)
+        grid = self.booking_obj.get_time_slot_data(self.days[0], format=False, event_index=event_index)
+        for day in self.days:
+            self.assertEqual(self.booking_obj.get_free_slots_on_day(day, event_index),
+                             [slot[day] for slot in grid if day in slot])
+
+    @freeze_time("2018-02-10 11:21:34")
+    def test_get_longest_free_run(self):
+        event_index = EventIndex(self.events)
+        monday = datetime.datetime(2018, 2, 12)
+        self.assertEqual(self.booking_obj.get_longest_free_run(monday.replace(hour=8), event_index), 60)
+        self.assertEqual(self.booking_obj.get_longest_free_run(monday.replace(hour=9), event_index), 30)
+        self.assertEqual(self.booking_obj.get_longest_free_run(monday.replace(hour=9, minute=30), event_index), 0)
+        self.assertEqual(self.booking_obj.get_longest_free_run(monday.replace(hour=15, minute=30), event_index), 30)
+        moved_event = (monday.replace(hour=9, minute=30), monday.replace(hour=10))
+        self.assertEqual(self.booking_obj.get_longest_free_run(monday.replace(hour=9), event_index, moved_event), 60)
+        self.assertEqual(self.booking_obj.get_longest_free_run(monday.replace(hour=9, minute=30), event_index,
+                                                               moved_event), 30)
+
+    @freeze_time("2018-02-10 11:21:34")
+    def test_duration_choices_follow_longest_free_run(self):
+        event_index = EventIndex(self.events)
+        monday = datetime.datetime(2018, 2, 12)
+        for hour, minute in [(8, 0), (9, 0), (9, 30), (15, 30)]:
+            start = monday.replace(hour=hour, minute=minute)
+            form = views.EventBookingForm(date=start, booking_availability=self.booking_obj, event_index=event_index)
+            longest_run = self.booking_obj.get_longest_free_run(start, event_index)
+            self.assertEqual(form.fields['duration'].choices,
+                             [(duration, duration) for duration in range(15, longest_run + 1, 15)])
+
+    @freeze_time("2018-02-10 11:21:34")
+    def test_duration_choices_reject_a_recently_booked_slot(self):
+        form = views.EventBookingForm(date=datetime.datetime(2018, 2, 12, 9, 30), booking_availability=self.booking_obj,
+                                      event_index=EventIndex(self.events),
+                                      data={'date_time': '2018-02-12 09:30', 'first_name': 'Ann', 'last_name': 'Lee',
+                                            'email': 'ann.lee@kcl.ac.uk', 'duration': 15, 'subject': 'Catch up'})
+        self.assertEqual(form.fields['duration'].choices, [])
+        self.assertIn('duration', form.errors)
+
+    def test_day_queries_fetch_only_the_day(self):
+        with patch.object(self.booking_obj, 'get_outlook_events', return_value={'value': []}) as outlook_events:
+            self.booking_obj.get_free_slots_on_day(datetime.date(2018, 2, 12))
+        outlook_events.assert_called_once_with([datetime.date(2018, 2, 12), datetime.date(2018, 2, 13)])
+
+
+class ShortBreakTests(TestCase):
+
+    def setUp(self):
+        self.booking_obj = BookingAvailability(availability_increment=15, booking_duration=60)
+        self.days = self.booking_obj.get_next_7_days(datetime.date(2018, 2, 10))
+
+    def get_breaks_by_scan(self, days, events):
+        '''previous implementation, flat list and a three event guard over the whole week'''
+        break_slots = []
+        day_events_dict = self.booking_obj.get_day_events_dict(events)
+        for day in days:
+            if day_events_dict.get(day):
+                day_events = day_events_dict.get(day)
+                if len(events) < 3:
+                    continue
+                cumulative_difference = 0
+                possible_times = []
+                previous_event_end_time = day_events[0]['end']
+                for event in day_events[1:]:
+                    diff_in_minutes = int((event['start'] - previous_event_end_time).seconds / 60)
+                    if 0 < diff_in_minutes <= 15:
+                        possible_times.append(previous_event_end_time)
+                        cumulative_difference += diff_in_minutes
+                    previous_event_end_time = event['end']
+                if cumulative_difference > 20:
+                    continue
+                break_slots.append(possible_times)
+        return [inner for outer in break_slots for inner in outer]
+
+    def get_random_events(self, generator):
+        events = []
+        for day in self.days:
+            count = generator.choice([0, 3, 4, 6])
+            start = datetime.datetime.combine(day, datetime.time(8, 0))
+            for _ in range(count):
+                start += datetime.timedelta(minutes=generator.choice([-20, 0, 5, 10, 15, 16, 30, 90]))
+                end = start + datetime.timedelta(minutes=generator.choice([15, 30, 45, 60]))
+                events.append({'start': start, 'end': end, 'is_all_day': False})
+                start = end
+        return sorted(events, key=lambda event: event['start'])
+
+    def test_matches_previous_implementation_on_sorted_input(self):
+        generator = random.Random(17)
+        for _ in range(200):
+            events = self.get_random_events(generator)
+            expected = self.get_breaks_by_scan(self.days, events)
+            self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.days, events), set(expected))
+            self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.days, EventIndex(events)),
+                             set(expected))
+
+    def test_three_event_guard_is_per_day(self):
+        events = [{'start': datetime.datetime(2018, 2, 12, 9, 0), 'end': datetime.datetime(2018, 2, 12, 9, 30),
+                   'is_all_day': False},
+                  {'start': datetime.datetime(2018, 2, 12, 9, 40), 'end': datetime.datetime(2018, 2, 12, 10, 0),
+                   'is_all_day': False},
+                  {'start': datetime.datetime(2018, 2, 13, 9, 0), 'end': datetime.datetime(2018, 2, 13, 10, 0),
+                   'is_all_day': False}]
+        self.assertEqual(self.get_breaks_by_scan(self.days, events), [datetime.datetime(2018, 2, 12, 9, 30)])
+        self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.days, events), set())
+
+    def test_unsorted_input_and_thresholds(self):
+        events = [{'start': datetime.datetime(2018, 2, 12, 10, 0) + datetime.timedelta(minutes=minute),
+                   'end': datetime.datetime(2018, 2, 12, 10, 20) + datetime.timedelta(minutes=minute),
+                   'is_all_day': False} for minute in [60, 0, 30]]
+        breaks = {datetime.datetime(2018, 2, 12, 10, 20), datetime.datetime(2018, 2, 12, 10, 50)}
+        self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.days, events), breaks)
+        self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.days, events, max_gap=5),
+                         set())
+        self.assertEqual(self.booking_obj.get_breaks_between_close_sets_of_events(self.days, events, max_total=15),
+                         set())
+
+
+class EventIndexTests(TestCase):
+
+    def setUp(self):
+        random.seed(7)
+        base = datetime.datetime(2018, 2, 12, 7, 0)
+        self.events = []
+        for num in range(60):
+            start = base + datetime.timedelta(minutes=random.randrange(0, 5 * 24 * 60, 5))
+            self.events.append({'start': start, 'end': start + datetime.timedelta(minutes=random.randrange(5, 240, 5)),
+                                'is_all_day': num % 20 == 0})
+        self.index = EventIndex(self.events)
+
+    def clashes_linearly(self, datetime_obj, increment):
+        for event in self.events:
+            if event['is_all_day'] and event['start'].date() == datetime_obj.date():
+                return True
+            if event['start'] <= datetime_obj < event['end']:
+                return True
+            if event['start'] < datetime_obj + datetime.timedelta(minutes=increment) <= event['end']:
+                return True
+        return False
+
+    def test_clashes_with_slot_matches_linear_scan(self):
+        slot = datetime.datetime(2018, 2, 11, 0, 0)
+        while slot < datetime.datetime(2018, 2, 19, 0, 0):
+            for increment in [5, 20, 45]:
+                self.assertEqual(self.index.clashes_with_slot(slot, increment), self.clashes_linearly(slot, increment))
+            slot += datetime.timedelta(minutes=5)
+
+    def test_events_sorted_and_bucketed_by_day(self):
+        self.assertEqual([event['start'] for event in self.index], sorted(event['start'] for event in self.events))
+        self.assertEqual(sum(len(self.index.events_on(day)) for day in self.index.events_by_day), len(self.events))
+        for day, day_events in self.index.events_by_day.items():
+            self.assertTrue(all(event['start'].date() == day for event in day_events))
+
+    def test_parse_graph_datetime(self):
+        with patch('dateutil.parser.parse') as dateutil_parse:
+            self.assertEqual(parse_graph_datetime('2018-02-16T10:00:00.0000000'), datetime.datetime(2018, 2, 16, 10, 0))
+            self.assertEqual(parse_graph_datetime('2018-02-16T10:00:05.1234567'),
+                             datetime.datetime(2018, 2, 16, 10, 0, 5, 123456))
+            self.assertEqual(parse_graph_datetime('2018-02-16T10:00:00'), datetime.datetime(2018, 2, 16, 10, 0))
+        dateutil_parse.assert_not_called()
+        # other formats fall back to dateutil
+        self.assertEqual(parse_graph_datetime('2018-02-16T10:00:00Z').replace(tzinfo=None),
+                         datetime.datetime(2018, 2, 16, 10, 0))
+        self.assertEqual(parse_graph_datetime('16 Feb 2018 10:00'), datetime.datetime(2018, 2, 16, 10, 0))
+
+    def test_event_record_reads_like_parsed_dict(self):
+        event = {'start': datetime.datetime(2018, 2, 16, 11, 7, 30), 'end': datetime.datetime(2018, 2, 17, 0, 0),
+                 'is_all_day': False}
+        record = EventRecord.from_datetimes(event['start'], event['end'])
+        self.assertEqual(record, event)
+        self.assertEqual((record['start'], record.get('end'), record.get('missing', 1)),
+                         (event['start'], event['end'], 1))
+        self.assertEqual(record.start_date, datetime.date(2018, 2, 16))
+        self.assertEqual(EventRecord.from_graph({'start': {'dateTime': '2018-02-16T11:07:30.0000000'},
+                                                 'end': {'dateTime': '2018-02-17T00:00:00.0000000'}}), record)
+        with self.assertRaises(AttributeError):
+            record.subject = 'records have no __dict__'
+
+
+class CalendarCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def get_cached_events(self, user_email, start_date, end_date):
+        return list(outlookservice.iter_cached_events_between_dates('token', user_email, start_date, end_date))
+
+    @responses.activate
+    def test_iter_cached_events_between_dates_hit(self):
+        responses.add(responses.GET, 'https://graph.microsoft.com/v1.0/me/calendarview', json={'value': [
+            {'id': '1', 'start': {'dateTime': '2018-02-12T10:00:00'}, 'end': {'dateTime': '2018-02-12T11:00:00'},
+             'isAllDay': False}]}, status=200)
+        first = self.get_cached_events('email', '2018-02-10', '2018-02-17')
+        second = self.get_cached_events('email', '2018-02-10', '2018-02-17')
+        self.assertEqual(first, second)
+        self.assertEqual(first, [{'start': {'dateTime': '2018-02-12T10:00:00'},
+                                  'end': {'dateTime': '2018-02-12T11:00:00'}, 'isAllDay': False}])
+        self.assertEqual(len(responses.calls), 1)
+        self.get_cached_events('email', '2018-02-17', '2018-02-24')
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_iter_cached_events_between_dates_errors_not_cached(self):
+        responses.add(responses.GET, 'https://graph.microsoft.com/v1.0/me/calendarview', json={'error': 'throttled'},
+                      status=429)
+        for attempt in range(2):
+            with self.assertRaises(requests.HTTPError):
+                self.get_cached_events('email', '2018-02-10', '2018-02-17')
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_iter_cached_events_between_dates_streams_pages(self):
+        url = 'https://graph.microsoft.com/v1.0/me/calendarview'
+        event = {'start': {'dateTime': '2018-02-12T10:00:00'}, 'end': {'dateTime': '2018-02-12T11:00:00'},
+                 'isAllDay': False}
+        responses.add(responses.GET, url, json={'value': [event], '@odata.nextLink': url + '?skip=1'}, status=200)
+        responses.add(responses.GET, url, json={'value': [event]}, status=200)
+        events = outlookservice.iter_cached_events_between_dates('token', 'email', '2018-02-10', '2018-02-17')
+        self.assertEqual(next(events), event)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(list(events), [event])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(self.get_cached_events('email', '2018-02-10', '2018-02-17'), [event, event])
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @freeze_time("2018-02-4 10:21:34")
+    def test_writes_invalidate_cached_events(self):
+        responses.add(responses.GET, 'https://graph.microsoft.com/v1.0/me/calendarview', json={'value': []},
+                      status=200)
+        responses.add(responses.POST, 'https://graph.microsoft.com/v1.0/me/events', json={'id': '5'}, status=201)
+        responses.add(responses.DELETE, 'https://graph.microsoft.com/v1.0/me/events/5', status=204)
+        start = datetime.datetime.now()
+        event = {'subject': 'test', 'start_time': start, 'end_time': start + datetime.timedelta(hours=1),
+                 'email': 'email', 'first_name': 'name'}
+        self.get_cached_events('email', '2018-02-04', '2018-02-11')
+        outlookservice.book_event('token', 'email', event, 'content')
+        self.get_cached_events('email', '2018-02-04', '2018-02-11')
+        outlookservice.cancel_booking('token', 'email', '5')
+        self.get_cached_events('email', '2018-02-04', '2018-02-11')
+        self.get_cached_events('other_email', '2018-02-04', '2018-02-11')
+        self.get_cached_events('other_email', '2018-02-04', '2018-02-11')
+        self.assertEqual([call.request.method for call in responses.calls],
+                         ['GET', 'POST', 'GET', 'DELETE', 'GET', 'GET'])
+
+    def test_invalidation_seen_by_other_processes(self):
+        outlookservice.invalidate_calendar_cache('email')
+        version = subprocess.check_output([sys.executable, '-c', 'import django; django.setup(); '
+                                           'from bookings.outlookservice import get_calendar_cache_version; '
+                                           'print(get_calendar_cache_version("email"))'], cwd=settings.BASE_DIR)
+        self.assertEqual(int(version), outlookservice.get_calendar_cache_version('email'))
+
+
+class CalendarMirrorSyncTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='test_user', password='test_password', email='test_email')
+        self.social_account = SocialAccount.objects.create(user=self.user, provider="microsoft")
+        self.delta_url = 'https://graph.microsoft.com/v1.0/me/calendarview/delta'
+
+    def graph_event(self, outlook_id, start, end, is_all_day=False):
+        return {'id': outlook_id, 'isAllDay': is_all_day,
+                'start': {'dateTime': start + ':00.0000000', 'timeZone': 'Europe/London'},
+                'end': {'dateTime': end + ':00.0000000', 'timeZone': 'Europe/London'}}
+
+    @responses.activate
+    @freeze_time("2018-02-10 10:21:34")
+    def test_sync_calendar_mirror_full_then_delta(self):
+        responses.add(responses.GET, self.delta_url, status=200, json={
+            'value': [self.graph_event('a', '2018-02-12T09:00', '2018-02-12T10:00')],
+            '@odata.nextLink': self.delta_url + '?$skiptoken=1'})
+        responses.add(responses.GET, self.delta_url, status=200, json={
+            'value': [self.graph_event('b', '2018-02-13T11:00', '2018-02-13T11:30')],
+            '@odata.deltaLink': self.delta_url + '?$deltatoken=1'})
+        responses.add(responses.GET, self.delta_url, status=200, json={
+            'value': [{'id': 'a', '@removed': {'reason': 'deleted'}},
+                      self.graph_event('c', '2018-02-14T00:00', '2018-02-15T00:00', is_all_day=True)],
+            '@odata.deltaLink': self.delta_url + '?$deltatoken=2'})
+        self.assertTrue(calendarsync.sync_calendar_mirror(self.social_account, 'token'))
+        self.assertEqual(set(CalendarEventMirror.objects.values_list('outlook_id', flat=True)), {'a', 'b'})
+        self.assertTrue(calendarsync.sync_calendar_mirror(self.social_account, 'token'))
+        self.assertEqual(responses.calls[2].request.url, self.delta_url + '?$deltatoken=1')
+        self.assertEqual(set(CalendarEventMirror.objects.values_list('outlook_id', flat=True)), {'b', 'c'})
+        events = CalendarEventMirror.get_events_between_dates(self.social_account, datetime.date(2018, 2, 10),
+                                                              datetime.date(2018, 2, 17))
+        self.assertEqual(events['value'], [
+            {'start': {'dateTime': '2018-02-13T11:00:00'}, 'end': {'dateTime': '2018-02-13T11:30:00'},
+             'isAllDay': False},
+            {'start': {'dateTime': '2018-02-14T00:00:00'}, 'end': {'dateTime': '2018-02-15T00:00:00'},
+             'isAllDay': True}])
+
+    @responses.activate
+    @freeze_time("2018-02-10 10:21:34")
+    def test_mirror_stale_after_write_or_max_age(self):
+        responses.add(responses.GET, self.delta_url, status=200, json={
+            'value': [], '@odata.deltaLink': self.delta_url + '?$deltatoken=1'})
+        calendarsync.sync_calendar_mirror(self.social_account, 'token')
+        dates = (datetime.date(2018, 2, 10), datetime.date(2018, 2, 17))
+        self.assertEqual(CalendarEventMirror.get_events_between_dates(self.social_account, *dates), {'value': []})
+        self.assertIsNone(CalendarEventMirror.get_events_between_dates(self.social_account, datetime.date(2018, 2, 9),
+                                                                       datetime.date(2018, 2, 17)))
+        outlookservice.invalidate_calendar_cache('test_email')
+        self.assertIsNone(CalendarEventMirror.get_events_between_dates(self.social_account, *dates))
+        calendarsync.sync_calendar_mirror(self.social_account, 'token')
+        with freeze_time("2018-02-10 10:30:00"):
+            self.assertIsNone(CalendarEventMirror.get_events_between_dates(self.social_account, *dates))
+
+    @responses.activate
+    @freeze_time("2018-02-10 10:21:34")
+    def test_mirror_stale_after_write_in_another_process(self):
+        responses.add(responses.GET, self.delta_url, status=200, json={
+            'value': [], '@odata.deltaLink': self.delta_url + '?$deltatoken=1'})
+        calendarsync.sync_calendar_mirror(self.social_account, 'token')
+        dates = (datetime.date(2018, 2, 10), datetime.date(2018, 2, 17))
+        outlookservice.invalidate_calendar_cache('test_email')
+        cache.clear()  # a process whose cache never saw the write
+        self.assertIsNone(CalendarEventMirror.get_events_between_dates(self.social_account, *dates))
+        calendarsync.sync_calendar_mirror(self.social_account, 'token')
+        self.assertEqual(CalendarEventMirror.get_events_between_dates(self.social_account, *dates), {'value': []})
+
+    @responses.activate
+    @freeze_time("2018-02-10 10:21:34")
+    def test_mirror_covers_longest_booking_horizon(self):
+        responses.add(responses.GET, self.delta_url, status=200, json={
+            'value': [self.graph_event('a', '2018-04-06T09:00', '2018-04-06T10:00')],
+            '@odata.deltaLink': self.delta_url + '?$deltatoken=1'})
+        calendarsync.sync_calendar_mirror(self.social_account, 'token')
+        booking_availability = benchmarks.make_preferences(15, account_social=self.social_account)
+        booking_availability.save()
+        with patch('bookings.models.get_cached_events_for_windows') as graph_patch:
+            event_index = booking_availability.get_horizon_event_index(datetime.date(2018, 2, 10),
+                                                                       settings.BOOKING_HORIZON_MAX_WEEKS)
+        graph_patch.assert_not_called()
+        self.assertEqual(len(event_index), 1)
+
+    @responses.activate
+    @freeze_time("2018-02-10 10:21:34")
+    def test_sync_calendar_mirror_expired_delta_link(self):
+        responses.add(responses.GET, self.delta_url, status=410, json={'error': 'syncStateNotFound'})
+        CalendarSyncState.objects.create(social_account=self.social_account, delta_link=self.delta_url + '?t=1')
+        self.assertFalse(calendarsync.sync_calendar_mirror(self.social_account, 'token'))
+        self.assertEqual(CalendarSyncState.objects.get().delta_link, '')
+
+
+class HttpClientTests(TestCase):
+
+    def tearDown(self):
+        httpclient.close_session()
+
+    def test_get_session_shared(self):
+        session = httpclient.get_session()
+        self.assertIs(httpclient.get_session(), session)
+        adapter = session.get_adapter('https://graph.microsoft.com')
+        self.assertEqual(adapter._pool_maxsize, settings.HTTP_POOL_MAXSIZE)
+        httpclient.close_session()
+        self.assertIsNot(httpclient.get_session(), session)
+
+    def test_make_api_call_uses_pooled_session_with_timeouts(self):
+        with patch.object(httpclient.get_session(), 'request') as request:
+            request.return_value.status_code = 200
+            outlookservice.make_api_call('patch', 'https://graph.microsoft.com/v1.0/me/events/5', 'token', 'email',
+                                         payload={'subject': 'test'})
+        args, kwargs = request.call_args
+        self.assertEqual(args, ('PATCH', 'https://graph.microsoft.com/v1.0/me/events/5'))
+        self.assertEqual(kwargs['timeout'], (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+        self.assertEqual(kwargs['data'], '{"subject": "test"}')
+        self.assertEqual(kwargs['headers']['Content-Type'], 'application/json')
+
+
+class AsyncGraphClientTests(TestCase):
+
+    def test_get_events_for_windows_bounded_concurrency(self):
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'max': 0}
+
+        def get_events(access_token, user_email, start_date, end_date):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['now'])
+            time.sleep(0.02)
+            with lock:
+                in_flight['now'] -= 1
+            return {'value': [], 'window': (user_email, start_date)}
+
+        windows = [('token', 'email{}'.format(num), '2018-02-{:02d}'.format(num), 'end') for num in range(1, 11)]
+        with patch('bookings.asyncoutlookservice.get_cached_events_between_dates', side_effect=get_events):
+            results = asyncoutlookservice.get_events_for_windows(windows, max_concurrency=3)
+        self.assertEqual([response['window'] for response in results], [window[1:3] for window in windows])
+        self.assertEqual(in_flight['max'], 3)
+
+    @responses.activate
+    def test_get_cached_events_between_dates_error(self):
+        responses.add(responses.GET, 'https://graph.microsoft.com/v1.0/me/calendarview', json={'error': 'throttled'},
+                      status=429)
+        self.assertEqual(asyncoutlookservice.get_cached_events_between_dates('token', 'email', 'date1', 'date2'),
+                         '429: {"error": "throttled"}')
+
+    @patch('bookings.outlookservice.cancel_booking', return_value=True)
+    @patch('bookings.outlookservice.book_event', return_value={'id': '1'})
+    def test_async_writes(self, book_event, cancel_booking):
+        client = asyncoutlookservice.AsyncGraphClient()
+
+        async def book_then_cancel():
+            booked = await client.book_event('token', 'email', {'subject': 'test'}, 'content')
+            cancelled = await client.cancel_booking('token', 'email', booked['id'])
+            return booked, cancelled
+
+        self.assertEqual(asyncoutlookservice.run_sync(book_then_cancel()), ({'id': '1'}, True))
+        book_event.assert_called_with('token', 'email', {'subject': 'test'}, 'content')
+        cancel_booking.assert_called_with('token', 'email', '1')
+
+
+class GraphBatchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.batch_url = 'https://graph.microsoft.com/v1.0/$batch'
+
+    @responses.activate
+    def test_send_maps_responses_by_id(self):
+        responses.add(responses.POST, self.batch_url, status=200, json={'responses': [
+            {'id': '2', 'status': 424, 'body': {'error': 'failed dependency'}},
+            {'id': '1', 'status': 400, 'body': {'error': 'bad request'}},
+        ]})
+        batch = outlookservice.GraphBatch('token', 'email')
+        create_id = batch.add('POST', '/me/events', payload={'subject': 'test'})
+        read_id = batch.add('GET', '/me/calendarview', parameters={'startdatetime': 'date1'}, depends_on=[create_id])
+        result = batch.send()
+        self.assertEqual(result[create_id]['status'], 400)
+        self.assertEqual(result[read_id]['body'], {'error': 'failed dependency'})
+        self.assertFalse(batch.is_success(read_id))
+        sent = json.loads(responses.calls[0].request.body)['requests']
+        self.assertEqual(sent[0]['body'], {'subject': 'test'})
+        self.assertEqual(sent[1]['url'], '/me/calendarview?startdatetime=date1')
+        self.assertEqual(sent[1]['dependsOn'], ['1'])
+
+    def test_add_limits(self):
+        batch = outlookservice.GraphBatch('token', 'email')
+        with self.assertRaises(ValueError):
+            batch.add('GET', '/me/events', depends_on=['1'])
+        for num in range(20):
+            batch.add('GET', '/me/events')
+        with self.assertRaises(ValueError):
+            batch.add('GET', '/me/events')
+
+    @responses.activate
+    def test_writes_invalidate_cache(self):
+        responses.add(responses.POST, self.batch_url, status=200, json={'responses': [
+            {'id': '1', 'status': 204}, {'id': '2', 'status': 404, 'body': {'error': 'not found'}}]})
+        version = outlookservice.get_calendar_cache_version('email')
+        batch = outlookservice.GraphBatch('token', 'email')
+        deleted, missing = batch.add('DELETE', '/me/events/a'), batch.add('DELETE', '/me/events/b')
+        batch.send()
+        self.assertEqual((batch.is_success(deleted), batch.is_success(missing)), (True, False))
+        self.assertEqual(outlookservice.get_calendar_cache_version('email'), version + 1)
+
+    @responses.activate
+    def test_get_events_for_windows(self):
+        responses.add(responses.POST, self.batch_url, status=200, json={'responses': [
+            {'id': '1', 'status': 200, 'body': {'value': [{'id': 1}],
+                                                '@odata.nextLink': 'https://graph.microsoft.com/v1.0/me/calendarview'}},
+            {'id': '2', 'status': 429, 'body': {'error': 'throttled'}}]})
+        responses.add(responses.GET, 'https://graph.microsoft.com/v1.0/me/calendarview', json={'value': [{'id': 2}]},
+                      status=200)
+        result = outlookservice.get_events_for_windows('token', 'email', [('date1', 'date2'), ('date2', 'date3')])
+        self.assertEqual(result, [{'value': [{'id': 1}, {'id': 2}]}, '429: {"error": "throttled"}'])
+
+    @responses.activate
+    def test_get_events_for_windows_follows_pages_concurrently(self):
+        url = 'https://graph.microsoft.com/v1.0/me/calendarview'
+        responses.add(responses.POST, self.batch_url, status=200, json={'responses': [
+            {'id': '1', 'status': 200, 'body': {'value': [{'id': 1}], '@odata.nextLink': url + '?week=1'}},
+            {'id': '2', 'status': 200, 'body': {'value': [{'id': 3}], '@odata.nextLink': url + '?week=2'}},
+            {'id': '3', 'status': 200, 'body': {'value': [{'id': 5}]}}]})
+        responses.add(responses.GET, url, json={'value': [{'id': 2}]}, status=200)
+        windows = [('date1', 'date2'), ('date2', 'date3'), ('date3', 'date4')]
+        with patch('bookings.asyncoutlookservice.get_next_pages', wraps=asyncoutlookservice.get_next_pages) as pages:
+            result = outlookservice.get_events_for_windows('token', 'email', windows)
+        pages.assert_called_once_with([('token', 'email', url + '?week=1'), ('token', 'email', url + '?week=2')])
+        self.assertEqual(result, [{'value': [{'id': 1}, {'id': 2}]}, {'value': [{'id': 3}, {'id': 2}]},
+                                  {'value': [{'id': 5}]}])
+
+
+class TokenManagerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='test_user', password='test_password', email='test_email')
+        self.social_account = SocialAccount.objects.create(user=self.user, provider="microsoft")
+        self.social_token = SocialToken.objects.create(account=self.social_account, app_id=1, token='old',
+                                                       token_secret='refresh', expires_at=timezone.now())
+
+    def test_get_social_token_cached(self):
+        token_obj = authhelper.get_social_token(self.social_account)
+        with self.assertNumQueries(0):
+            cached = authhelper.get_social_token(self.social_account)
+        self.assertEqual(cached.token, 'old')
+        self.assertIsNot(cached, token_obj)
+        self.social_token.token = 'new'
+        self.social_token.save()
+        self.assertEqual(authhelper.get_social_token(self.social_account).token, 'new')
+
+    @patch('bookings.authhelper.get_new_access_token_from_refresh_token')
+    def test_refresh_expired_token(self, refresh_patch):
+        refresh_patch.return_value = {'access_token': 'new', 'refresh_token': 'new_refresh'}
+        token_obj = authhelper.get_social_token(self.social_account)
+        token_obj.expires_at = timezone.now() - datetime.timedelta(minutes=1)
+        authhelper.refresh_expired_token(token_obj, 'uri')
+        refresh_patch.assert_called_once_with('refresh', 'uri')
+        self.assertEqual(token_obj.token, 'new')
+        self.assertEqual(SocialToken.objects.get().token_secret, 'new_refresh')
+        with self.assertNumQueries(0):
+            self.assertEqual(authhelper.get_social_token(self.social_account).token, 'new')
+
+    @patch('bookings.authhelper.get_new_access_token_from_refresh_token')
+    def test_refresh_single_flight_waits_for_running_refresh(self, refresh_patch):
+        lock_key = 'outlook_token_refresh:{}'.format(self.social_account.pk)
+        cache.add(lock_key, 1)
+        SocialToken.objects.filter(pk=self.social_token.pk).update(token='refreshed_elsewhere')
+        threading.Timer(0.2, cache.delete, args=[lock_key]).start()
+        authhelper.refresh_access_token(self.social_token, 'uri')
+        refresh_patch.assert_not_called()
+        self.assertEqual(self.social_token.token, 'refreshed_elsewhere')
+
+    @patch('bookings.authhelper.get_new_access_token_from_refresh_token')
+    def test_refresh_locks_token_row(self, refresh_patch):
+        refresh_patch.return_value = {'access_token': 'new', 'refresh_token': 'new_refresh'}
+        with patch.object(SocialToken.objects, 'select_for_update',
+                          wraps=SocialToken.objects.select_for_update) as lock_patch:
+            authhelper.refresh_access_token(self.social_token, 'uri')
+        lock_patch.assert_called_once_with()
+        self.assertEqual(self.social_token.token, 'new')
+
+    @patch('bookings.authhelper.get_new_access_token_from_refresh_token')
+    def test_refresh_skipped_when_already_refreshed(self, refresh_patch):
+        SocialToken.objects.filter(pk=self.social_token.pk).update(
+            token='refreshed_elsewhere', expires_at=timezone.now() + datetime.timedelta(hours=1))
+        authhelper.refresh_access_token(self.social_token, 'uri')
+        refresh_patch.assert_not_called()
+        self.assertEqual(self.social_token.token, 'refreshed_elsewhere')
+
+    @patch('bookings.authhelper.refresh_access_token')
+    @patch('bookings.authhelper.refresh_access_token_in_background')
+    def test_refresh_near_expiry_in_background(self, background_patch, refresh_patch):
+        self.social_token.expires_at = timezone.now() + datetime.timedelta(seconds=60)
+        authhelper.refresh_expired_token(self.social_token, 'uri')
+        background_patch.assert_called_once_with(self.social_token, 'uri')
+        refresh_patch.assert_not_called()
+        self.social_token.expires_at = timezone.now() + datetime.timedelta(hours=1)
+        authhelper.refresh_expired_token(self.social_token, 'uri')
+        self.assertEqual(background_patch.call_count, 1)
+
+
+class OutboxTests(TestCase):
+
+    def queue(self, subject='New Booking: sub'):
+        return outbox.queue_mail(subject=subject, message='', from_email='imeetingbooker@gmail.com',
+                                 recipient_list=['test@kcl.ac.uk'], html_message='<p>booked</p>')
+
+    def test_drain_outbox_sends_batch_over_one_connection(self):
+        for index in range(3):
+            self.queue('Booking {}'.format(index))
+        with patch('django.core.mail.backends.locmem.EmailBackend.open') as open_connection:
+            self.assertEqual(outbox.drain_outbox(), (3, 0))
+        self.assertEqual(open_connection.call_count, 1)
+        self.assertEqual([message.subject for message in mail.outbox], ['Booking 0', 'Booking 1', 'Booking 2'])
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>booked</p>', 'text/html')])
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.SENT).exists())
+
+    def test_drain_outbox_batch_size(self):
+        for index in range(3):
+            self.queue()
+        self.assertEqual(outbox.drain_outbox(batch_size=2), (2, 0))
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.PENDING).count(), 1)
+
+    def test_drain_outbox_retries_with_backoff(self):
+        with freeze_time('2018-02-10 10:00:00'):
+            email = self.queue()
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('refused')):
+            with freeze_time('2018-02-10 10:00:00'):
+                self.assertEqual(outbox.drain_outbox(), (0, 1))
+                email.refresh_from_db()
+                self.assertEqual(email.next_attempt_at, timezone.now() + datetime.timedelta(seconds=30))
+                self.assertEqual(outbox.drain_outbox(), (0, 0))  # not due yet
+            with freeze_time('2018-02-10 10:00:30'):
+                self.assertEqual(outbox.drain_outbox(), (0, 1))
+                email.refresh_from_db()
+                self.assertEqual(email.next_attempt_at, timezone.now() + datetime.timedelta(seconds=60))
+        self.assertEqual(email.attempts, 2)
+        self.assertIn('refused', email.last_error)
+        with freeze_time('2018-02-10 10:01:30'):
+            self.assertEqual(outbox.drain_outbox(), (1, 0))
+
+    def test_drain_outbox_skips_emails_claimed_by_another_run(self):
+        email = self.queue()
+        self.assertTrue(outbox.claim_email(OutboxEmail.objects.get(pk=email.pk)))
+        self.assertFalse(outbox.claim_email(email))  # read before the other run claimed it
+        self.assertEqual(outbox.drain_outbox(), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_drain_outbox_resends_email_left_sending(self):
+        with freeze_time('2018-02-10 10:00:00'):
+            email = self.queue()
+            outbox.claim_email(email)  # run died before sending
+            self.assertEqual(outbox.drain_outbox(), (0, 0))
+        with freeze_time('2018-02-10 10:10:00'):
+            self.assertEqual(outbox.drain_outbox(), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboxEmail.SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_drain_outbox_gives_up_after_max_attempts(self):
+        email = self.queue()
+        email.attempts = settings.EMAIL_OUTBOX_MAX_ATTEMPTS - 1
+        email.save()
+        with patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('no route')):
+            self.assertEqual(outbox.drain_outbox(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboxEmail.FAILED)
+
+
+class OutlookWriteJobTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_user', password='test_password', email='test_email')
+        self.social_account = SocialAccount.objects.create(user=self.user, provider="microsoft")
+        self.event = Event.objects.create(social_account=self.social_account, date_time='',
+                                          start_time=timezone.make_aware(datetime.datetime(2018, 2, 12, 10, 0)),
+                                          end_time=timezone.make_aware(datetime.datetime(2018, 2, 12, 10, 30)),
+                                          first_name='fn', email='test@kcl.ac.uk', duration=30, subject='sub',
+                                          status=Event.PENDING)
+        patcher = patch('bookings.jobs.get_access_token', return_value='token')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, action, mail=None):
+        return jobs.queue_outlook_write(action, self.event, body_content='<p>booked</p>', mail=mail)
+
+    @patch('bookings.jobs.book_event')
+    def test_book_job_confirms_event_and_queues_mail(self, book_event):
+        book_event.return_value = {'id': 'outlook-1'}
+        self.queue(OutlookWriteJob.BOOK, mail={'subject': 'New Booking: sub', 'message': '',
+                                               'from_email': 'imeetingbooker@gmail.com',
+                                               'recipient_list': ['test_email'], 'html_message': '<p>booked</p>'})
+        self.assertEqual(jobs.run_outlook_jobs(), (1, 0))
+        self.event.refresh_from_db()
+        self.assertEqual((self.event.outlook_id, self.event.status), ('outlook-1', Event.CONFIRMED))
+        self.assertEqual(book_event.call_args[0][3], '<p>booked</p>')
+        self.assertEqual(OutboxEmail.objects.get().subject, 'New Booking: sub')
+
+    @patch('bookings.jobs.book_event', return_value='503: unavailable')
+    def test_book_job_retries_then_fails_event(self, book_event):
+        with freeze_time('2018-02-10 10:00:00'):
+            job = self.queue(OutlookWriteJob.BOOK)
+            self.assertEqual(jobs.run_outlook_jobs(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutlookWriteJob.PENDING)
+        self.assertEqual(job.next_attempt_at, job.created_at + datetime.timedelta(seconds=30))
+        job.attempts = settings.OUTLOOK_JOB_MAX_ATTEMPTS - 1
+        job.save()
+        self.assertEqual(jobs.run_outlook_jobs(), (0, 1))
+        job.refresh_from_db()
+        self.event.refresh_from_db()
+        self.assertEqual((job.status, self.event.status), (OutlookWriteJob.FAILED, Event.FAILED))
+        failure_mail = OutboxEmail.objects.get()
+        self.assertEqual(failure_mail.subject, 'Booking Failed: sub')
+        self.assertEqual(failure_mail.get_recipient_list(), ['test_email', 'test@kcl.ac.uk'])
+
+    @patch('bookings.jobs.book_event', return_value={'id': 'outlook-1'})
+    def test_run_outlook_jobs_skips_jobs_claimed_by_another_run(self, book_event):
+        job = self.queue(OutlookWriteJob.BOOK)
+        self.assertTrue(jobs.claim_job(OutlookWriteJob.objects.get(pk=job.pk)))
+        self.assertFalse(jobs.claim_job(job))  # read before the other run claimed it
+        self.assertEqual(jobs.run_outlook_jobs(), (0, 0))
+        book_event.assert_not_called()
+
+    @patch('bookings.jobs.book_event', return_value={'id': 'outlook-1'})
+    def test_run_outlook_jobs_reruns_job_left_running(self, book_event):
+        with freeze_time('2018-02-10 10:00:00'):
+            job = self.queue(OutlookWriteJob.BOOK)
+            jobs.claim_job(job)  # run died before writing to outlook
+            self.assertEqual(jobs.run_outlook_jobs(), (0, 0))
+        with freeze_time('2018-02-10 10:10:00'):
+            self.assertEqual(jobs.run_outlook_jobs(), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutlookWriteJob.DONE)
+        self.assertEqual(book_event.call_count, 1)
+
+    @patch('bookings.jobs.update_booking', return_value='503: unavailable')
+    def test_failed_update_job_restores_previous_times(self, update_booking):
+        self.event.outlook_id, self.event.status, self.event.date_time = 'outlook-1', Event.CONFIRMED, 'Mon 10:00'
+        self.event.save()
+        previous = jobs.get_event_times(self.event)
+        self.event.start_time += datetime.timedelta(hours=4)
+        self.event.end_time += datetime.timedelta(hours=4)
+        self.event.status, self.event.date_time = Event.PENDING, 'Mon 14:00'
+        self.event.save()
+        job = jobs.queue_outlook_write(OutlookWriteJob.UPDATE, self.event, body_content='<p>moved</p>',
+                                       previous=previous)
+        job.attempts = settings.OUTLOOK_JOB_MAX_ATTEMPTS - 1
+        job.save()
+        self.assertEqual(jobs.run_outlook_jobs(), (0, 1))
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.start_time, timezone.make_aware(datetime.datetime(2018, 2, 12, 10, 0)))
+        self.assertEqual(self.event.end_time, timezone.make_aware(datetime.datetime(2018, 2, 12, 10, 30)))
+        self.assertEqual((self.event.date_time, self.event.status), ('Mon 10:00', Event.CONFIRMED))
+        failure_mail = OutboxEmail.objects.get()
+        self.assertEqual(failure_mail.subject, 'Reschedule Failed: sub')
+        self.assertIn('stays at Mon 10:00', failure_mail.html_message)
+        self.assertEqual(failure_mail.get_recipient_list(), ['test_email', 'test@kcl.ac.uk'])
+
+    @patch('bookings.jobs.update_booking')
+    @patch('bookings.jobs.book_event', return_value='503: unavailable')
+    def test_later_jobs_wait_for_earlier_job_of_event(self, book_event, update_booking):
+        self.queue(OutlookWriteJob.BOOK)
+        self.queue(OutlookWriteJob.UPDATE)
+        self.assertEqual(jobs.run_outlook_jobs(), (0, 1))
+        update_booking.assert_not_called()
+
+    @patch('bookings.jobs.cancel_booking')
+    def test_cancel_job_without_outlook_event_deletes_locally(self, cancel_booking):
+        self.event.status = Event.CANCELLED
+        self.event.save()
+        self.queue(OutlookWriteJob.CANCEL)
+        self.assertEqual(jobs.run_outlook_jobs(), (1, 0))
+        cancel_booking.assert_not_called()
+        self.assertFalse(Event.objects.exists())
+
+    @freeze_time('2018-02-10 10:00:00')
+    def test_pending_events_block_availability(self):
+        booking_availability = BookingAvailability.objects.create(
+            account_social=self.social_account, monday_from=datetime.time(9, 0), monday_to=datetime.time(17, 0),
+            availability_increment=30, booking_duration=30)
+        dates = [datetime.date(2018, 2, 12)]
+        self.assertEqual(booking_availability.get_pending_events(dates),
+                         [{'start': datetime.datetime(2018, 2, 12, 10, 0),
+                           'end': datetime.datetime(2018, 2, 12, 10, 30), 'is_all_day': False}])
+        self.event.status = Event.CONFIRMED
+        self.event.save()
+        self.assertEqual(booking_availability.get_pending_events(dates), [])
+
+    @patch('bookings.jobs.book_event', return_value={'id': 'outlook-1'})
+    def test_booked_slot_stays_unbookable_after_job_with_warm_cache(self, book_event):
+        booking_availability = BookingAvailability.objects.create(
+            account_social=self.social_account, monday_from=datetime.time(9, 0), monday_to=datetime.time(17, 0),
+            availability_increment=30, booking_duration=30)
+        CalendarSyncState.objects.create(social_account=self.social_account)
+        day = datetime.date(2018, 2, 12)
+        # calendar a web worker cached before the booking reached outlook, the job runs in another process
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value={'value': []}):
+            with freeze_time('2018-02-10 10:00:00'):
+                self.queue(OutlookWriteJob.BOOK)
+                self.assertNotIn(datetime.time(10, 0), booking_availability.get_free_slots_on_day(day))
+                self.assertEqual(jobs.run_outlook_jobs(), (1, 0))
+                self.assertNotIn(datetime.time(10, 0), booking_availability.get_free_slots_on_day(day))
+            with freeze_time('2018-02-10 10:00:59'):
+                self.assertNotIn(datetime.time(10, 0), booking_availability.get_free_slots_on_day(day))
+        state = CalendarSyncState.objects.get()
+        self.assertGreater(state.write_version, state.calendar_version)
+
+
+class AvailabilityApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='test_user', password='test_password', email='test_email')
+        self.social_account = SocialAccount.objects.create(user=self.user, provider="microsoft")
+        SocialToken.objects.create(account=self.social_account, app_id=1, expires_at=datetime.date(2018, 2, 9))
+        self.booking_obj = BookingAvailability.objects.create(
+            account_social=self.social_account,
+            monday_from=datetime.time(8, 0),
+            monday_to=datetime.time(12, 0),
+            tuesday_from=datetime.time(9, 0),
+            tuesday_to=datetime.time(17, 0),
+            availability_increment=30,
+            booking_duration=30,
+        )
+        self.events = {'value': [{'start': {'dateTime': '2018-02-12T09:00:00'},
+                                  'end': {'dateTime': '2018-02-12T10:00:00'}, 'isAllDay': False}]}
+        patcher = patch('bookings.views.set_new_token')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @freeze_time("2018-02-10 10:00:00")
+    def test_get_week_availability_matches_grid(self):
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events):
+            week = self.booking_obj.get_week_availability(datetime.date(2018, 2, 10))
+            grid = self.booking_obj.get_time_slot_data(datetime.date(2018, 2, 10))
+        self.assertEqual(len(week['days']), 7)
+        self.assertEqual(week['days'][2]['free'], [480, 510, 600, 630, 660, 690])
+        for day in week['days']:
+            self.assertEqual([minute for minute in week['times']
+                              if any(row.get(day['label']) == '{:02d}:{:02d}'.format(*divmod(minute, 60))
+                                     for row in grid)], day['free'])
+
+    @override_settings(SERVER_TIMING_HEADER=True)
+    def test_server_timing_header(self):
+        def get_outlook_events(dates):
+            with timing.timer('graph'):
+                return self.events
+        with patch.object(BookingAvailability, 'get_outlook_events', side_effect=get_outlook_events):
+            response = self.client.get(reverse('bookings:available_time_slots_json', args=[self.user.pk]))
+        phases = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(list(phases), ['graph', 'slots', 'db', 'total'])
+        self.assertTrue(phases['graph'].endswith('desc="1 calls"'))
+        self.assertIsNone(timing.get_request_timings())
+
+    def test_server_timing_header_only_for_staff_by_default(self):
+        url = reverse('bookings:available_time_slots_json', args=[self.user.pk])
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events):
+            self.assertNotIn('Server-Timing', self.client.get(url))
+            self.client.force_login(User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True))
+            self.assertIn('total;dur=', self.client.get(url)['Server-Timing'])
+
+    def test_query_timing_keeps_no_sql(self):
+        connection.queries_log.clear()
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events):
+            self.client.get(reverse('bookings:available_time_slots_json', args=[self.user.pk]))
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertEqual(len(connection.queries_log), 0)
+        self.assertNotIn('make_cursor', vars(connection))
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_request_log(self):
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events):
+            with self.assertLogs('bookings.slow_requests', 'WARNING') as logs:
+                self.client.get(reverse('bookings:available_time_slots_json', args=[self.user.pk]), {'start': 'x'})
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry['method'], entry['status']), ('GET', 400))
+        self.assertEqual(entry['path'], reverse('bookings:available_time_slots_json', args=[self.user.pk]) +
+                         '?start=x')
+        self.assertGreater(entry['phases']['db']['count'], 0)
+
+    @freeze_time("2018-02-10 10:00:00")
+    def test_available_time_slots_json(self):
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events) as outlook_events:
+            url = reverse('bookings:available_time_slots_json', args=[self.user.pk])
+            data = self.client.get(url).json()
+            self.assertEqual((data['start'], data['prev'], data['next']), ('2018-02-10', None, '2018-02-17'))
+            self.assertEqual(self.client.get(url, {'start': '2018-02-12'}).json()['prev'], '2018-02-10')
+            self.assertEqual(self.client.get(url, {'start': '2018-02-10'}).json(), data)
+            self.assertEqual(outlook_events.call_count, 2)  # second read of the week is cached
+            self.booking_obj.save()
+            self.client.get(url)
+            self.assertEqual(outlook_events.call_count, 3)
+        self.assertEqual(self.client.get(url, {'start': 'monday'}).status_code, 400)
+
+    def test_display_available_time_slots_client_render(self):
+        response = self.client.get(reverse('bookings:display_available_time_slots', args=['test_user', self.user.pk]),
+                                   {'render': 'client'})
+        self.assertContains(response, reverse('bookings:available_time_slots_json', args=[self.user.pk]))
+        self.assertContains(response, 'book_slot/99:99/')
+
+    @freeze_time("2018-02-10 10:00:00")
+    def test_booking_grid_html_cached_and_versioned(self):
+        url = reverse('bookings:display_available_time_slots', args=['test_user', self.user.pk])
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events) as outlook_events:
+            first = self.client.get(url)
+            self.assertContains(first, 'book_slot/08:00/Mon%2012/02/18/')
+            self.assertEqual(self.client.get(url).content, first.content)
+            self.assertEqual(outlook_events.call_count, 1)
+            self.assertEqual(booking_grid.get_grid_cache_stats(), {'hits': 1, 'misses': 1})
+            outlookservice.invalidate_calendar_cache('test_email')  # booked, updated or cancelled
+            self.client.get(url)
+            self.booking_obj.save()
+            self.client.get(url)
+            self.client.get(reverse('bookings:display_available_time_slots', args=['test_user', self.user.pk, 1]))
+            self.assertEqual(outlook_events.call_count, 4)
+        self.assertEqual(booking_grid.get_grid_cache_stats(), {'hits': 1, 'misses': 4})
+        metrics = booking_grid.grid_cache_as_prometheus()
+        self.assertIn('# TYPE booking_grid_cache_hits_total counter\nbooking_grid_cache_hits_total 1\n', metrics)
+        self.assertIn('booking_grid_cache_misses_total 4\n', metrics)
+
+    @freeze_time("2018-02-10 10:00:00")
+    def test_display_available_weeks_fetches_horizon_once(self):
+        url = reverse('bookings:display_available_weeks', args=['test_user', self.user.pk])
+        with patch('bookings.models.get_cached_events_for_windows', return_value=self.events) as windows_events:
+            response = self.client.get(url, {'weeks': 4, 'page': 2})
+        windows_events.assert_called_once()
+        self.assertEqual(windows_events.call_args[1]['windows'],
+                         [('2018-02-10', '2018-02-17'), ('2018-02-17', '2018-02-24'),
+                          ('2018-02-24', '2018-03-03'), ('2018-03-03', '2018-03-11')])
+        self.assertContains(response, 'Week of Sat 24/02/18')
+        self.assertContains(response, 'Week of Sat 03/03/18')
+        self.assertNotContains(response, 'Week of Sat 10/02/18')
+        self.assertContains(response, 'Page 2 of 2')
+
+    @freeze_time("2018-02-10 10:00:00")
+    def test_horizon_event_index_matches_weekly_fetch(self):
+        with patch('bookings.models.get_cached_events_for_windows', return_value=self.events):
+            event_index = self.booking_obj.get_horizon_event_index(datetime.date(2018, 2, 10), 2)
+        with patch.object(BookingAvailability, 'get_outlook_events', return_value=self.events):
+            for week_start in [datetime.date(2018, 2, 10), datetime.date(2018, 2, 17)]:
+                self.assertEqual(self.booking_obj.get_time_slot_data(week_start, event_index=event_index),
+                                 self.booking_obj.get_time_slot_data(week_start))
+
+    def test_get_cached_events_for_windows_merges_weeks(self):
+        event = {'start': {'dateTime': '2018-02-16T23:00:00'}, 'end': {'dateTime': '2018-02-17T01:00:00'},
+                 'isAllDay': False}
+        windows = [('2018-02-10', '2018-02-17'), ('2018-02-17', '2018-02-24')]
+        with patch('bookings.outlookservice.get_events_for_windows',
+                   return_value=[{'value': [event]}, {'value': [event]}]) as batched:
+            self.assertEqual(outlookservice.get_cached_events_for_windows('token', 'test_email', windows),
+                             {'value': [event]})
+            outlookservice.get_cached_events_for_windows('token', 'test_email', windows)
+        batched.assert_called_once_with('token', 'test_email', windows)
+        with patch('bookings.outlookservice.get_events_for_windows', return_value=[{'value': []}, '503: busy']):
+            outlookservice.invalidate_calendar_cache('test_email')
+            self.assertEqual(outlookservice.get_cached_events_for_windows('token', 'test_email', windows),
+                             '503: busy')
+
+
+class BenchmarkTests(TestCase):
+
+    def test_make_calendar(self):
+        calendar = benchmarks.make_calendar(datetime.date(2018, 2, 12), 7, 50)
+        self.assertEqual(len(calendar['value']), 50)
+        self.assertEqual(calendar, benchmarks.make_calendar(datetime.date(2018, 2, 12), 7, 50))
+        starts = [event['start']['dateTime'] for event in calendar['value']]
+        self.assertEqual(starts, sorted(starts))
+        self.assertTrue(all('2018-02-12' <= start < '2018-02-19' for start in starts))
+
+    def test_run_benchmarks(self):
+        seen = []
+        output = benchmarks.run_benchmarks(event_counts=[20], increments=[30], weeks_options=[1], repeat=2,
+                                           start_date=datetime.date(2018, 2, 12),
+                                           progress=lambda key, measurements: seen.append(key))
+        self.assertEqual(sorted(output['results']), ['duration_choices:20ev:30min', 'grid_render:1w:20ev:30min',
+                                                     'time_slot_data:1w:20ev:30min'])
+        self.assertEqual(sorted(seen), sorted(output['results']))
+        for measurements in output['results'].values():
+            self.assertLessEqual(measurements['p50'], measurements['p99'])
+            self.assertGreater(measurements['peak_kib'], 0)
+
+    def test_compare_with_baseline(self):
+        baseline = {'results': {'a': {'p50': 10.0}, 'b': {'p50': 10.0}}}
+        results = {'results': {'a': {'p50': 11.0}, 'b': {'p50': 13.0}, 'c': {'p50': 50.0}}}
+        self.assertEqual(benchmarks.compare_with_baseline(results, baseline), [('b', 10.0, 13.0)])
+        self.assertEqual(benchmarks.compare_with_baseline(results, baseline, tolerance=0.5), [])
+
+
+class FakeGraphTests(TestCase):
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(('localhost', 0), seed=1).start()
+        self.addCleanup(self.server.stop)
+        graph_settings = override_settings(GRAPH_BASE_URL=self.server.graph_base_url,
+                                           OUTLOOK_AUTHORITY=self.server.base_url, OUTLOOK_CALENDAR_PAGE_SIZE=10,
+                                           HTTP_MAX_RETRIES=2, HTTP_RETRY_BACKOFF=0)
+        graph_settings.enable()
+        self.addCleanup(graph_settings.disable)
+        httpclient.close_session()
+        self.addCleanup(httpclient.close_session)
+        graphmetrics.graph_metrics.reset()
+        self.event = {'subject': 'Meeting', 'email': 'booker@example.com', 'first_name': 'Booker',
+                      'start_time': timezone.make_aware(datetime.datetime(2018, 2, 12, 10, 0)),
+                      'end_time': timezone.make_aware(datetime.datetime(2018, 2, 12, 11, 0))}
+
+    def test_book_update_cancel(self):
+        booked = outlookservice.book_event('token', 'test_email', self.event, 'body')
+        self.assertEqual(booked['start']['dateTime'], '2018-02-12T10:00:00.0000000')
+        self.event.update(outlook_id=booked['id'], start_time=self.event['start_time'] + datetime.timedelta(hours=1),
+                          end_time=self.event['end_time'] + datetime.timedelta(hours=1))
+        self.assertEqual(outlookservice.update_booking('token', 'test_email', self.event, 'body')['start']['dateTime'],
+                         '2018-02-12T11:00:00.0000000')
+        events = outlookservice.get_events_between_dates('token', 'test_email', '2018-02-12', '2018-02-13')
+        self.assertEqual([event['id'] for event in events['value']], [booked['id']])
+        self.assertEqual(outlookservice.get_events_between_dates('token', 'other_email', '2018-02-12', '2018-02-13'),
+                         {'value': []})
+        self.assertTrue(outlookservice.cancel_booking('token', 'test_email', booked['id']))
+        self.assertFalse(outlookservice.cancel_booking('token', 'test_email', booked['id']))
+
+    def test_calendar_view_pages_and_batches(self):
+        calendar = benchmarks.make_calendar(datetime.date(2018, 2, 12), 14, 25)
+        self.server.store.add_calendar('test_email', calendar, pytz.timezone('Europe/London'))
+        events = outlookservice.get_events_between_dates('token', 'test_email', '2018-02-12', '2018-02-26')
+        self.assertEqual(len(events['value']), 25)
+        self.assertEqual(events['value'][0]['start'], calendar['value'][0]['start'])
+        self.assertEqual(set(events['value'][0]), {'id', 'start', 'end', 'isAllDay'})
+        windows = outlookservice.get_events_for_windows('token', 'test_email', [('2018-02-12', '2018-02-19'),
+                                                                                ('2018-02-19', '2018-02-26')])
+        self.assertEqual(sum(len(window['value']) for window in windows), 25)
+        self.assertEqual(self.server.request_counts['POST /$batch'], 1)
+
+    def test_calendar_view_delta(self):
+        booked = outlookservice.book_event('token', 'test_email', self.event, 'body')
+        changes, delta_link = outlookservice.get_calendar_view_delta('token', 'test_email', '2018-02-12', '2018-02-19')
+        self.assertEqual([change['id'] for change in changes], [booked['id']])
+        outlookservice.cancel_booking('token', 'test_email', booked['id'])
+        changes, delta_link = outlookservice.get_calendar_view_delta('token', 'test_email', delta_link=delta_link)
+        self.assertEqual(changes, [{'id': booked['id'], '@removed': {'reason': 'deleted'}}])
+        self.assertEqual(outlookservice.get_calendar_view_delta('token', 'test_email', delta_link=delta_link)[0], [])
+
+    def test_injected_failures(self):
+        self.server.throttle_rate, self.server.retry_after = 1, 0
+        self.assertTrue(outlookservice.get_events_between_dates('token', 'test_email', '2018-02-12',
+                                                                '2018-02-13').startswith('429: '))
+        self.assertEqual(self.server.request_counts['GET /me/calendarview'], 1 + settings.HTTP_MAX_RETRIES)
+        self.server.throttle_rate, self.server.error_rate = 0, 1
+        self.assertTrue(outlookservice.get_events_between_dates('token', 'test_email', '2018-02-12',
+                                                                '2018-02-13').startswith('503: '))
+
+    def test_graph_metrics(self):
+        self.server.throttle_rate, self.server.retry_after = 1, 3
+        with override_settings(HTTP_RETRY_AFTER_MAX=0), self.assertLogs('bookings.graph', 'WARNING') as logs:
+            outlookservice.cancel_booking('token', 'test_email', 'AAMk=')
+        self.assertIn('DELETE /me/events/{id} returned 429, client-request-id', logs.output[0])
+        self.server.throttle_rate = 0
+        outlookservice.get_events_between_dates('token', 'test_email', '2018-02-12', '2018-02-13')
+        metrics = graphmetrics.graph_metrics.as_prometheus()
+        self.assertIn('graph_responses_total{endpoint="/me/events/{id}",method="DELETE",status="429"} 1', metrics)
+        self.assertIn('graph_retries_total{{endpoint="/me/events/{{id}}"}} {}'.format(settings.HTTP_MAX_RETRIES),
+                      metrics)
+        self.assertIn('graph_throttle_retry_after_seconds_total{endpoint="/me/events/{id}"} 3', metrics)
+        self.assertIn('graph_request_duration_seconds_count{endpoint="/me/calendarview"} 1', metrics)
+        self.assertIn('graph_request_duration_seconds_bucket{endpoint="/me/calendarview",le="+Inf"} 1', metrics)
+        self.assertIn('graph_mailbox_requests_total{mailbox="test_email"} 2', metrics)
+        self.assertRegex(metrics, r'graph_response_bytes_total\{endpoint="/me/calendarview"\} [1-9]')
+
+    def test_graph_metrics_view_staff_only(self):
+        url = reverse('bookings:graph_metrics')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        staff = User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertContains(response, '# TYPE graph_request_duration_seconds histogram')
+        self.assertContains(response, '# TYPE booking_grid_cache_misses_total counter')
+
+    def test_token_refresh(self):
+        response = authhelper.get_new_access_token_from_refresh_token('refresh', 'http://localhost/callback')
+        self.assertTrue(response['access_token'].startswith('fake-access-'))
+        self.assertEqual(self.server.request_counts['POST token'], 1)
+
+
+class LoadTestTests(TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(loadtest.parse_mix('grid=3, book=1'), [('grid', 3.0), ('book', 1.0)])
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('grid=3,search=1')
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('grid=0')
+
+    def test_summarise(self):
+        samples = {'grid': [(latency / 1000.0, 200) for latency in range(1, 101)],
+                   'book': [(0.2, 302), (0.4, None), (0.3, 500)]}
+        summary = loadtest.summarise(samples, 2)
+        self.assertEqual((summary['grid']['p50'], summary['grid']['p95'], summary['grid']['p99']),
+                         (50.0, 95.0, 99.0))
+        self.assertEqual(summary['grid']['throughput'], 50)
+        self.assertEqual(summary['book']['errors'], 2)
+        self.assertEqual(summary['book']['statuses'], {'302': 1, 'None': 1, '500': 1})
+        self.assertEqual(summary['all']['requests'], 103)
+
+    def test_navigate_week_with_a_single_week(self):
+        session = Mock()
+        target = loadtest.LoadTarget('http://testserver', 'host', 1, 15, weeks=1)
+        [(label, response)] = loadtest.navigate_week(session, target, random.Random(0))
+        self.assertEqual(label, 'week')
+        self.assertIn(datetime.date.today().strftime('%x'), session.get.call_args[0][0])
+
+
+class RequestTimingTests(TestCase):
+
+    def test_nested_timers_count_towards_inner_phase(self):
+        timings = timing.start_request_timings()
+        with patch('bookings.timing.time.perf_counter', side_effect=[0.0, 1.0, 4.0, 10.0]):
+            with timing.timer('slots'):
+                with timing.timer('graph'):
+                    pass
+        timing.stop_request_timings()
+        self.assertEqual(timings.as_dict(), {'slots': {'ms': 7000.0, 'count': 1},
+                                             'graph': {'ms': 3000.0, 'count': 1}})
+        self.assertEqual(timings.as_header(total=12),
+                         'graph;dur=3000.0;desc="1 calls", slots;dur=7000.0;desc="1 calls", total;dur=12000.0')
+
+    def test_timer_outside_request(self):
+        with timing.timer('graph') as graph_timer:
+            pass
+        self.assertIsNone(graph_timer.timings)
+
+
+class RequestProfilerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        profile_settings = override_settings(PROFILE_DIR=profile_dir)
+        profile_settings.enable()
+        self.addCleanup(profile_settings.disable)
+        self.url = reverse('bookings:ajax_load_booking_durations')
+        self.staff = User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+
+    def get_profiled(self):
+        return self.client.get(self.url, {'availability_increment': 15, 'profile': 1})
+
+    def test_only_staff_can_profile(self):
+        self.assertNotIn('X-Profile', self.get_profiled())
+        self.client.force_login(User.objects.create_user('booker', 'booker@example.com', 'password'))
+        self.assertNotIn('X-Profile', self.get_profiled())
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_profile_listed_with_top_functions(self):
+        self.client.force_login(self.staff)
+        name = self.client.get(self.url, {'availability_increment': 15},
+                               HTTP_X_PROFILE_REQUEST='1')['X-Profile']
+        self.assertEqual([(profile['name'], profile['status'], profile['user'])
+                          for profile in profiling.list_profiles()], [(name, 200, 'staff')])
+        self.assertContains(self.client.get(reverse('bookings:request_profiles')), name)
+        response = self.client.get(reverse('bookings:request_profile', args=[name]))
+        self.assertContains(response, 'load_booking_durations')
+        self.assertEqual(self.client.get(reverse('bookings:request_profile', args=['missing'])).status_code, 404)
+
+    @override_settings(PROFILE_RATE_LIMIT=2, PROFILE_MAX_FILES=1)
+    def test_rate_limit_and_caps(self):
+        self.client.force_login(self.staff)
+        first = self.get_profiled()['X-Profile']
+        second = self.get_profiled()['X-Profile']
+        self.assertEqual(self.get_profiled()['X-Profile'], 'rate limited')
+        self.assertEqual([profile['name'] for profile in profiling.list_profiles()], [max(first, second)])
+        cache.clear()
+        with override_settings(PROFILE_MAX_BYTES=0):
+            self.assertEqual(self.get_profiled()['X-Profile'], 'too large')
+        with self.assertRaises(ValueError):
+            profiling.get_profile_path('../settings')
+
+
+class PerformanceBudgetTests(TestCase):
+    '''
+    Each booking view against a budget of DB queries, Graph calls, SMTP sends and wall clock seconds,
+    Graph is the in process fake so calls are counted and nothing leaves the machine
+    '''
+
+    def setUp(self):
+        self.server = fakegraph.FakeGraphServer(('localhost', 0), seed=1).start()
+        self.addCleanup(self.server.stop)
+        graph_settings = override_settings(GRAPH_BASE_URL=self.server.graph_base_url,
+                                           OUTLOOK_AUTHORITY=self.server.base_url,
+                                           GOOGLE_RECAPTCHA_VERIFY_URL=self.server.recaptcha_verify_url,
+                                           HTTP_RETRY_BACKOFF=0, OUTLOOK_ASYNC_WRITES=False)
+        graph_settings.enable()
+        self.addCleanup(graph_settings.disable)
+        httpclient.close_session()
+        self.addCleanup(httpclient.close_session)
+        cache.clear()
+        self.user = loadtest.seed_booking_page('host', 20, 15, 2, self.server.store)
+        self.account = SocialAccount.objects.get(user=self.user)
+        self.grid_url = reverse('bookings:display_available_time_slots', kwargs={'name': 'host', 'pk': self.user.pk})
+        today = datetime.date.today()
+        self.day = today + datetime.timedelta(days=7 - today.weekday())  # next monday
+        start = timezone.make_aware(datetime.datetime.combine(self.day, datetime.time(17, 0)))
+        booked = self.server.store.create_event(self.user.email, {
+            'subject': 'Meeting', 'start': {'dateTime': start.isoformat(), 'timeZone': 'UTC'},
+            'end': {'dateTime': (start + datetime.timedelta(minutes=30)).isoformat(), 'timeZone': 'UTC'}})
+        self.event = Event.objects.create(social_account=self.account, date_time=start.strftime('%A, %-d %B %Y %H:%M'),
+                                          start_time=start, end_time=start + datetime.timedelta(minutes=30),
+                                          first_name='Booker', email='booker@kcl.ac.uk', duration=30,
+                                          subject='Meeting', outlook_id=booked['id'])
+        # the seeded calendar is random from today, so book the first slot it leaves free rather than a fixed time
+        week = self.client.get(reverse('bookings:available_time_slots_json', args=[self.user.pk]),
+                               {'start': self.day.isoformat()}).json()
+        free_day = next(day for day in week['days'] if day['free'])
+        self.date = free_day['label']
+        self.slot = '{:02d}:{:02d}'.format(*divmod(free_day['free'][0], 60))
+        cache.clear()
+        self.server.request_counts.clear()
+
+    def get_graph_calls(self):
+        '''
+        :return: Counter of Graph calls to the fake server by method and endpoint, token and reCAPTCHA excluded
+        '''
+        return collections.Counter({call: count for call, count in self.server.request_counts.items()
+                                    if call.split(' ', 1)[1].startswith('/')})
+
+    @contextlib.contextmanager
+    def assertWithinBudget(self, queries, graph_calls, emails=0, seconds=2):
+        '''
+        Fail with a diff of the budget and what the block used when it goes over any part of it
+        :param queries: most DB queries the block may make
+        :param graph_calls: most Graph calls the block may make
+        :param emails: most emails the block may send over SMTP
+        :param seconds: most wall clock seconds the block may take
+        :return: context manager
+        '''
+        graph_before = self.get_graph_calls()
+        emails_before = len(mail.outbox)
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - started
+        graph = self.get_graph_calls() - graph_before
+        budget = [('queries', queries), ('graph_calls', graph_calls), ('emails', emails), ('seconds', seconds)]
+        used = {'queries': len(captured), 'graph_calls': sum(graph.values()),
+                'emails': len(mail.outbox) - emails_before, 'seconds': round(elapsed, 3)}
+        over = [(name, limit) for name, limit in budget if used[name] > limit]
+        if not over:
+            return
+        lines = ['Over budget (- budget, + used):']
+        for name, limit in over:
+            lines.extend(['- {}: {}'.format(name, limit), '+ {}: {}'.format(name, used[name])])
+        if used['queries'] > queries:
+            lines.append('Queries:')
+            lines.extend('  {}. {}'.format(number, query['sql']) for number, query in enumerate(captured, 1))
+        if used['graph_calls'] > graph_calls:
+            lines.append('Graph calls:')
+            lines.extend('  {} x{}'.format(call, count) for call, count in sorted(graph.items()))
+        self.fail('\n'.join(lines))
+
+    def test_budget_failure_is_a_readable_diff(self):
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertWithinBudget(queries=0, graph_calls=0):
+                self.client.get(self.grid_url)
+        message = str(raised.exception)
+        self.assertIn('- queries: 0\n+ queries: ', message)
+        self.assertIn('- graph_calls: 0\n+ graph_calls: 1', message)
+        self.assertIn('GET /me/calendarview x1', message)
+        self.assertNotIn('seconds', message)
+
+    def test_events(self):
+        self.client.force_login(self.user)
+        with self.assertWithinBudget(queries=5, graph_calls=1):
+            response = self.client.get(reverse('bookings:events'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_display_available_time_slots(self):
+        with self.assertWithinBudget(queries=7, graph_calls=1):
+            response = self.client.get(self.grid_url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_book_meeting_slot_get(self):
+        url = reverse('bookings:book_meeting_slot', kwargs={'slot': self.slot, 'date': self.date, 'pk': self.user.pk,
+                                                            'event_pk': 0})
+        with self.assertWithinBudget(queries=7, graph_calls=1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_book_meeting_slot_post(self):
+        url = reverse('bookings:book_meeting_slot', kwargs={'slot': self.slot, 'date': self.date, 'pk': self.user.pk,
+                                                            'event_pk': 0})
+        with self.assertWithinBudget(queries=12, graph_calls=2):
+            response = self.client.post(url, {'g-recaptcha-response': 'ok', 'first_name': 'Booker', 'last_name': 'B',
+                                              'email': 'booker@kcl.ac.uk', 'subject': 'Meeting', 'duration': 30,
+                                              'date_time': self.date})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.server.request_counts['POST siteverify'], 1)
+
+    def test_update_meeting_slot(self):
+        url = reverse('bookings:update_meeting_slot', kwargs={'slot': self.slot, 'date': self.date, 'pk': self.user.pk,
+                                                              'event_pk': self.event.pk})
+        with self.assertWithinBudget(queries=8, graph_calls=1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertWithinBudget(queries=3, graph_calls=0):
+            response = self.client.post(url, {'duration': 30})
+        self.assertEqual(response.status_code, 200)
+
+    def test_confirm_slot_reschedule(self):
+        url = reverse('bookings:confirm_slot_reschedule', kwargs={'slot': self.slot, 'date': self.date,
+                                                                  'event_pk': self.event.pk, 'duration': 30})
+        with self.assertWithinBudget(queries=7, graph_calls=1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+
+    def test_cancel_booking_slot(self):
+        url = reverse('bookings:cancel_booking_slot', kwargs={'event_pk': self.event.pk})
+        with self.assertWithinBudget(queries=1, graph_calls=0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertWithinBudget(queries=8, graph_calls=1):
+            response = self.client.post(url)
+        self.assertContains(response, 'cancelled')
+
+
 class OutlookServiceTests(TestCase):
 
     @responses.activate
@@ -401,6 +1821,37 @@ class OutlookServiceTests(TestCase):
         resp = outlookservice.get_events_between_dates('token', 'email', 'date1', 'date2')
         self.assertEquals(resp, {'example': 2})
 
+    @responses.activate
+    def test_get_my_events_between_dates_follows_next_link(self):
+        url = 'https://graph.microsoft.com/v1.0/me/calendarview'
+        responses.add(responses.GET, url, json={'value': [{'id': 1}, {'id': 2}], '@odata.nextLink': url + '?skip=2'},
+                      status=200)
+        responses.add(responses.GET, url, json={'value': [{'id': 3}]}, status=200)
+        resp = outlookservice.get_events_between_dates('token', 'email', 'date1', 'date2')
+        self.assertEquals(resp, {'value': [{'id': 1}, {'id': 2}, {'id': 3}]})
+        self.assertIn('%24top=500', responses.calls[0].request.url)
+        self.assertEqual(responses.calls[1].request.url, url + '?skip=2')
+
+    @responses.activate
+    def test_get_my_events_between_dates_next_link_error(self):
+        url = 'https://graph.microsoft.com/v1.0/me/calendarview'
+        responses.add(responses.GET, url, json={'value': [{'id': 1}], '@odata.nextLink': url + '?skip=1'},
+                      status=200)
+        responses.add(responses.GET, url, json={'error': 'throttled'}, status=429)
+        resp = outlookservice.get_events_between_dates('token', 'email', 'date1', 'date2')
+        self.assertEquals(resp, '429: {"error": "throttled"}')
+
+    @responses.activate
+    def test_iter_events_between_dates(self):
+        url = 'https://graph.microsoft.com/v1.0/me/calendarview'
+        responses.add(responses.GET, url, json={'value': [{'id': 1}], '@odata.nextLink': url + '?skip=1'},
+                      status=200)
+        responses.add(responses.GET, url, json={'value': [{'id': 2}]}, status=200)
+        events = outlookservice.iter_events_between_dates('token', 'email', 'date1', 'date2')
+        self.assertEqual(next(events), {'id': 1})
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(list(events), [{'id': 2}])
+
     @responses.activate
     @freeze_time("2018-02-4 10:21:34")
     def test_update_booking_404(self):
@@ -0,0 +1,127 @@
+import collections
+import functools
+import threading
+import time
+
+_local = threading.local()
+
+# what the count of a phase is shown as in Server-Timing descriptions, calls unless listed
+phase_units = {'db': 'queries'}
+
+
+class RequestTimings(object):
+    '''
+    Phase durations of the request being handled on this thread, time spent inside a nested timer
+    counts only towards the inner phase e.g. a Graph call made while computing slots is graph time
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.stack = []
+
+    def add(self, phase, seconds, count=1):
+        '''
+        :param phase: phase name e.g. graph
+        :param seconds: time spent
+        :param count: calls or queries the time covers
+        :return: Void
+        '''
+        totals = self.phases.setdefault(phase, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += count
+
+    def get_total(self):
+        '''
+        :return: seconds since the request started
+        '''
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        '''
+        :return: dict of phase => {'ms': milliseconds, 'count': calls}
+        '''
+        return collections.OrderedDict((phase, {'ms': round(seconds * 1000, 3), 'count': count})
+                                       for phase, (seconds, count) in self.phases.items())
+
+    def as_header(self, total=None):
+        '''
+        :param total: seconds for the total entry, defaults to the time so far
+        :return: Server-Timing header value
+        e.g. 'db;dur=2.1;desc="3 queries", graph;dur=80.4;desc="1 calls", total;dur=95.0'
+        '''
+        entries = ['{};dur={:.1f};desc="{} {}"'.format(phase, seconds * 1000, count,
+                                                       phase_units.get(phase, 'calls'))
+                   for phase, (seconds, count) in self.phases.items()]
+        entries.append('total;dur={:.1f}'.format((self.get_total() if total is None else total) * 1000))
+        return ', '.join(entries)
+
+
+def start_request_timings():
+    '''
+    Begin collecting timings for the request on this thread
+    :return: RequestTimings
+    '''
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def get_request_timings():
+    '''
+    :return: RequestTimings of the request on this thread or None outside a timed request
+    '''
+    return getattr(_local, 'timings', None)
+
+
+def stop_request_timings():
+    '''
+    Stop collecting timings on this thread
+    :return: RequestTimings or None if none were being collected
+    '''
+    timings = get_request_timings()
+    _local.timings = None
+    return timings
+
+
+class timer(object):
+    '''
+    Time a block towards a phase of the current request, does nothing outside a timed request
+    e.g.
+    with timer('graph'):
+        response = httpclient.request(...)
+    '''
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.timings = None
+
+    def __enter__(self):
+        self.timings = get_request_timings()
+        if self.timings is not None:
+            # [started, seconds spent in nested timers]
+            self.timings.stack.append([time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            started, nested = self.timings.stack.pop()
+            elapsed = time.perf_counter() - started
+            self.timings.add(self.phase, elapsed - nested)
+            if self.timings.stack:
+                self.timings.stack[-1][1] += elapsed
+        return False
+
+
+def timed(phase):
+    '''
+    Decorator timing every call of a function towards a phase e.g. @timed('slots')
+    :param phase: phase name
+    :return: decorator
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
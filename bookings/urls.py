@@ -19,6 +19,18 @@ urlpatterns = [
     url(
         r'^(?P<name>[\w.@+-]+)/(?P<pk>\d+)/(?P<date>\d{2}\/\d{2}\/\d{2})/(?P<action>[\w.@+-]+)/(?P<event_pk>\d+)/appointment/$',
         views.display_available_time_slots, name='display_available_time_slots'),
+    # several weeks of booking grids from one calendar fetch
+    url(r'^(?P<name>[\w.@+-]+)/(?P<pk>\d+)/booking_weeks/$', views.display_available_weeks,
+        name='display_available_weeks'),
+    url(r'^(?P<name>[\w.@+-]+)/(?P<pk>\d+)/(?P<event_pk>\d+)/booking_weeks_update/$', views.display_available_weeks,
+        name='display_available_weeks'),
+    # week of availability as JSON for the client rendered grid
+    url(r'^(?P<pk>\d+)/availability/$', views.available_time_slots_json, name='available_time_slots_json'),
+    # Graph client metrics for Prometheus, staff only
+    url(r'^metrics/graph/$', views.graph_metrics_view, name='graph_metrics'),
+    # request profiles taken with ?profile=1, staff only
+    url(r'^profiles/$', views.request_profiles, name='request_profiles'),
+    url(r'^profiles/(?P<name>[\w-]+)/$', views.request_profile, name='request_profile'),
     url(r'^book_slot/(?P<slot>\d+:\d+)/(?P<date>[\w|\W]+\d{2}\/\d{2}\/\d{2})/(?P<pk>\d+)/(?P<event_pk>\d+)/$',
         views.book_meeting_slot, name='book_meeting_slot'),
     url(r'^booking_confirmed/(?P<pk>\d+)/$', views.BookingConfirmedView.as_view(), name='booking_confirmed'),
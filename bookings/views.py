@@ -1,23 +1,28 @@
 import datetime
 
-import requests
 from allauth.socialaccount.models import SocialToken, SocialAccount
 from django.conf import settings
 from django.contrib import messages
-from django.core.mail import send_mail
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, redirect
 from django.template.loader import render_to_string
 from django.utils.timezone import make_aware
 from django.views.generic import DetailView
-from django_tables2 import RequestConfig
 
-from bookings.authhelper import set_new_token
-from bookings.booking_grid import BookingGrid
+from bookings import httpclient
+from bookings.authhelper import get_social_token, set_new_token
+from bookings.booking_grid import get_booking_grid_html, grid_cache_as_prometheus, render_booking_grid
 from bookings.forms import BookingAvailabilityForm, EventBookingForm, UpdateEventBookingForm
-from bookings.models import BookingAvailability, Event
+from bookings.graphmetrics import graph_metrics
+from bookings.jobs import get_event_times, queue_outlook_write
+from bookings.models import BookingAvailability, Event, OutlookWriteJob
+from bookings.outbox import queue_mail
 from bookings.outlookservice import get_outlook_events, cancel_booking, book_event, update_booking
+from bookings.profiling import get_top_functions, list_profiles
+from bookings.timing import timer
 
 
 def events(request):
@@ -80,7 +85,7 @@ def validate_recaptcha(request):
         'secret': settings.GOOGLE_RECAPTCHA_SECRET_KEY,
         'response': recaptcha_response
     }
-    r = requests.post('https://www.google.com/recaptcha/api/siteverify', data=data)
+    r = httpclient.request('POST', settings.GOOGLE_RECAPTCHA_VERIFY_URL, data=data)
     result = r.json()
     if result.get('success'):
         return True
@@ -89,6 +94,65 @@ def validate_recaptcha(request):
         return False
 
 
+def display_available_weeks(request, name, pk, event_pk=0):
+    """
+    Display booking grids for several weeks ahead, events for the whole horizon are fetched once
+    and the weeks are paginated
+    :param request: GET weeks=number of weeks ahead (up to BOOKING_HORIZON_MAX_WEEKS), page=page number
+    :param name: user name
+    :param pk:
+    :param event_pk:
+    :return: GET page of weekly booking grids according to booking availability
+    """
+    account = SocialAccount.objects.filter(user__id=int(pk))[0]
+    booking_availabilty_preferences = BookingAvailability.objects.filter(account_social__id=account.pk)[0]
+    try:
+        weeks = min(max(int(request.GET.get('weeks', settings.BOOKING_HORIZON_WEEKS)), 1),
+                    settings.BOOKING_HORIZON_MAX_WEEKS)
+    except ValueError:
+        weeks = settings.BOOKING_HORIZON_WEEKS
+    start_date = datetime.date.today()
+    week_starts = [start_date + datetime.timedelta(days=week * 7) for week in range(weeks)]
+    paginator = Paginator(week_starts, settings.BOOKING_HORIZON_WEEKS_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+    set_new_token(request, get_social_token(account))
+    event_index = booking_availabilty_preferences.get_horizon_event_index(start_date, weeks)
+    tables = [(week_start, render_booking_grid(request, booking_availabilty_preferences, week_start, int(pk),
+                                               int(event_pk), event_index)) for week_start in page]
+    with timer('render'):
+        return render(request, 'bookings/display_available_weeks.html', {'tables': tables, 'page': page,
+                                                                         'weeks': weeks, 'name': name})
+
+
+def available_time_slots_json(request, pk):
+    """
+    Week of bookable slots as JSON for the client rendered booking grid
+    :param request: GET start=YYYY-MM-DD first day of the week, defaults to today
+    :param pk: user pk/id
+    :return: JSON of get_week_availability with prev/next week start dates
+    """
+    account = SocialAccount.objects.filter(user__id=int(pk))[0]
+    booking_availabilty_preferences = BookingAvailability.objects.filter(account_social__id=account.pk)[0]
+    today = datetime.date.today()
+    try:
+        start_date = datetime.datetime.strptime(request.GET['start'], '%Y-%m-%d').date() \
+            if request.GET.get('start') else today
+    except ValueError:
+        return JsonResponse({'error': 'start must be a date e.g. 2018-02-12'}, status=400)
+    start_date = max(start_date, today)
+    set_new_token(request, get_social_token(account))
+    week = dict(booking_availabilty_preferences.get_cached_week_availability(start_date))
+    previous_start = start_date - datetime.timedelta(days=7)
+    week['prev'] = max(previous_start, today).isoformat() if start_date > today else None
+    week['next'] = (start_date + datetime.timedelta(days=7)).isoformat()
+    return JsonResponse(week)
+
+
 def book_meeting_slot(request, slot, date, pk, event_pk):
     """
     View booking form and Book selected event slot
@@ -101,7 +165,7 @@ def book_meeting_slot(request, slot, date, pk, event_pk):
     Booking Form on GET req
     """
     account = SocialAccount.objects.filter(user__id=int(pk))[0]
-    token_obj = account.socialtoken_set.get()
+    token_obj = get_social_token(account)
     set_new_token(request,token_obj)
     booking_availability = BookingAvailability.objects.filter(account_social__id=account.pk)[0]
     date = datetime.datetime.strptime(slot + ' ' + date, '%H:%M %a %d/%m/%y')
@@ -112,6 +176,8 @@ def book_meeting_slot(request, slot, date, pk, event_pk):
             event.social_account = account
             event.start_time = make_aware(date)
             event.end_time = make_aware(date + datetime.timedelta(minutes=event.duration))
+            if settings.OUTLOOK_ASYNC_WRITES:
+                event.status = Event.PENDING
             event.save()
             event_dict = {'start_time': event.start_time,'end_time': event.end_time,
                           'first_name': event.first_name,'last_name': event.last_name, 'email':event.email,
@@ -121,13 +187,19 @@ def book_meeting_slot(request, slot, date, pk, event_pk):
                                         {'event': event_dict, 'update': False, ##refactor formatting into function
                                          'start_time_formatted': event_dict['start_time'].strftime('%A, %-d %B %Y %H:%M'),
                                          'end_time_formatted': event_dict['end_time'].strftime('%A, %-d %B %Y %H:%M')})
+            mail = {'subject': 'New Booking: {}'.format(event.subject), 'message': '',
+                    'from_email': 'imeetingbooker@gmail.com', 'recipient_list': [account.user.email],
+                    'html_message': msg_html}
+            if settings.OUTLOOK_ASYNC_WRITES:
+                # confirm now, the outlook event is created by the run_outlook_jobs command
+                queue_outlook_write(OutlookWriteJob.BOOK, event, body_content=msg_html, mail=mail)
+                return redirect('bookings:booking_confirmed', pk=event.pk)
             response = book_event(access_token=token_obj.token, user_email=account.user.email,
                                   event=event_dict,body_content=msg_html)
             if isinstance(response, dict):  # json response
                 event.outlook_id = response.get('id')
                 event.save()
-                send_mail(subject='New Booking: {}'.format(event.subject), message='', from_email='imeetingbooker@gmail.com',
-                          recipient_list=[account.user.email], html_message=msg_html)
+                queue_mail(**mail)
                 return redirect('bookings:booking_confirmed', pk=event.pk)
             else:
                 event.delete() # if outlook event is null delete object
@@ -182,7 +254,7 @@ def confirm_slot_reschedule(request, slot, date, event_pk, duration):
     """
     event = Event.objects.filter(pk=int(event_pk))[0]
     social_account = event.social_account
-    token_obj = social_account.socialtoken_set.get()
+    token_obj = get_social_token(social_account)
     set_new_token(request,token_obj)
     date_obj = datetime.datetime.strptime(slot + ' ' + date, '%H:%M %a %d/%m/%y')
     event_dict = {'start_time': make_aware(date_obj), 'outlook_id':event.outlook_id, 'end_time':
@@ -192,18 +264,29 @@ def confirm_slot_reschedule(request, slot, date, event_pk, duration):
     msg_html = render_to_string('bookings/email_confirmation.html',
     {'event': event_dict, 'update': True,'start_time_formatted': event_dict['start_time'].strftime('%A, %-d %B %Y %H:%M'),
      'end_time_formatted':event_dict['end_time'].strftime('%A, %-d %B %Y %H:%M')})
-    response = update_booking(token_obj, social_account.user.email, event_dict, body_content=msg_html)
-    if isinstance(response, dict):
-        event.start_time = event_dict['start_time']
-        event.end_time = event_dict['end_time']
-        event.duration = int(duration)
+    mail = {'subject': 'Updated Booking: {}'.format(event.subject), 'message': '',
+            'from_email': 'imeetingbooker@gmail.com', 'recipient_list': [social_account.user.email],
+            'html_message': msg_html}
+    if settings.OUTLOOK_ASYNC_WRITES:
+        # reschedule now, the outlook event is moved by the run_outlook_jobs command
+        # or put back at these times if that fails
+        previous = get_event_times(event)
+        event.status = Event.PENDING
+    else:
+        response = update_booking(token_obj, social_account.user.email, event_dict, body_content=msg_html)
+        if not isinstance(response, dict):
+            return HttpResponse('Booking error for {} {} {}, Error {}'.format(slot, date, duration, response))
         event.outlook_id = response.get('id')
-        event.date_time = event_dict['start_time'].strftime('%A, %-d %B %Y %H:%M')
-        event.save()
-        send_mail(subject='Updated Booking: {}'.format(event.subject), message='', from_email='imeetingbooker@gmail.com',
-                  recipient_list=[social_account.user.email], html_message=msg_html)
-        return redirect('bookings:booking_confirmed', pk=event.pk)
-    return HttpResponse('Booking error for {} {} {}, Error {}'.format(slot, date, duration, response))
+    event.start_time = event_dict['start_time']
+    event.end_time = event_dict['end_time']
+    event.duration = int(duration)
+    event.date_time = event_dict['start_time'].strftime('%A, %-d %B %Y %H:%M')
+    event.save()
+    if settings.OUTLOOK_ASYNC_WRITES:
+        queue_outlook_write(OutlookWriteJob.UPDATE, event, body_content=msg_html, mail=mail, previous=previous)
+    else:
+        queue_mail(**mail)
+    return redirect('bookings:booking_confirmed', pk=event.pk)
 
 
 def cancel_booking_slot(request, event_pk):
@@ -219,14 +302,22 @@ def cancel_booking_slot(request, event_pk):
     else:
         # send request to cancel/delete outlook event
         social_account = event.social_account
-        token_obj = social_account.socialtoken_set.get()
+        msg_html = render_to_string('bookings/email_cancellation.html',
+                                    {'event': event})
+        mail = {'subject': 'Cancelled Booking: {}'.format(event.email), 'message': '',
+                'from_email': 'imeetingbooker@gmail.com', 'recipient_list': [social_account.user.email],
+                'html_message': msg_html}
+        if settings.OUTLOOK_ASYNC_WRITES:
+            # kept as cancelled until the outlook event is deleted by the run_outlook_jobs command
+            event.status = Event.CANCELLED
+            event.save(update_fields=['status'])
+            queue_outlook_write(OutlookWriteJob.CANCEL, event, mail=mail)
+            return HttpResponse(content="The event has been cancelled!")
+        token_obj = get_social_token(social_account)
         set_new_token(request,token_obj)
         if cancel_booking(token_obj, social_account.user.email, event.outlook_id):
             event.delete()  # send email
-            msg_html = render_to_string('bookings/email_cancellation.html',
-                                        {'event': event})
-            send_mail(subject='Cancelled Booking: {}'.format(event.email), message='', from_email='imeetingbooker@gmail.com',
-                      recipient_list=[social_account.user.email], html_message=msg_html)
+            queue_mail(**mail)
             return HttpResponse(content="The event has been cancelled!")
 
 
@@ -295,17 +386,57 @@ def display_available_time_slots(request, name, pk, date=None, action=None, even
     elif not date:
         date = datetime.datetime.today().date()
         appear = False
-    set_new_token(request,account.socialtoken_set.get())
-    table_data = booking_availabilty_preferences.get_time_slot_data(start_date=date)
-    days = BookingAvailability.get_next_7_days(date, format=True)
-    if int(event_pk):
-        table = BookingGrid(table_data, days=days, pk = int(pk), viewname='bookings:update_meeting_slot', event_pk=int(event_pk))
-    else:
-        table = BookingGrid(table_data, days=days, pk =int(pk))
-    # using RequestConfig automatically pulls values from request.GET and updates the table accordingly
-    RequestConfig(request, paginate=False).configure(table)
-    return render(request, 'bookings/display_available_time_slots.html', {'table': table, 'name': name,
-                                                                          'date': date.strftime('%x'),
-                                                                          'next': 'next', 'prev': 'prev',
-                                                                          'appear': appear, 'pk': pk,
-                                                                          'event_pk': event_pk})
+    if request.GET.get('render') == 'client':
+        # grid is drawn in the browser from available_time_slots_json
+        viewname = 'bookings:update_meeting_slot' if int(event_pk) else 'bookings:book_meeting_slot'
+        return render(request, 'bookings/display_available_time_slots_client.html',
+                      {'name': name, 'pk': pk, 'event_pk': event_pk, 'start': date.isoformat(),
+                       'slot_url': reverse(viewname, args=['99:99', 'Xxx 99/99/99', pk, event_pk])})
+    set_new_token(request, get_social_token(account))
+    table = get_booking_grid_html(request, booking_availabilty_preferences, date, int(pk), int(event_pk))
+    with timer('render'):
+        return render(request, 'bookings/display_available_time_slots.html', {'table': table, 'name': name,
+                                                                              'date': date.strftime('%x'),
+                                                                              'next': 'next', 'prev': 'prev',
+                                                                              'appear': appear, 'pk': pk,
+                                                                              'event_pk': event_pk})
+
+
+@staff_member_required
+def graph_metrics_view(request):
+    """
+    Graph call latency histograms, status codes, retries, bytes and per mailbox counts of this process
+    and booking grid cache hits and misses in the Prometheus text format, staff only
+    :param request:
+    :return: text/plain Prometheus exposition
+    """
+    return HttpResponse(graph_metrics.as_prometheus() + grid_cache_as_prometheus(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def request_profiles(request):
+    """
+    List stored request profiles, a staff user profiles a bookings request by adding ?profile=1
+    :param request:
+    :return: page of profiles newest first
+    """
+    return render(request, 'bookings/request_profiles.html', {'profiles': list_profiles()})
+
+
+@staff_member_required
+def request_profile(request, name):
+    """
+    Top functions of a stored request profile
+    :param request: GET sort=cumulative (default) or tottime
+    :param name: profile name
+    :return: page of the profile's slowest functions
+    """
+    sort = 'tottime' if request.GET.get('sort') == 'tottime' else 'cumulative'
+    try:
+        functions = get_top_functions(name, settings.PROFILE_TOP_FUNCTIONS, sort)
+    except (OSError, ValueError):
+        raise Http404('No profile {}'.format(name))
+    details = next((profile for profile in list_profiles() if profile['name'] == name), {'name': name})
+    return render(request, 'bookings/request_profile.html', {'profile': details, 'functions': functions,
+                                                             'sort': sort})
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 from meeting_scheduler.secret_settings import *
 import os
 import socket
+import tempfile
 # from meeting_scheduler.secret_settings import *
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -54,6 +55,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'bookings.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -61,6 +63,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'bookings.middleware.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'meeting_scheduler.urls'
@@ -98,6 +101,18 @@ DATABASES = {
     }
 }
 
+# cache shared by every web worker and command process on the host, so calendar and preference versions bumped
+# in one process invalidate cached calendars, weeks and grids in all of them, use memcached across several hosts
+# keys never expire unless given a timeout as incr rewrites a file cache key with the default timeout
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'meeting_scheduler_cache'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -168,6 +183,114 @@ SOCIALACCOUNT_PROVIDERS = {
     },
 }
 
+# pooled HTTP client for Graph, token and reCAPTCHA calls, hosts kept, connections per host and timeouts in seconds
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 20
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 20
+
+# retries of failed connections and of idempotent requests answered 429, 503 or 504, off by default, the
+# backoff factor in seconds between them (doubled each retry) when no Retry-After header is sent and the
+# longest wait in seconds for a Retry-After
+HTTP_MAX_RETRIES = 0
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_AFTER_MAX = 5
+
+# Microsoft Graph API and OAuth authority base urls, point both at a fake_graph server to run offline
+# e.g. GRAPH_BASE_URL = 'http://localhost:8001/v1.0' and OUTLOOK_AUTHORITY = 'http://localhost:8001'
+GRAPH_BASE_URL = 'https://graph.microsoft.com/v1.0'
+OUTLOOK_AUTHORITY = 'https://login.microsoftonline.com'
+
+# Graph requests in flight at once for the asyncio client
+GRAPH_ASYNC_MAX_CONCURRENCY = 8
+
+# events requested per calendarView page, further pages are followed through @odata.nextLink
+OUTLOOK_CALENDAR_PAGE_SIZE = 500
+
+# seconds Outlook calendar responses are cached for, per mailbox and date window
+OUTLOOK_CALENDAR_CACHE_TIMEOUT = 60
+
+# seconds computed weeks of availability are cached for, keys change with preferences and calendar versions
+AVAILABILITY_CACHE_TIMEOUT = 60
+
+# seconds rendered booking grid HTML is cached for, keys change with preferences and calendar versions
+BOOKING_GRID_CACHE_TIMEOUT = 60
+
+# weeks of booking grids shown ahead by default, the most a booker can ask for and weeks per page
+BOOKING_HORIZON_WEEKS = 4
+BOOKING_HORIZON_MAX_WEEKS = 8
+BOOKING_HORIZON_WEEKS_PER_PAGE = 2
+
+# slots after events followed within this many minutes by another on a day with 3+ events are kept free
+# as short breaks, unless that day's breaks add up to more than the total
+SHORT_BREAK_MAX_GAP = 15
+SHORT_BREAK_MAX_TOTAL = 20
+
+# public url of the site, used for token refresh callbacks made outside of a request
+OUTLOOK_SITE_URL = 'http://localhost:8000'
+
+# seconds before expiry access tokens are refreshed in the background and longest a refresh may hold its lock
+OUTLOOK_TOKEN_REFRESH_MARGIN = 300
+OUTLOOK_TOKEN_REFRESH_TIMEOUT = 30
+
+# calendar mirror kept by the sync_calendars command, days synced ahead and seconds before it counts as stale
+# the window covers the longest booking horizon, its weeks plus the day bounding the last one
+OUTLOOK_MIRROR_WINDOW_DAYS = BOOKING_HORIZON_MAX_WEEKS * 7 + 1
+OUTLOOK_MIRROR_MAX_AGE = 300
+
+# email outbox drained by the send_outbox command, emails per connection, attempts before giving up,
+# seconds before the first retry (doubled for each further attempt) and seconds a run's claim on an email
+# lasts before another run may send it
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_RETRY_DELAY = 30
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 600
+
+# save bookings locally as pending and leave the Outlook write to the run_outlook_jobs command,
+# jobs per pass, attempts before the event is marked failed, seconds before the first retry and seconds
+# a run's claim on a job lasts before another run may run it
+OUTLOOK_ASYNC_WRITES = False
+OUTLOOK_JOB_BATCH_SIZE = 20
+OUTLOOK_JOB_MAX_ATTEMPTS = 5
+OUTLOOK_JOB_RETRY_DELAY = 30
+OUTLOOK_JOB_CLAIM_TIMEOUT = 600
+
+# send a Server-Timing header breaking requests down into db, graph, token, slots and render phases to every
+# user, staff users always get it, requests taking longer than the threshold in milliseconds are logged with
+# their breakdown to slow_requests.log
+SERVER_TIMING_HEADER = False
+SLOW_REQUEST_THRESHOLD = 1000
+
+# staff can profile a bookings request with ?profile=1 or an X-Profile-Request: 1 header, profiles are kept
+# in PROFILE_DIR, at most PROFILE_RATE_LIMIT a minute across the processes sharing CACHES, PROFILE_MAX_FILES
+# kept and none over PROFILE_MAX_BYTES, /bookings/profiles/ lists them with their PROFILE_TOP_FUNCTIONS
+# slowest functions
+PROFILE_REQUESTS_ENABLED = True
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_RATE_LIMIT = 6
+PROFILE_MAX_FILES = 50
+PROFILE_MAX_BYTES = 5 * 1024 * 1024
+PROFILE_TOP_FUNCTIONS = 40
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'slow_requests': {'format': '%(asctime)s %(message)s'},
+    },
+    'handlers': {
+        'slow_requests': {
+            'class': 'logging.FileHandler',
+            'filename': os.path.join(BASE_DIR, 'slow_requests.log'),
+            'formatter': 'slow_requests',
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'bookings.slow_requests': {'handlers': ['slow_requests'], 'level': 'WARNING', 'propagate': False},
+    },
+}
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_USE_TLS = True
 #python connects to gmail by ipv4
@@ -175,3 +298,6 @@ EMAIL_HOST = socket.gethostbyname('smtp.gmail.com')
 EMAIL_PORT = 587
 
 NOCAPTCHA = True
+
+# reCAPTCHA verification endpoint, a fake_graph server answers it too for offline runs
+GOOGLE_RECAPTCHA_VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'